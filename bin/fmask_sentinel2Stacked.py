@@ -25,24 +25,51 @@ import sys
 import os
 import argparse
 import numpy
-import tempfile
 
+from osgeo import gdal
 from rios import fileinfo
 
 from fmask import config
 from fmask import fmask
+from fmask import sen2meta
+from fmask import sen2scene
 
 def getCmdargs():
     """
     Get command line arguments
     """
     parser = argparse.ArgumentParser()
+    parser.add_argument('--safedir', 
+        help=("Input .SAFE directory (with a single granule), granule directory, or "+
+            "tile metadata XML file. The band files are read directly, and this "+
+            "replaces --toa and --tilexml"))
+    parser.add_argument('--resolution', type=float, default=sen2scene.DEFAULT_RESOLUTION,
+        help=("Resolution (in metres) to process at, when using --safedir "+
+            "(default=%(default)s)"))
     parser.add_argument('-a', '--toa', 
         help='Input stack of TOA reflectance (as supplied by ESA)')
     parser.add_argument('-z', '--anglesfile', 
         help=("Input angles file containing satellite and sun azimuth and zenith. " +
             "See fmask_sentinel2makeAnglesImage.py for assistance in creating this"))
+    parser.add_argument('--tilexml', 
+        help=("Input tile metadata XML file. If given, the sun and satellite angles "+
+            "are interpolated directly from this, and no angles file is required"))
+    parser.add_argument('--cachemeta', default=False, action='store_true',
+        help=("Keep a cache of the parsed tile metadata next to the XML file, so that "+
+            "it is quicker to read next time"))
     parser.add_argument('-o', '--output', help='Output cloud mask')
+    parser.add_argument('--cog', default=False, action='store_true',
+        help=("Write the output cloud mask as a Cloud Optimised GeoTIFF (tiled, "+
+            "compressed, with overviews)"))
+    parser.add_argument('--shadowmatchstats', 
+        help="Optional output text file of statistics on the matching of cloud shadows")
+    parser.add_argument('--classstats', 
+        help="Optional output JSON file of the counts and percentages of each class in the output")
+    parser.add_argument('--classstatscellsize', type=int, 
+        help="Also count each class for cells of this size (in pixels), in the --classstats file")
+    parser.add_argument('--anglesoverview', type=int, 
+        help=("Read the angles from this overview level (0-based) of the --anglesfile, "+
+            "which must already exist, rather than at full resolution"))
     parser.add_argument('-v', '--verbose', dest='verbose', default=False,
         action='store_true', help='verbose output')
     parser.add_argument('-k', '--keepintermediates', 
@@ -77,7 +104,11 @@ def getCmdargs():
 
     cmdargs = parser.parse_args()
 
-    if cmdargs.output is None or cmdargs.toa is None or cmdargs.anglesfile is None:
+    if cmdargs.safedir is not None:
+        cmdargs.tilexml = sen2scene.findTileXML(cmdargs.safedir)
+
+    if (cmdargs.output is None or (cmdargs.safedir is None and (cmdargs.toa is None or 
+            (cmdargs.anglesfile is None and cmdargs.tilexml is None)))):
         parser.print_help()
         sys.exit(1)
     
@@ -87,11 +118,13 @@ def getCmdargs():
 def checkAnglesFile(inputAnglesFile, toafile):
     """
     Check that the resolution of the input angles file matches that of the input
-    TOA reflectance file. If not, make a VRT file which will resample it 
-    on-the-fly. Only checks the resolution, assumes that if these match, then everything
-    else will match too. 
+    TOA reflectance file. If not, make a VRT file (on GDAL's in-memory filesystem)
+    which will resample it on-the-fly. Only checks the resolution, assumes that if 
+    these match, then everything else will match too. 
     
-    Return the name of the angles file to use. 
+    Return the name of the angles file to use. If this is not the input angles 
+    file, it is a VRT which should be removed with gdal.Unlink when no longer 
+    required. 
     
     """
     toaImgInfo = fileinfo.ImageInfo(toafile)
@@ -99,15 +132,12 @@ def checkAnglesFile(inputAnglesFile, toafile):
     
     outputAnglesFile = inputAnglesFile
     if (toaImgInfo.xRes != anglesImgInfo.xRes) or (toaImgInfo.yRes != anglesImgInfo.yRes):
-        (fd, vrtName) = tempfile.mkstemp(prefix='angles', suffix='.vrt')
-        os.close(fd)
-        cmdFmt = ("gdalwarp -q -of VRT -tr {xres} {yres} -te {xmin} {ymin} {xmax} {ymax} "+
-            "-r near {infile}  {outfile} ")
-        cmd = cmdFmt.format(xres=toaImgInfo.xRes, yres=toaImgInfo.yRes, xmin=toaImgInfo.xMin,
-            ymin=toaImgInfo.yMin, xmax=toaImgInfo.xMax, ymax=toaImgInfo.yMax, 
-            outfile=vrtName, infile=inputAnglesFile)
-        os.system(cmd)
-        outputAnglesFile = vrtName
+        bounds = (toaImgInfo.xMin, toaImgInfo.yMin, toaImgInfo.xMax, toaImgInfo.yMax)
+        outputAnglesFile = '/vsimem/fmask_{}_angles.vrt'.format(os.getpid())
+        ds = gdal.Warp(outputAnglesFile, inputAnglesFile, format='VRT', 
+            xRes=toaImgInfo.xRes, yRes=toaImgInfo.yRes, outputBounds=bounds, 
+            resampleAlg='near')
+        del ds
     
     return outputAnglesFile
             
@@ -118,18 +148,43 @@ def mainRoutine():
     """
     cmdargs = getCmdargs()
     
-    anglesfile = checkAnglesFile(cmdargs.anglesfile, cmdargs.toa)
-    anglesInfo = config.AnglesFileInfo(anglesfile, 3, anglesfile, 2, anglesfile, 1, anglesfile, 0)
+    fmaskConfig = config.FmaskConfig(config.FMASK_SENTINEL2)
+    
+    toafile = cmdargs.toa
+    sceneVRT = None
+    if cmdargs.safedir is not None:
+        # Read only the required bands, through an in-memory VRT
+        sceneVRT = '/vsimem/fmask_{}_allbands.vrt'.format(os.getpid())
+        sen2scene.makeReflectiveVRT(cmdargs.tilexml, fmaskConfig, sceneVRT, 
+            cmdargs.resolution)
+        toafile = sceneVRT
+    
+    anglesfile = None
+    if cmdargs.tilexml is not None:
+        tileMeta = sen2meta.Sen2TileMeta(filename=cmdargs.tilexml, 
+            useCache=cmdargs.cachemeta)
+        toaImgInfo = fileinfo.ImageInfo(toafile)
+        anglesInfo = config.Sen2TileAnglesInfo(tileMeta, toaImgInfo.transform)
+    else:
+        anglesfile = checkAnglesFile(cmdargs.anglesfile, toafile)
+        anglesInfo = config.AnglesFileInfo(anglesfile, 3, anglesfile, 2, anglesfile, 1, anglesfile, 0)
+        anglesInfo.setLazyReading(True, cmdargs.anglesoverview)
     
     fmaskFilenames = config.FmaskFilenames()
-    fmaskFilenames.setTOAReflectanceFile(cmdargs.toa)
+    fmaskFilenames.setTOAReflectanceFile(toafile)
     fmaskFilenames.setOutputCloudMaskFile(cmdargs.output)
+    if cmdargs.shadowmatchstats is not None:
+        fmaskFilenames.setShadowMatchStatsFile(cmdargs.shadowmatchstats)
+    if cmdargs.classstats is not None:
+        fmaskFilenames.setClassStatsFile(cmdargs.classstats)
     
-    fmaskConfig = config.FmaskConfig(config.FMASK_SENTINEL2)
     fmaskConfig.setAnglesInfo(anglesInfo)
     fmaskConfig.setKeepIntermediates(cmdargs.keepintermediates)
     fmaskConfig.setVerbose(cmdargs.verbose)
     fmaskConfig.setTempDir(cmdargs.tempdir)
+    fmaskConfig.setClassStatsCellSize(cmdargs.classstatscellsize)
+    if cmdargs.cog:
+        fmaskConfig.setGdalDriverName(fmask.COG_DRIVER_NAME)
     fmaskConfig.setTOARefScaling(10000.0)
     fmaskConfig.setMinCloudSize(cmdargs.mincloudsize)
     fmaskConfig.setEqn17CloudProbThresh(cmdargs.cloudprobthreshold / 100)    # Note conversion from percentage
@@ -137,15 +192,17 @@ def mainRoutine():
     fmaskConfig.setEqn20GreenSnowThresh(cmdargs.greensnowthreshold)
     
     # Work out a suitable buffer size, in pixels, dependent on the resolution of the input TOA image
-    toaImgInfo = fileinfo.ImageInfo(cmdargs.toa)
+    toaImgInfo = fileinfo.ImageInfo(toafile)
     fmaskConfig.setCloudBufferSize(int(cmdargs.cloudbufferdistance / toaImgInfo.xRes))
     fmaskConfig.setShadowBufferSize(int(cmdargs.shadowbufferdistance / toaImgInfo.xRes))
     
-    fmask.doFmask(fmaskFilenames, fmaskConfig)
-    
-    if anglesfile != cmdargs.anglesfile:
-        # Must have been a temporary vrt, so remove it
-        os.remove(anglesfile)
+    try:
+        fmask.doFmask(fmaskFilenames, fmaskConfig)
+    finally:
+        if anglesfile is not None and anglesfile != cmdargs.anglesfile:
+            gdal.Unlink(anglesfile)
+        if sceneVRT is not None:
+            gdal.Unlink(sceneVRT)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Make the TOA reflectance, saturation mask and angles images for a USGS 
+Landsat scene, in a single pass through the stack of reflective radiance 
+bands. This replaces running fmask_usgsLandsatMakeAnglesImage.py, 
+fmask_usgsLandsatSaturationMask.py and fmask_usgsLandsatTOA.py separately. 
+"""
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+import sys
+import argparse
+from fmask import landsatingest
+
+def getCmdargs():
+    """
+    Get command line arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--infile', help='Input raw DN radiance image')
+    parser.add_argument('-m', '--mtl', help='.MTL  file')
+    parser.add_argument('-o', '--toa', help='Output TOA reflectance file')
+    parser.add_argument('-s', '--saturation', help='Output saturation mask file')
+    parser.add_argument('-z', '--anglesfile', help='Output image of sun and satellite angles')
+
+    cmdargs = parser.parse_args()
+
+    if (cmdargs.infile is None or cmdargs.mtl is None or  
+            (cmdargs.toa is None and cmdargs.saturation is None and 
+            cmdargs.anglesfile is None)):
+        parser.print_help()
+        sys.exit()
+    return cmdargs
+
+
+def mainRoutine():
+    cmdargs = getCmdargs()
+    
+    landsatingest.makeLandsatInputs(cmdargs.infile, cmdargs.mtl, cmdargs.toa, 
+        cmdargs.saturation, cmdargs.anglesfile)
+    
+if __name__ == '__main__':
+    mainRoutine()
@@ -22,11 +22,14 @@ reflective and thermal and runs the fmask on it.
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 from __future__ import print_function, division
 
+import os
 import sys
 import argparse
 from fmask import fmask
 from fmask import config
+from fmask import landsatscene
 
+from osgeo import gdal
 from rios import fileinfo
 
 
@@ -35,16 +38,36 @@ def getCmdargs():
     Get command line arguments
     """
     parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--scenedir', 
+        help=('Directory of an unpacked USGS scene (or its .MTL file). The band files '+
+            'are read directly, and this replaces --thermal, --toa, --radiance and --mtl'))
     parser.add_argument('-t', '--thermal', help='Input stack of thermal bands')
     parser.add_argument('-a', '--toa', 
         help='Input stack of TOA reflectance (see fmask_usgsLandsatTOA.py)')
+    parser.add_argument('-r', '--radiance', 
+        help=('Input stack of reflective radiance bands. May be given instead of --toa, '+
+            'in which case the TOA reflectance is calculated as it is needed, '+
+            'without writing a TOA reflectance file'))
     parser.add_argument('-m', '--mtl', help='Input .MTL file')
     parser.add_argument('-s', '--saturation', 
         help='Input saturation mask (see fmask_usgsLandsatSaturationMask.py)')
     parser.add_argument("-z", "--anglesfile", 
-        help="Image of sun and satellite angles (see fmask_usgsLandsatMakeAnglesImage.py)")
+        help=("Image of sun and satellite angles (see fmask_usgsLandsatMakeAnglesImage.py). "+
+            "If not given, the same angles are calculated directly, without an image"))
     parser.add_argument('-o', '--output', dest='output',
         help='output cloud mask')
+    parser.add_argument('--cog', default=False, action='store_true',
+        help=("Write the output cloud mask as a Cloud Optimised GeoTIFF (tiled, "+
+            "compressed, with overviews)"))
+    parser.add_argument('--shadowmatchstats', 
+        help="Optional output text file of statistics on the matching of cloud shadows")
+    parser.add_argument('--classstats', 
+        help="Optional output JSON file of the counts and percentages of each class in the output")
+    parser.add_argument('--classstatscellsize', type=int, 
+        help="Also count each class for cells of this size (in pixels), in the --classstats file")
+    parser.add_argument('--anglesoverview', type=int, 
+        help=("Read the angles from this overview level (0-based) of the --anglesfile, "+
+            "which must already exist, rather than at full resolution"))
     parser.add_argument('-v', '--verbose', default=False,
         action='store_true', help='verbose output')
     parser.add_argument('-k', '--keepintermediates', dest='keepintermediates', 
@@ -79,9 +102,17 @@ def getCmdargs():
 
     cmdargs = parser.parse_args()
 
-    if (cmdargs.thermal is None or cmdargs.anglesfile is None or 
-            cmdargs.mtl is None is None or cmdargs.output is None
-            or cmdargs.toa is None):
+    if cmdargs.scenedir is not None:
+        replaced = [option for (option, value) in [('--toa', cmdargs.toa), 
+            ('--radiance', cmdargs.radiance), ('--thermal', cmdargs.thermal), 
+            ('--mtl', cmdargs.mtl)] if value is not None]
+        if len(replaced) > 0:
+            parser.error("--scenedir cannot be used with " + ", ".join(replaced))
+        cmdargs.mtl = landsatscene.findMTLFile(cmdargs.scenedir)
+
+    if (cmdargs.output is None or cmdargs.mtl is None or (cmdargs.scenedir is None and
+            (cmdargs.thermal is None or 
+            (cmdargs.toa is None and cmdargs.radiance is None)))):
         parser.print_help()
         sys.exit(1)
     
@@ -98,10 +129,8 @@ def mainRoutine():
     # stack of Landsat thermal bands
     thermalInfo = config.readThermalInfoFromLandsatMTL(cmdargs.mtl)
                         
-    anglesfile = cmdargs.anglesfile
-    anglesInfo = config.AnglesFileInfo(anglesfile, 3, anglesfile, 2, anglesfile, 1, anglesfile, 0)
-    
     mtlInfo = config.readMTLFile(cmdargs.mtl)
+    
     landsat = mtlInfo['SPACECRAFT_ID'][-1]
     
     if landsat == '4':
@@ -115,32 +144,67 @@ def mainRoutine():
     else:
         raise SystemExit('Unsupported Landsat sensor')
         
+    fmaskConfig = config.FmaskConfig(sensor)
     fmaskFilenames = config.FmaskFilenames()
-    fmaskFilenames.setTOAReflectanceFile(cmdargs.toa)
-    fmaskFilenames.setThermalFile(cmdargs.thermal)
+    anglesfile = cmdargs.anglesfile
+    
+    sceneVRT = None
+    if cmdargs.scenedir is not None:
+        # Read the band files directly, through an in-memory VRT
+        sceneVRT = '/vsimem/fmask_{}_ref.vrt'.format(os.getpid())
+        (bandNumbers, thermalFile) = landsatscene.makeReflectiveVRT(cmdargs.mtl, 
+            fmaskConfig, sceneVRT)
+        reflectiveFile = sceneVRT
+        fmaskFilenames.setRadianceFile(sceneVRT, cmdargs.mtl, anglesfile, bandNumbers)
+        fmaskFilenames.setThermalFile(thermalFile)
+    else:
+        reflectiveFile = cmdargs.toa
+        if cmdargs.toa is not None:
+            fmaskFilenames.setTOAReflectanceFile(cmdargs.toa)
+        else:
+            reflectiveFile = cmdargs.radiance
+            fmaskFilenames.setRadianceFile(cmdargs.radiance, cmdargs.mtl, anglesfile)
+        fmaskFilenames.setThermalFile(cmdargs.thermal)
+    
+    if anglesfile is not None:
+        anglesInfo = config.AnglesFileInfo(anglesfile, 3, anglesfile, 2, anglesfile, 1, anglesfile, 0)
+        anglesInfo.setLazyReading(True, cmdargs.anglesoverview)
+    else:
+        anglesInfo = config.LandsatAnglesInfo.fromTemplateImage(reflectiveFile, mtlInfo)
+    
     fmaskFilenames.setOutputCloudMaskFile(cmdargs.output)
+    if cmdargs.shadowmatchstats is not None:
+        fmaskFilenames.setShadowMatchStatsFile(cmdargs.shadowmatchstats)
+    if cmdargs.classstats is not None:
+        fmaskFilenames.setClassStatsFile(cmdargs.classstats)
     if cmdargs.saturation is not None:
         fmaskFilenames.setSaturationMask(cmdargs.saturation)
     else:
         print('saturation mask not supplied - see fmask_usgsLandsatSaturationMask.py')
     
-    fmaskConfig = config.FmaskConfig(sensor)
     fmaskConfig.setThermalInfo(thermalInfo)
     fmaskConfig.setAnglesInfo(anglesInfo)
     fmaskConfig.setKeepIntermediates(cmdargs.keepintermediates)
     fmaskConfig.setVerbose(cmdargs.verbose)
     fmaskConfig.setTempDir(cmdargs.tempdir)
+    fmaskConfig.setClassStatsCellSize(cmdargs.classstatscellsize)
+    if cmdargs.cog:
+        fmaskConfig.setGdalDriverName(fmask.COG_DRIVER_NAME)
     fmaskConfig.setMinCloudSize(cmdargs.mincloudsize)
     fmaskConfig.setEqn17CloudProbThresh(cmdargs.cloudprobthreshold / 100)    # Note conversion from percentage
     fmaskConfig.setEqn20NirSnowThresh(cmdargs.nirsnowthreshold)
     fmaskConfig.setEqn20GreenSnowThresh(cmdargs.greensnowthreshold)
 
     # Work out a suitable buffer size, in pixels, dependent on the resolution of the input TOA image
-    toaImgInfo = fileinfo.ImageInfo(cmdargs.toa)
+    toaImgInfo = fileinfo.ImageInfo(reflectiveFile)
     fmaskConfig.setCloudBufferSize(int(cmdargs.cloudbufferdistance / toaImgInfo.xRes))
     fmaskConfig.setShadowBufferSize(int(cmdargs.shadowbufferdistance / toaImgInfo.xRes))
     
-    fmask.doFmask(fmaskFilenames, fmaskConfig)
+    try:
+        fmask.doFmask(fmaskFilenames, fmaskConfig)
+    finally:
+        if sceneVRT is not None:
+            gdal.Unlink(sceneVRT)
     
 if __name__ == '__main__':
     mainRoutine()
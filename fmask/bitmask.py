@@ -0,0 +1,272 @@
+"""
+A 2-d mask stored with one bit per pixel, packed along each row, as made by
+numpy.packbits.
+
+Logical operations on these work on 8 pixels at a time, and the memory
+required is one eighth of that for a numpy bool array. The neighbourhood
+filters (:meth:`BitMask.majority3x3` and :meth:`BitMask.dilate`) are done
+bit-parallel, with shifts and logical operations on the packed rows, so
+no per-pixel arithmetic is ever done, and no float arrays are allocated.
+
+"""
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+import numpy
+
+# Number of bits set in each possible byte value, for counting when
+# numpy.bitwise_count is not available
+POPCOUNT_LUT = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+
+def popcount(packed):
+    """
+    Return the total number of bits set in the given uint8 array
+    """
+    if hasattr(numpy, 'bitwise_count'):
+        counts = numpy.bitwise_count(packed)
+    else:
+        counts = POPCOUNT_LUT[packed]
+    return int(counts.sum(dtype=numpy.int64))
+
+
+class BitMask(object):
+    """
+    A 2-d mask of shape (nrows, ncols), held as a (nrows, ceil(ncols/8)) uint8
+    array of packed bits. The first pixel of each row is the most significant
+    bit of the first byte, as for numpy.packbits. Any padding bits at the end
+    of each row are always zero.
+
+    Normally created with :meth:`fromBool`, and converted back with :meth:`toBool`.
+    The &, | and ~ operators work as for bool arrays.
+
+    """
+    def __init__(self, packed, ncols):
+        self.packed = packed
+        self.ncols = ncols
+        self.shape = (packed.shape[0], ncols)
+
+    @classmethod
+    def fromBool(cls, mask):
+        """
+        Make a BitMask from a 2-d numpy array, with True (non-zero) for masked pixels
+        """
+        return cls(numpy.packbits(mask.astype(numpy.bool), axis=1), mask.shape[1])
+
+    def toBool(self):
+        """
+        Return the mask as a 2-d numpy bool array
+        """
+        return numpy.unpackbits(self.packed, axis=1)[:, :self.ncols].astype(numpy.bool)
+
+    def tailMask(self):
+        """
+        Return a 1-d uint8 array, for one packed row, with only the bits
+        for actual pixels set, i.e. zero for the padding bits.
+
+        """
+        tail = numpy.empty(self.packed.shape[1], dtype=numpy.uint8)
+        tail.fill(0xff)
+        numPad = tail.shape[0] * 8 - self.ncols
+        if numPad > 0:
+            tail[-1] = (0xff << numPad) & 0xff
+        return tail
+
+    def newLike(self, packed):
+        """
+        Return a new BitMask of the same shape, for the given packed array,
+        with its padding bits cleared.
+
+        """
+        if self.ncols % 8 != 0:
+            packed &= self.tailMask()
+        return BitMask(packed, self.ncols)
+
+    def __and__(self, other):
+        return BitMask(self.packed & other.packed, self.ncols)
+
+    def __or__(self, other):
+        return BitMask(self.packed | other.packed, self.ncols)
+
+    def __invert__(self):
+        return self.newLike(~self.packed)
+
+    def count(self):
+        """
+        Return the number of masked pixels
+        """
+        return popcount(self.packed)
+
+    def countAnd(self, other):
+        """
+        Return the number of pixels masked in both this and the other BitMask,
+        i.e. the size of their overlap.
+
+        """
+        return popcount(self.packed & other.packed)
+
+    def shiftCols(self, n):
+        """
+        Return a new BitMask with every pixel moved n columns to the right
+        (or left, if n is negative), i.e. out[:, c] = in[:, c-n]. Pixels
+        moved in from outside the array are zero.
+
+        """
+        (nbytes, nbits) = divmod(abs(n), 8)
+        packed = self.packed
+        out = numpy.zeros(packed.shape, dtype=numpy.uint8)
+        ncolBytes = packed.shape[1]
+        if nbytes < ncolBytes:
+            if n >= 0:
+                src = packed[:, :ncolBytes-nbytes]
+                out[:, nbytes:] = src >> nbits
+                if nbits > 0:
+                    out[:, nbytes+1:] |= (src[:, :-1] << (8 - nbits)) & 0xff
+            else:
+                src = packed[:, nbytes:]
+                out[:, :ncolBytes-nbytes] = (src << nbits) & 0xff
+                if nbits > 0:
+                    out[:, :ncolBytes-nbytes-1] |= src[:, 1:] >> (8 - nbits)
+        return self.newLike(out)
+
+    def shiftRows(self, n):
+        """
+        Return a new BitMask with every pixel moved n rows down (or up, if n
+        is negative), i.e. out[r] = in[r-n]. Pixels moved in from outside
+        the array are zero.
+
+        """
+        packed = self.packed
+        out = numpy.zeros(packed.shape, dtype=numpy.uint8)
+        nrows = packed.shape[0]
+        if abs(n) < nrows:
+            if n >= 0:
+                out[n:] = packed[:nrows-n]
+            else:
+                out[:nrows+n] = packed[-n:]
+        return BitMask(out, self.ncols)
+
+    def colNeighbours(self):
+        """
+        Return a tuple of BitMasks (before, after) of each pixel's neighbour one
+        column to the left and to the right. At the edges of the array, the
+        edge pixel itself is used (as for scipy.ndimage's mode='reflect').
+
+        """
+        before = self.shiftCols(1)
+        before.packed[:, 0] |= self.packed[:, 0] & 0x80
+        after = self.shiftCols(-1)
+        lastByte = (self.ncols - 1) // 8
+        lastBit = numpy.uint8(0x80 >> ((self.ncols - 1) % 8))
+        after.packed[:, lastByte] |= self.packed[:, lastByte] & lastBit
+        return (before, after)
+
+    def rowNeighbours(self):
+        """
+        Return a tuple of BitMasks (above, below) of each pixel's neighbour one
+        row up and down. At the edges of the array, the edge pixel itself is
+        used (as for scipy.ndimage's mode='reflect').
+
+        """
+        above = self.shiftRows(1)
+        above.packed[0] = self.packed[0]
+        below = self.shiftRows(-1)
+        below.packed[-1] = self.packed[-1]
+        return (above, below)
+
+    def majority3x3(self):
+        """
+        Return a new BitMask, set where 5 or more of the 3x3 neighbourhood
+        (including the pixel itself) are set. The edges are treated as for
+        scipy.ndimage's mode='reflect', so this is exactly the same as
+
+            uniform_filter(mask*2.0, size=3) >= 1.0
+
+        The neighbours are counted with bit-sliced adders, i.e. each bit
+        of the count is a separate BitMask.
+
+        """
+        # Column sums of three rows, as 2-bit numbers (bit0, bit1)
+        (above, below) = self.rowNeighbours()
+        colSum = addBits(above, self, below)
+
+        # Add the column sums to the left and right, for a 4-bit total
+        (before0, after0) = colSum[0].colNeighbours()
+        (before1, after1) = colSum[1].colNeighbours()
+        (u0, u1, u2) = addBitNumbers((before0, before1), colSum)
+        (v0, v1, v2, v3) = addBitNumbers((u0, u1, u2), (after0, after1))
+
+        return v3 | (v2 & (v1 | v0))
+
+    def dilate(self, radius):
+        """
+        Return a new BitMask, set for every pixel within the given radius
+        (in pixels) of a set pixel, i.e. the same as scipy.ndimage.maximum_filter
+        with the circular footprint of :func:`fmask.fmask.makeBufferKernel`.
+
+        Each row of the disk is a horizontal dilation, which is built up by
+        shifting, and these are then shifted vertically and combined.
+
+        """
+        # Horizontal dilations by each half-width, built incrementally
+        hDilated = [self]
+        halfWidths = [int(numpy.floor(numpy.sqrt(radius * radius - dy * dy)))
+            for dy in range(radius + 1)]
+        for w in range(1, halfWidths[0] + 1):
+            hDilated.append(hDilated[-1] | self.shiftCols(w) | self.shiftCols(-w))
+
+        out = hDilated[halfWidths[0]]
+        for dy in range(1, radius + 1):
+            h = hDilated[halfWidths[dy]]
+            out = out | h.shiftRows(dy) | h.shiftRows(-dy)
+        return out
+
+
+def addBits(a, b, c):
+    """
+    Full adder. Return the sum of three BitMasks, as a tuple of BitMasks
+    (bit0, bit1)
+
+    """
+    aXorB = a.packed ^ b.packed
+    bit0 = aXorB ^ c.packed
+    bit1 = (a.packed & b.packed) | (c.packed & aXorB)
+    return (BitMask(bit0, a.ncols), BitMask(bit1, a.ncols))
+
+
+def addBitNumbers(x, y):
+    """
+    Add two numbers, each given as a tuple of BitMasks (bit0, bit1, ...),
+    least significant first. The second may have fewer bits than the first.
+    Returns a tuple of BitMasks, with one more bit than the first.
+
+    """
+    ncols = x[0].ncols
+    zero = numpy.zeros(x[0].packed.shape, dtype=numpy.uint8)
+    carry = zero
+    result = []
+    for i in range(len(x)):
+        xBits = x[i].packed
+        yBits = zero
+        if i < len(y):
+            yBits = y[i].packed
+        xXorY = xBits ^ yBits
+        result.append(BitMask(xXorY ^ carry, ncols))
+        carry = (xBits & yBits) | (carry & xXorY)
+    result.append(BitMask(carry, ncols))
+    return tuple(result)
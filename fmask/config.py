@@ -23,11 +23,15 @@ from __future__ import print_function, division
 import abc
 import numpy
 import scipy.constants
+from scipy.ndimage import map_coordinates, distance_transform_edt
 
 from osgeo import gdal
 gdal.UseExceptions()
 from rios import applier
+from rios import fileinfo
 from . import fmaskerrors
+from . import landsatangles
+from . import tilecache
 
 FMASK_LANDSAT47 = 0
 "Landsat 4 to 7"
@@ -70,6 +74,12 @@ class FmaskConfig(object):
     # Minimum number of pixels in a single cloud (before buffering). A non-zero value
     # would allow filtering of very small clouds. 
     minCloudSize_pixels = 0
+    # Clouds smaller than this (in pixels) have their shadows matched with a 
+    # vectorised method, many clouds at once. Does not change the results. 
+    smallCloudMatchSize = 100
+    # Size (in pixels) of the grid cells for per-cell counts of each class
+    # in the output. None means only whole-image counts. 
+    classStatsCellSize = None
         
     # constants from the paper that could probably be tweaked
     # equation numbers are from the original paper.
@@ -209,6 +219,27 @@ class FmaskConfig(object):
         """
         self.minCloudSize_pixels = minCloudSize
         
+    def setSmallCloudMatchSize(self, smallCloudMatchSize):
+        """
+        Set the size (in pixels) below which a cloud is treated as small when
+        matching cloud shadows. Small clouds are matched in batches, with a
+        vectorised search, which is much faster when a scene has very many tiny
+        clouds. The matched shadows are the same either way. Defaults to 100, 
+        and a value of 0 disables this. 
+        
+        """
+        self.smallCloudMatchSize = smallCloudMatchSize
+        
+    def setClassStatsCellSize(self, cellSize):
+        """
+        Set the size (in pixels) of the cells of a grid over the image, for 
+        which the number of pixels of each class in the output are counted 
+        (see :class:`fmask.fmask.FmaskClassStats`). The whole-image counts are
+        always made. Defaults to None, i.e. no grid. 
+        
+        """
+        self.classStatsCellSize = cellSize
+        
     def setVerbose(self, verbose):
         """
         Print informative messages. Defaults to False.
@@ -339,6 +370,10 @@ class FmaskConfig(object):
         """
         Change the GDAL driver used for writing the final output file. Default
         value is taken from the default for the RIOS package, as per $RIOS_DFLT_DRIVER. 
+        
+        The name 'COG' (:data:`fmask.fmask.COG_DRIVER_NAME`) writes a Cloud Optimised 
+        GeoTIFF, tiled and compressed, with overviews, colour table and class names, 
+        even with versions of GDAL which do not have the COG driver. 
         """
         self.gdalDriverName = driverName
 
@@ -351,6 +386,12 @@ class FmaskFilenames(object):
     thermal = None
     saturationMask = None
     outputMask = None
+    shadowMatchStats = None
+    classStats = None
+    radiance = None
+    radianceMTL = None
+    radianceAngles = None
+    radianceBandNumbers = None
     
     def __init__(self, toaRefFile=None, thermalFile=None, outputMask=None,
                 saturationMask=None):
@@ -391,6 +432,43 @@ class FmaskFilenames(object):
         """
         self.toaRef = toaRefFile
     
+    def setRadianceFile(self, radianceFile, mtlFile, anglesFile=None, bandNumbers=None):
+        """
+        Use a Landsat radiance file (as supplied by USGS) as the reflective
+        input, instead of a TOA reflectance file. The TOA reflectance is then
+        calculated as it is needed, within each pass of fmask, in exactly the same
+        way as by :func:`fmask.landsatTOA.makeTOAReflectance`, using the 
+        calibration information from the given .MTL file. This avoids writing
+        a TOA reflectance file, and reading it back. 
+        
+        The anglesFile is an angles image as for 
+        :func:`fmask.landsatTOA.makeTOAReflectance`. If it is not given, the
+        sun angles are calculated directly, as in 
+        :func:`fmask.landsatangles.makeAnglesImage`. 
+        
+        If the radiance file does not have all the usual reflective bands (e.g. 
+        as made by :func:`fmask.landsatscene.makeReflectiveVRT`), bandNumbers is the 
+        list of MTL band numbers of its layers. 
+        
+        If a TOA reflectance file has also been set, it is used instead. 
+        
+        """
+        self.radiance = radianceFile
+        self.radianceMTL = mtlFile
+        self.radianceAngles = anglesFile
+        self.radianceBandNumbers = bandNumbers
+    
+    def getReferenceFile(self):
+        """
+        Return the name of the reflective input file, i.e. the TOA reflectance
+        file, or the radiance file if no TOA file has been set. This defines
+        the pixel grid for all of fmask. 
+        
+        """
+        if self.toaRef is not None:
+            return self.toaRef
+        return self.radiance
+    
     def setSaturationMask(self, mask):
         """
         Set the mask to use for ignoring saturated pixels. By default
@@ -424,6 +502,32 @@ class FmaskFilenames(object):
         
         """
         self.outputMask = cloudMask
+    
+    def setShadowMatchStatsFile(self, statsFile):
+        """
+        Set the path of an optional text file, to which statistics on the 
+        matching of cloud shadows are written. This has a line for each cloud, 
+        giving its size, the number of search steps evaluated, the best
+        similarity, whether it was matched, and the time taken, followed by
+        histograms of these. It is useful for finding out why some images
+        take a long time to process. By default, no statistics are written. 
+        
+        See :class:`fmask.fmask.ShadowMatchStats`. 
+        
+        """
+        self.shadowMatchStats = statsFile
+    
+    def setClassStatsFile(self, statsFile):
+        """
+        Set the path of an optional JSON file, to which the counts and 
+        percentages of each class in the output mask are written, as a sidecar
+        to the mask. These are collected as the mask is written, so it is
+        not read again. By default, no file is written. 
+        
+        See :class:`fmask.fmask.FmaskClassStats`. 
+        
+        """
+        self.classStats = statsFile
 
 
 class ThermalFileInfo(object):
@@ -603,6 +707,9 @@ class AnglesFileInfo(AnglesInfo):
     """
     An implementation of AnglesInfo that reads the information from
     GDAL supported files.
+    
+    By default, only the windows of the angle images covering each query are
+    read, as required (see :meth:`setLazyReading`). 
     """
     def __init__(self, solarZenithFilename, solarZenithBand, solarAzimuthFilename,
             solarAzimuthBand, viewZenithFilename, viewZenithBand, 
@@ -628,6 +735,32 @@ class AnglesFileInfo(AnglesInfo):
         
         # This default value matches the file produced by fmask_usgsLandsatMakeAnglesImage.py
         self.scaleToRadians = 0.01
+        
+        # Settings for reading only the windows required (see setLazyReading())
+        self.lazyReading = True
+        self.overviewLevel = None
+        # Open datasets, and tile caches for each angle, when reading lazily
+        self.datasets = None
+        self.angleTiles = None
+    
+    def setLazyReading(self, lazyReading, overviewLevel=None):
+        """
+        If lazyReading is True, the angle images are not read into memory 
+        by prepareForQuerying(). Instead, each query reads just the window 
+        covering the requested indices, through a small cache of tiles (see 
+        :class:`fmask.tilecache.TileCache`), so memory use and reading depend 
+        on the area of cloud rather than the size of the image. This is the 
+        default, and gives exactly the same values as reading whole images. 
+        If lazyReading is False, the whole angle images are read into memory.
+        
+        If overviewLevel is also given, the angles are read from that overview
+        (0-based) of each angle band, which must already exist. Since the angles 
+        change only slowly across an image, this is generally a close enough
+        approximation, with much less reading. 
+        
+        """
+        self.lazyReading = lazyReading
+        self.overviewLevel = overviewLevel
     
     @staticmethod
     def readData(filename, bandNum):
@@ -641,6 +774,10 @@ class AnglesFileInfo(AnglesInfo):
         """
         Called when fmask is about to query this object for angles.
         """
+        if self.lazyReading:
+            self.prepareLazyReading()
+            return
+        
         self.solarZenithData = self.readData(self.solarZenithFilename, 
                                 self.solarZenithBand)
         self.solarAzimuthData = self.readData(self.solarAzimuthFilename, 
@@ -650,38 +787,84 @@ class AnglesFileInfo(AnglesInfo):
         self.viewAzimuthData = self.readData(self.viewAzimuthFilename, 
                                 self.viewAzimuthBand)
         
+    def prepareLazyReading(self):
+        """
+        Open each of the angle files once, and make a tile cache for each angle
+        """
+        angleBands = {'solarZenith': (self.solarZenithFilename, self.solarZenithBand),
+            'solarAzimuth': (self.solarAzimuthFilename, self.solarAzimuthBand),
+            'viewZenith': (self.viewZenithFilename, self.viewZenithBand),
+            'viewAzimuth': (self.viewAzimuthFilename, self.viewAzimuthBand)}
+        self.datasets = {}
+        self.angleTiles = {}
+        for angleName in angleBands:
+            (filename, bandNum) = angleBands[angleName]
+            if filename not in self.datasets:
+                self.datasets[filename] = gdal.Open(filename)
+            ds = self.datasets[filename]
+            tiles = tilecache.TileCache(ds, bandNum + 1, overview=self.overviewLevel)
+            # Factors to go from full resolution pixels to the overview
+            rowFactor = ds.RasterYSize / tiles.nrows
+            colFactor = ds.RasterXSize / tiles.ncols
+            self.angleTiles[angleName] = (tiles, rowFactor, colFactor)
+    
+    def readAngle(self, angleName, data, indices):
+        """
+        Return the values of the given angle for the given indices. The data is the 
+        whole angle image, if it has been read into memory. 
+        """
+        if not self.lazyReading:
+            return data[indices]
+        
+        (tiles, rowFactor, colFactor) = self.angleTiles[angleName]
+        (rows, cols) = indices
+        if self.overviewLevel is not None:
+            rows = (rows / rowFactor).astype(numpy.int64)
+            cols = (cols / colFactor).astype(numpy.int64)
+        (row0, col0) = (int(rows.min()), int(cols.min()))
+        nrows = int(rows.max()) - row0 + 1
+        ncols = int(cols.max()) - col0 + 1
+        window = tiles.readWindow(row0, col0, nrows, ncols)
+        return window[rows - row0, cols - col0]
+        
     def releaseMemory(self):
         """
         Called when fmask has finished querying this object.
         """
-        del self.solarZenithData
-        del self.solarAzimuthData
-        del self.viewZenithData
-        del self.viewAzimuthData
+        self.solarZenithData = None
+        self.solarAzimuthData = None
+        self.viewZenithData = None
+        self.viewAzimuthData = None
+        self.angleTiles = None
+        self.datasets = None
     
     def getSolarZenithAngle(self, indices):
         """
         Return the average solar zenith angle for the given indices
         """
-        return self.solarZenithData[indices].mean() * self.scaleToRadians
+        values = self.readAngle('solarZenith', self.solarZenithData, indices)
+        return values.mean() * self.scaleToRadians
 
     def getSolarAzimuthAngle(self, indices):
         """
         Return the average solar azimuth angle for the given indices
         """
-        return self.solarAzimuthData[indices].mean() * self.scaleToRadians
+        values = self.readAngle('solarAzimuth', self.solarAzimuthData, indices)
+        return values.mean() * self.scaleToRadians
     
     def getViewZenithAngle(self, indices):
         """
         Return the average view zenith angle for the given indices
         """
-        return self.viewZenithData[indices].mean() * self.scaleToRadians
+        values = self.readAngle('viewZenith', self.viewZenithData, indices)
+        return values.mean() * self.scaleToRadians
 
     def getViewAzimuthAngle(self, indices):
         """
         Return the average view azimuth angle for the given indices
         """
-        return self.viewAzimuthData[indices].mean() * self.scaleToRadians
+        values = self.readAngle('viewAzimuth', self.viewAzimuthData, indices)
+        return values.mean() * self.scaleToRadians
 
     def setScaleToRadians(self, scale):
         """
@@ -725,6 +908,238 @@ class AngleConstantInfo(AnglesInfo):
         """
         return self.viewAzimuthAngle
 
+class LandsatAnglesInfo(AnglesInfo):
+    """
+    An implementation of AnglesInfo for Landsat, which calculates the angles
+    directly, using the same estimates as fmask_usgsLandsatMakeAnglesImage.py
+    (see :mod:`fmask.landsatangles`), without making an angles image. 
+    
+    Only the nadir line, the satellite azimuths either side of it, and the sun
+    angles at the corners of the raster extent are stored. The angles are 
+    calculated for the centre of each requested pixel, and averaged. 
+    
+    """
+    def __init__(self, nadirLine, satAzimuth, extentSunAngles, extent, 
+            geotransform, R, satAltitude=landsatangles.LANDSAT_ALTITUDE):
+        """
+        The nadirLine, satAzimuth and extentSunAngles are as returned by
+        :func:`fmask.landsatangles.findNadirLine`, 
+        :func:`fmask.landsatangles.satAzLeftRight` and 
+        :func:`fmask.landsatangles.sunAnglesForExtent`. The extent is a tuple of
+        (xMin, xMax, yMin, yMax) for the raster, and geotransform is the GDAL 
+        geotransform of the image to whose pixels the indices refer. R is the 
+        local earth radius (see :func:`fmask.landsatangles.localRadius`), and
+        satAltitude is in metres. 
+        """
+        self.nadirLine = nadirLine
+        self.satAzimuth = satAzimuth
+        self.extentSunAngles = extentSunAngles
+        self.extent = extent
+        self.geotransform = geotransform
+        self.R = R
+        self.satAltitude = satAltitude
+        
+        # The calculated angles are in radians already
+        self.scaleToRadians = 1.0
+        
+        # Angles for the most recently requested indices
+        self.lastIndices = None
+        self.lastAngles = None
+    
+    @classmethod
+    def fromTemplateImage(cls, templateimg, mtlInfo):
+        """
+        Create from the given template image (e.g. the TOA reflectance image) and
+        the dictionary from :func:`readMTLFile`. The template image is searched
+        for the corners of the swath (see :func:`fmask.landsatangles.findImgCorners`). 
+        """
+        imgInfo = fileinfo.ImageInfo(templateimg)
+        corners = landsatangles.findImgCorners(templateimg, imgInfo)
+        nadirLine = landsatangles.findNadirLine(corners)
+        extentSunAngles = landsatangles.sunAnglesForExtent(imgInfo, mtlInfo)
+        satAzimuth = landsatangles.satAzLeftRight(nadirLine)
+        (ctrLat, ctrLong) = landsatangles.getCtrLatLong(imgInfo)
+        R = landsatangles.localRadius(ctrLat)
+        extent = (imgInfo.xMin, imgInfo.xMax, imgInfo.yMin, imgInfo.yMax)
+        return cls(nadirLine, satAzimuth, extentSunAngles, extent, imgInfo.transform, R)
+    
+    def getAngles(self, indices):
+        """
+        Return a tuple of (satAzimuth, satZenith, sunAzimuth, sunZenith) arrays
+        for the given indices. These are kept for the next call, as fmask asks 
+        for all four angles with the same indices. 
+        """
+        if indices is not self.lastIndices:
+            (rows, cols) = indices
+            gt = self.geotransform
+            x = gt[0] + (cols + 0.5) * gt[1] + (rows + 0.5) * gt[2]
+            y = gt[3] + (cols + 0.5) * gt[4] + (rows + 0.5) * gt[5]
+            (satAzimuth, satZenith) = landsatangles.satAnglesForPoints(x, y, 
+                self.nadirLine, self.satAzimuth, self.R, self.satAltitude)
+            (sunAzimuth, sunZenith) = landsatangles.sunAnglesInterp(self.extent, 
+                self.extentSunAngles, x, y)
+            self.lastIndices = indices
+            self.lastAngles = (satAzimuth, satZenith, sunAzimuth, sunZenith)
+        return self.lastAngles
+    
+    def releaseMemory(self):
+        """
+        Called when fmask has finished querying this object.
+        """
+        self.lastIndices = None
+        self.lastAngles = None
+    
+    def getSolarZenithAngle(self, indices):
+        """
+        Return the average solar zenith angle for the given indices
+        """
+        return self.getAngles(indices)[3].mean() * self.scaleToRadians
+
+    def getSolarAzimuthAngle(self, indices):
+        """
+        Return the average solar azimuth angle for the given indices
+        """
+        return self.getAngles(indices)[2].mean() * self.scaleToRadians
+    
+    def getViewZenithAngle(self, indices):
+        """
+        Return the average view zenith angle for the given indices
+        """
+        return self.getAngles(indices)[1].mean() * self.scaleToRadians
+
+    def getViewAzimuthAngle(self, indices):
+        """
+        Return the average view azimuth angle for the given indices
+        """
+        return self.getAngles(indices)[0].mean() * self.scaleToRadians
+
+    def setScaleToRadians(self, scale):
+        """
+        Set scaling factor to get radians from the calculated angles. Default 
+        is 1, as they are calculated in radians. 
+        """
+        self.scaleToRadians = scale
+
+class Sen2TileAnglesInfo(AnglesInfo):
+    """
+    An implementation of AnglesInfo for Sentinel-2, which works directly
+    from the coarse (5km) angle grids given in the tile metadata XML, 
+    without making a separate angles image. 
+    
+    The angles for each pixel are found by bilinear interpolation of the 
+    grids, at the pixel centre, and the average over the requested indices 
+    is returned. The view angles are the mean over all bands, as for 
+    fmask_sentinel2makeAnglesImage.py. 
+    
+    """
+    def __init__(self, tileMeta, toaGeotransform):
+        """
+        The tileMeta is a :class:`fmask.sen2meta.Sen2TileMeta` object, and 
+        toaGeotransform is the GDAL geotransform of the TOA reflectance image, 
+        to whose pixels the indices refer. 
+        """
+        bandNames = sorted(tileMeta.viewAzimuthDict.keys())
+        viewAzimuth = numpy.array([tileMeta.viewAzimuthDict[i] for i in bandNames]).mean(axis=0)
+        viewZenith = numpy.array([tileMeta.viewZenithDict[i] for i in bandNames]).mean(axis=0)
+        self.solarZenithGrid = self.fillNulls(tileMeta.sunZenithGrid)
+        self.solarAzimuthGrid = self.fillNulls(tileMeta.sunAzimuthGrid)
+        self.viewZenithGrid = self.fillNulls(viewZenith)
+        self.viewAzimuthGrid = self.fillNulls(viewAzimuth)
+        
+        # The grid values are given for points spaced by the grid resolution, 
+        # starting at the upper left corner of the tile
+        (self.gridULX, self.gridULY) = tileMeta.ulxyByRes["10"]
+        self.gridXres = tileMeta.angleGridXres
+        self.gridYres = tileMeta.angleGridYres
+        self.toaGeotransform = toaGeotransform
+        
+        # The angles in the XML are in degrees
+        self.scaleToRadians = numpy.radians(1.0)
+        
+        # Grid coordinates of the most recently requested indices. 
+        self.lastIndices = None
+        self.lastGridCoords = None
+    
+    @staticmethod
+    def fillNulls(grid):
+        """
+        Return a copy of the given grid, with any null (NaN) cells filled
+        with the value of the nearest non-null cell. 
+        """
+        nullMask = numpy.isnan(grid)
+        if nullMask.all():
+            msg = "Sentinel-2 angle grid has no valid values"
+            raise fmaskerrors.Sen2MetaError(msg)
+        filled = grid.astype(numpy.float64)
+        if nullMask.any():
+            (nearestRow, nearestCol) = distance_transform_edt(nullMask, 
+                return_distances=False, return_indices=True)
+            filled = filled[nearestRow, nearestCol]
+        return filled
+    
+    def getGridCoords(self, indices):
+        """
+        Return the (row, col) coordinates, as floats in the angle grids, of the 
+        centres of the pixels given by indices. These are kept for the next call, as
+        fmask asks for all four angles with the same indices. 
+        """
+        if indices is not self.lastIndices:
+            (rows, cols) = indices
+            gt = self.toaGeotransform
+            x = gt[0] + (cols + 0.5) * gt[1] + (rows + 0.5) * gt[2]
+            y = gt[3] + (cols + 0.5) * gt[4] + (rows + 0.5) * gt[5]
+            gridRow = (self.gridULY - y) / self.gridYres
+            gridCol = (x - self.gridULX) / self.gridXres
+            self.lastIndices = indices
+            self.lastGridCoords = numpy.array([gridRow, gridCol])
+        return self.lastGridCoords
+    
+    def interpolate(self, grid, indices):
+        """
+        Return the mean of the grid, interpolated at the given indices, in radians
+        """
+        values = map_coordinates(grid, self.getGridCoords(indices), order=1, 
+            mode='nearest')
+        return values.mean() * self.scaleToRadians
+    
+    def releaseMemory(self):
+        """
+        Called when fmask has finished querying this object.
+        """
+        self.lastIndices = None
+        self.lastGridCoords = None
+    
+    def getSolarZenithAngle(self, indices):
+        """
+        Return the average solar zenith angle for the given indices
+        """
+        return self.interpolate(self.solarZenithGrid, indices)
+
+    def getSolarAzimuthAngle(self, indices):
+        """
+        Return the average solar azimuth angle for the given indices
+        """
+        return self.interpolate(self.solarAzimuthGrid, indices)
+    
+    def getViewZenithAngle(self, indices):
+        """
+        Return the average view zenith angle for the given indices
+        """
+        return self.interpolate(self.viewZenithGrid, indices)
+
+    def getViewAzimuthAngle(self, indices):
+        """
+        Return the average view azimuth angle for the given indices
+        """
+        return self.interpolate(self.viewAzimuthGrid, indices)
+
+    def setScaleToRadians(self, scale):
+        """
+        Set scaling factor to get radians from the values in the grids. Default 
+        is for degrees, as given in the XML. 
+        """
+        self.scaleToRadians = scale
+
 def readMTLFile(mtl):
     """
     Very simple .mtl file reader that just creates a dictionary
@@ -49,12 +49,14 @@ import sys
 import os
 import subprocess
 import tempfile
+import time
+import json
 
 import numpy
 numpy.seterr(all='raise')
 from osgeo import gdal
 gdal.UseExceptions()
-from scipy.ndimage import uniform_filter, maximum_filter, label
+from scipy.ndimage import label, distance_transform_edt
 import scipy.stats
 
 # We use RIOS intensively here
@@ -73,6 +75,13 @@ from . import config
 from . import fmaskerrors
 # so we can check if thermal all zeroes
 from . import zerocheck
+# for reading windows of the intermediate files
+from . import tilecache
+# bit-packed masks, for fast neighbourhood operations
+from . import bitmask
+# for calculating TOA reflectance from radiance, if required
+from . import landsatTOA
+from . import landsatangles
 
 # Bands in the saturation mask, if supplied
 SATURATION_BLUE = 0
@@ -92,6 +101,8 @@ OUTCODE_SHADOW = 3
 OUTCODE_SNOW = 4
 #: Output pixel value for water
 OUTCODE_WATER = 5
+#: Number of output codes
+NUM_OUTCODES = 6
     
 def doFmask(fmaskFilenames, fmaskConfig):
     """
@@ -101,8 +112,12 @@ def doFmask(fmaskFilenames, fmaskConfig):
     * **fmaskFilenames** an instance of :class:`fmask.config.FmaskFilenames` that contains the files to use
     * **fmaskConfig** an instance of :class:`fmask.config.FmaskConfig` that contains the parameters to use
     
-    If :func:`fmask.config.FmaskConfig.setKeepIntermediates` has been called with True, then
-    a dictionary of intermediate files will be returned. Otherwise None is returned.
+    Returns a dictionary. The 'classStats' entry is a :class:`FmaskClassStats` of the 
+    pixel counts for each class in the output mask. If 
+    :func:`fmask.config.FmaskConfig.setKeepIntermediates` has been called with True, then
+    it also contains the intermediate files. The 'potentialShadows' and 
+    'interimShadow' files are None if the scene has no cloud, or nothing 
+    but cloud, as the cloud shadow stages are then skipped. 
     
     """
     
@@ -121,7 +136,7 @@ def doFmask(fmaskFilenames, fmaskConfig):
             missingThermal = True
 
     # do some basic checking of inputs
-    if fmaskFilenames.toaRef is None:
+    if fmaskFilenames.getReferenceFile() is None:
         msg = 'Must provide input TOA reflectance file via fmaskFilenames parameter'
         raise fmaskerrors.FmaskParameterError(msg)
         
@@ -138,56 +153,86 @@ def doFmask(fmaskFilenames, fmaskConfig):
         fmaskConfig.setCloudBufferSize(0)
         fmaskConfig.setShadowBufferSize(3)
     
+    # Everything needed to calculate TOA reflectance from radiance, if required,
+    # made once for all passes
+    virtualTOA = makeVirtualTOA(fmaskFilenames, fmaskConfig.anglesInfo)
+    
     if fmaskConfig.verbose: print("Cloud layer, pass 1")
-    (pass1file, Twater, Tlow, Thigh, NIR_17) = doPotentialCloudFirstPass(
-        fmaskFilenames, fmaskConfig, missingThermal)
+    (pass1file, Twater, Tlow, Thigh, NIR_17, blockMap) = doPotentialCloudFirstPass(
+        fmaskFilenames, fmaskConfig, missingThermal, virtualTOA)
     if fmaskConfig.verbose: print("  Twater=", Twater, "Tlow=", Tlow, "Thigh=", Thigh, "NIR_17=", 
         NIR_17)
     
     if fmaskConfig.verbose: print("Cloud layer, pass 2")
     (pass2file, landThreshold) = doPotentialCloudSecondPass(fmaskFilenames, 
-        fmaskConfig, pass1file, Twater, Tlow, Thigh, missingThermal)
+        fmaskConfig, pass1file, Twater, Tlow, Thigh, missingThermal, blockMap, 
+        virtualTOA)
     if fmaskConfig.verbose: print("  landThreshold=", landThreshold)
 
     if fmaskConfig.verbose: print("Cloud layer, pass 3")
-    interimCloudmask = doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, 
-        pass1file, pass2file, landThreshold, Tlow, missingThermal)
+    (interimCloudmask, numCloudPix, numValidPix) = doCloudLayerFinalPass(
+        fmaskFilenames, fmaskConfig, pass1file, pass2file, landThreshold, Tlow, 
+        missingThermal, blockMap)
+    if fmaskConfig.verbose: print("  numCloudPix=", numCloudPix, "numValidPix=", 
+        numValidPix)
+    
+    # With no cloud there can be no cloud shadow, and with nothing but cloud 
+    # there is nowhere for a shadow to be matched, so in either case all the 
+    # shadow stages are skipped, and there is no shadow layer. 
+    potentialShadowsFile = None
+    interimShadowmask = None
+    if numCloudPix == 0 or numCloudPix == numValidPix:
+        if fmaskConfig.verbose: print("Skipping cloud shadows")
+        if fmaskFilenames.shadowMatchStats is not None:
+            ShadowMatchStats().writeTable(fmaskFilenames.shadowMatchStats)
+    else:
+        # The whole-image stages only work on the bounding box of the non-null 
+        # pixels, as everything outside it is null. The potential shadows 
+        # depend only on the NIR band, so use the footprint of its own nulls, 
+        # which may differ from that of all the bands together. 
+        footprint = blockMap.footprint()
+        nirFootprint = blockMap.footprint(blockMap.nirNullCells)
+        if fmaskConfig.verbose: print("  Footprint (row0, col0, nrows, ncols)=", footprint,
+            "NIR footprint=", nirFootprint)
         
-    if fmaskConfig.verbose: print("Potential shadows")
-    potentialShadowsFile = doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17)
-    
-    if fmaskConfig.verbose: print("Clumping clouds")
-    (clumps, numClumps) = clumpClouds(interimCloudmask)
-    
-    if fmaskConfig.verbose: print("Making 3d clouds")
-    (cloudShape, cloudBaseTemp, cloudClumpNdx) = make3Dclouds(fmaskFilenames, 
-        fmaskConfig, clumps, numClumps, missingThermal)
-    
-    if fmaskConfig.verbose: print("Making cloud shadow shapes")
-    shadowShapesDict = makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
-        cloudShape, cloudClumpNdx)
-    
-    if fmaskConfig.verbose: print("Matching shadows")
-    interimShadowmask = matchShadows(fmaskConfig, interimCloudmask, 
-        potentialShadowsFile, shadowShapesDict, cloudBaseTemp, Tlow, Thigh, 
-        pass1file)
+        if fmaskConfig.verbose: print("Clumping clouds")
+        (clumps, numClumps) = clumpClouds(interimCloudmask, footprint)
+        
+        if fmaskConfig.verbose: print("Potential shadows")
+        potentialShadowsFile = doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17,
+            nirFootprint, virtualTOA)
+        
+        if fmaskConfig.verbose: print("Making 3d clouds")
+        (cloudShape, cloudBaseTemp, cloudClumpNdx) = make3Dclouds(fmaskFilenames, 
+            fmaskConfig, clumps, numClumps, missingThermal, footprint)
+        del clumps
+        
+        if fmaskConfig.verbose: print("Making cloud shadow shapes")
+        shadowShapesDict = makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
+            cloudShape, cloudClumpNdx, footprint)
+        
+        if fmaskConfig.verbose: print("Matching shadows")
+        interimShadowmask = matchShadows(fmaskConfig, interimCloudmask, 
+            potentialShadowsFile, shadowShapesDict, cloudBaseTemp, Tlow, Thigh, 
+            pass1file, fmaskFilenames.shadowMatchStats)
     
     if fmaskConfig.verbose: print("Doing final tidy up")
-    finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
-        pass1file)
+    classStats = finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, 
+        interimShadowmask, pass1file, blockMap)
     
     # Remove temporary files
-    retVal = None
+    retVal = {'classStats' : classStats}
     if not fmaskConfig.keepIntermediates:
         for filename in [pass1file, pass2file, interimCloudmask, potentialShadowsFile,
                 interimShadowmask]:
-            os.remove(filename)
+            if filename is not None:
+                os.remove(filename)
     else:
-        # create a dictionary with the intermediate filenames so we can return them.
-        retVal = {'pass1' : pass1file, 'pass2' : pass2file, 
+        # add the intermediate filenames so we can return them.
+        retVal.update({'pass1' : pass1file, 'pass2' : pass2file, 
             'interimCloud' : interimCloudmask, 
             'potentialShadows' : potentialShadowsFile, 
-            'interimShadow' : interimShadowmask}
+            'interimShadow' : interimShadowmask})
 
     if fmaskConfig.verbose: print('finished fmask')
     
@@ -205,11 +250,287 @@ B4_SCALE = 500.0
 #: Global RIOS window size
 RIOS_WINDOW_SIZE = 512
 
-def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
+def makeVirtualTOA(fmaskFilenames, anglesInfo=None):
+    """
+    If only a radiance file has been given (see 
+    :func:`fmask.config.FmaskFilenames.setRadianceFile`), return an OtherInputs
+    object with everything needed to calculate the TOA reflectance from it, 
+    otherwise return None. 
+    
+    This reads the MTL file and, if there is no angles file, the edges of the
+    radiance image, so it is done once by :func:`doFmask` and the result given 
+    to each pass. If anglesInfo is a :class:`fmask.config.LandsatAnglesInfo` for
+    the same extent as the radiance image (e.g. the one in the FmaskConfig), its
+    nadir line and angles are used instead of searching the image again. 
+    
+    """
+    if fmaskFilenames.toaRef is not None:
+        return None
+    
+    virtualTOA = applier.OtherInputs()
+    mtlInfo = config.readMTLFile(fmaskFilenames.radianceMTL)
+    imgInfo = fileinfo.ImageInfo(fmaskFilenames.radiance)
+    landsatTOA.setTOAOtherinputs(virtualTOA, mtlInfo, imgInfo, 
+        fmaskFilenames.radianceBandNumbers)
+    if fmaskFilenames.radianceAngles is None:
+        extent = (imgInfo.xMin, imgInfo.xMax, imgInfo.yMin, imgInfo.yMax)
+        if (isinstance(anglesInfo, config.LandsatAnglesInfo) and 
+                numpy.allclose(anglesInfo.extent, extent)):
+            nadirLine = anglesInfo.nadirLine
+            extentSunAngles = anglesInfo.extentSunAngles
+            satAzimuth = anglesInfo.satAzimuth
+        else:
+            corners = landsatangles.findImgCorners(fmaskFilenames.radiance, imgInfo)
+            nadirLine = landsatangles.findNadirLine(corners)
+            extentSunAngles = landsatangles.sunAnglesForExtent(imgInfo, mtlInfo)
+            satAzimuth = landsatangles.satAzLeftRight(nadirLine)
+        landsatangles.setAnglesOtherargs(virtualTOA, imgInfo, nadirLine, 
+            extentSunAngles, satAzimuth)
+    return virtualTOA
+
+
+def setTOAInput(fmaskFilenames, infiles, otherargs, virtualTOA=None):
+    """
+    Set up the reflective input for a RIOS pass. This is either the TOA reflectance
+    file, or, if only a radiance file has been given (see 
+    :func:`fmask.config.FmaskFilenames.setRadianceFile`), the radiance file 
+    (and angles file), in which case otherargs.virtualTOA is set with everything 
+    needed to calculate the TOA reflectance. Use :func:`readTOARef` to get the
+    TOA reflectance for each block. 
+    
+    The virtualTOA should be as returned by :func:`makeVirtualTOA`. If it is 
+    None, it is made here when required. 
+    
+    """
+    otherargs.virtualTOA = None
+    if fmaskFilenames.toaRef is not None:
+        infiles.toaref = fmaskFilenames.toaRef
+    else:
+        infiles.radiance = fmaskFilenames.radiance
+        if fmaskFilenames.radianceAngles is not None:
+            infiles.radianceAngles = fmaskFilenames.radianceAngles
+        if virtualTOA is None:
+            virtualTOA = makeVirtualTOA(fmaskFilenames)
+        otherargs.virtualTOA = virtualTOA
+
+
+def readTOARef(info, inputs, otherargs, bandList=None):
+    """
+    Return the TOA reflectance for the current block, as set up by 
+    :func:`setTOAInput`. This is either read from the TOA reflectance file, or 
+    calculated from the radiance. If bandList is given, only those bands are 
+    calculated. 
+    
+    """
+    if otherargs.virtualTOA is None:
+        return inputs.toaref
+    
+    virtualTOA = otherargs.virtualTOA
+    if hasattr(inputs, 'radianceAngles'):
+        sunZenDN = inputs.radianceAngles[3]
+    else:
+        (nrows, ncols) = inputs.radiance.shape[-2:]
+        sunZenDN = landsatangles.makeAnglesForBlock(info, nrows, ncols, virtualTOA)[3]
+    return landsatTOA.toaForBlock(inputs.radiance, sunZenDN, virtualTOA, bandList)
+
+
+def readVirtualTOABand(fmaskFilenames, bandNdx, window=None, virtualTOA=None):
+    """
+    Calculate the whole of a single band (0-based) of TOA reflectance from the 
+    radiance file (see :func:`setTOAInput`), and return it as an int16 array, 
+    along with its null value. Gives the same result as reading that band from 
+    the TOA reflectance file. 
+    
+    If window is given, as (row0, col0, nrows, ncols), only that part of the
+    band is calculated and returned. The virtualTOA is as for :func:`setTOAInput`. 
+    
+    """
+    infiles = applier.FilenameAssociations()
+    outfiles = applier.FilenameAssociations()
+    otherargs = applier.OtherInputs()
+    controls = applier.ApplierControls()
+    
+    setTOAInput(fmaskFilenames, infiles, otherargs, virtualTOA)
+    otherargs.bandNdx = bandNdx
+    if window is None:
+        imgInfo = fileinfo.ImageInfo(fmaskFilenames.radiance)
+        window = (0, 0, imgInfo.nrows, imgInfo.ncols)
+    otherargs.window = window
+    otherargs.toaBand = numpy.zeros(window[2:], dtype=numpy.int16)
+    controls.setWindowXsize(RIOS_WINDOW_SIZE)
+    controls.setWindowYsize(RIOS_WINDOW_SIZE)
+    controls.setReferenceImage(fmaskFilenames.radiance)
+    
+    applier.apply(virtualTOABand, infiles, outfiles, otherargs, controls=controls)
+    
+    return (otherargs.toaBand, otherargs.virtualTOA.outNull)
+
+
+def virtualTOABand(info, inputs, outputs, otherargs):
+    """
+    Called from RIOS
+    
+    Calculate one band of TOA reflectance, and put the part of it which is
+    inside otherargs.window into the window array. 
+    
+    """
+    (winRow0, winCol0, winNrows, winNcols) = otherargs.window
+    (col0, row0) = info.getPixColRow(0, 0)
+    (ncols, nrows) = info.getBlockSize()
+    (r0, r1) = (max(row0, winRow0), min(row0 + nrows, winRow0 + winNrows))
+    (c0, c1) = (max(col0, winCol0), min(col0 + ncols, winCol0 + winNcols))
+    if r1 > r0 and c1 > c0:
+        toa = readTOARef(info, inputs, otherargs, [otherargs.bandNdx])[0]
+        otherargs.toaBand[r0-winRow0:r1-winRow0, c0-winCol0:c1-winCol0] = (
+            toa[r0-row0:r1-row0, c0-col0:c1-col0])
+
+
+#: Size (in pixels) of the cells of the :class:`BlockMap`
+BLOCKMAP_CELLSIZE = 64
+
+class BlockMap(object):
+    """
+    A coarse summary of the pass 1 layers, on a grid of cells of cellSize
+    pixels over the whole image, filled in by :func:`potentialCloudFirstPass`.
+    For each cell, it records whether every pixel is null (nullCells), 
+    whether every pixel is null in the NIR band alone (nirNullCells), and
+    whether any pixel is snow (snowCells) or water (waterCells). 
+    
+    The later passes use this to skip the calculations for blocks which are 
+    entirely null, or to write their output directly when it can only be 
+    a constant. The cells are independent of the RIOS block size and overlap,
+    so any window can be queried. Since the cells are small compared with
+    the blocks, the summary is only a few kilobytes even for a large image. 
+    
+    Note that there is no "cloud-free" summary, because the final cloud layer
+    includes pixels which are not in the potential cloud layer (see 
+    :func:`cloudFinalPass`), so it cannot be skipped on that basis. 
+    
+    """
+    def __init__(self, nrows, ncols, cellSize=BLOCKMAP_CELLSIZE):
+        self.shape = (nrows, ncols)
+        self.cellSize = cellSize
+        cellShape = (int(numpy.ceil(nrows / cellSize)), int(numpy.ceil(ncols / cellSize)))
+        self.nullCells = numpy.ones(cellShape, dtype=numpy.bool)
+        self.nirNullCells = numpy.ones(cellShape, dtype=numpy.bool)
+        self.snowCells = numpy.zeros(cellShape, dtype=numpy.bool)
+        self.waterCells = numpy.zeros(cellShape, dtype=numpy.bool)
+    
+    def cellStarts(self, start, size):
+        """
+        Return the offsets, within a block starting at pixel start and of the
+        given size, of the start of each cell which the block touches. 
+        
+        """
+        firstWhole = (-start) % self.cellSize
+        return numpy.unique(numpy.concatenate([[0], 
+            numpy.arange(firstWhole, size, self.cellSize)]))
+    
+    def addBlock(self, row0, col0, nullmask, nirNullmask, snowmask, watermask):
+        """
+        Add a block of the pass 1 layers, whose top-left pixel is at (row0, col0)
+        in the whole image, and which has no overlap. 
+        
+        """
+        # Anything beyond the image is just padding
+        (nrows, ncols) = (min(nullmask.shape[0], self.shape[0] - row0), 
+            min(nullmask.shape[1], self.shape[1] - col0))
+        rowStarts = self.cellStarts(row0, nrows)
+        colStarts = self.cellStarts(col0, ncols)
+        cellRow0 = row0 // self.cellSize
+        cellCol0 = col0 // self.cellSize
+        cellSlice = (slice(cellRow0, cellRow0 + len(rowStarts)), 
+            slice(cellCol0, cellCol0 + len(colStarts)))
+        
+        def reduceCells(ufunc, mask):
+            mask = mask[:nrows, :ncols].astype(numpy.bool)
+            return ufunc.reduceat(ufunc.reduceat(mask, rowStarts, axis=0), 
+                colStarts, axis=1)
+        
+        # Cells may be split between blocks, so combine with what is already there
+        self.nullCells[cellSlice] &= reduceCells(numpy.logical_and, nullmask)
+        self.nirNullCells[cellSlice] &= reduceCells(numpy.logical_and, nirNullmask)
+        self.snowCells[cellSlice] |= reduceCells(numpy.logical_or, snowmask)
+        self.waterCells[cellSlice] |= reduceCells(numpy.logical_or, watermask)
+    
+    def windowCells(self, cells, row0, col0, nrows, ncols):
+        """
+        Return the part of the given cells array which covers the window
+        of the image with its top-left pixel at (row0, col0), and of
+        shape (nrows, ncols). Any part of the window outside the image is
+        ignored. 
+        
+        """
+        row1 = min(row0 + nrows, self.shape[0])
+        col1 = min(col0 + ncols, self.shape[1])
+        if row1 <= row0 or col1 <= col0:
+            return cells[:0, :0]
+        return cells[row0 // self.cellSize:(row1 - 1) // self.cellSize + 1, 
+            col0 // self.cellSize:(col1 - 1) // self.cellSize + 1]
+    
+    def isAllNull(self, row0, col0, nrows, ncols):
+        """
+        Return True if every pixel of the given window is null
+        """
+        return self.windowCells(self.nullCells, row0, col0, nrows, ncols).all()
+    
+    def anySnow(self, row0, col0, nrows, ncols):
+        """
+        Return True if any pixel of the given window may be snow
+        """
+        return self.windowCells(self.snowCells, row0, col0, nrows, ncols).any()
+    
+    def anyWater(self, row0, col0, nrows, ncols):
+        """
+        Return True if any pixel of the given window may be water
+        """
+        return self.windowCells(self.waterCells, row0, col0, nrows, ncols).any()
+    
+    def footprint(self, nullCells=None, margin=1):
+        """
+        Return the bounding box of all non-null pixels, as a window
+        (row0, col0, nrows, ncols), with the given margin (in pixels) of null
+        pixels around it, as far as the edges of the image. This is to the 
+        nearest cell, so may be a little larger than necessary. If every pixel 
+        is null, the whole image is returned. 
+        
+        The nullCells array says which cells are null, and defaults to 
+        self.nullCells. Use self.nirNullCells for the footprint of the NIR band. 
+        
+        """
+        if nullCells is None:
+            nullCells = self.nullCells
+        (nrows, ncols) = self.shape
+        validRows = numpy.where(~nullCells.all(axis=1))[0]
+        validCols = numpy.where(~nullCells.all(axis=0))[0]
+        if len(validRows) == 0:
+            return (0, 0, nrows, ncols)
+        
+        cs = self.cellSize
+        row0 = max(validRows[0] * cs - margin, 0)
+        row1 = min((validRows[-1] + 1) * cs + margin, nrows)
+        col0 = max(validCols[0] * cs - margin, 0)
+        col1 = min((validCols[-1] + 1) * cs + margin, ncols)
+        return (int(row0), int(col0), int(row1 - row0), int(col1 - col0))
+
+
+def blockProperWindow(info, shape, overlap):
+    """
+    Return the window (row0, col0, nrows, ncols), in the whole image, of the 
+    current RIOS block of the given shape, without its overlap. 
+    
+    """
+    (col0, row0) = info.getPixColRow(overlap, overlap)
+    return (row0, col0, shape[0] - 2 * overlap, shape[1] - 2 * overlap)
+
+
+def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal, 
+        virtualTOA=None):
     """
     Run the first pass of the potential cloud layer. Also
     finds the temperature thresholds which will be needed 
     in the second pass, because it has the relevant data handy. 
+    The virtualTOA is as for :func:`setTOAInput`. 
     
     """
     infiles = applier.FilenameAssociations()
@@ -217,7 +538,7 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
     otherargs = applier.OtherInputs()
     controls = applier.ApplierControls()
     
-    infiles.toaref = fmaskFilenames.toaRef
+    setTOAInput(fmaskFilenames, infiles, otherargs, virtualTOA)
     if not missingThermal:
         infiles.thermal = fmaskFilenames.thermal
     if fmaskFilenames.saturationMask is not None:
@@ -230,7 +551,7 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
     os.close(fd)
     controls.setWindowXsize(RIOS_WINDOW_SIZE)
     controls.setWindowYsize(RIOS_WINDOW_SIZE)
-    controls.setReferenceImage(infiles.toaref)
+    controls.setReferenceImage(fmaskFilenames.getReferenceFile())
     controls.setCalcStats(False)
 
     otherargs.refBands = fmaskConfig.bands  
@@ -239,11 +560,21 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
     otherargs.clearLandBT_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
     otherargs.clearLandB4_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
     otherargs.fmaskConfig = fmaskConfig
-    refImgInfo = fileinfo.ImageInfo(fmaskFilenames.toaRef)
-    otherargs.refNull = refImgInfo.nodataval[0]
+    if otherargs.virtualTOA is not None:
+        otherargs.refNull = otherargs.virtualTOA.outNull
+    else:
+        refImgInfo = fileinfo.ImageInfo(fmaskFilenames.toaRef)
+        otherargs.refNull = refImgInfo.nodataval[0]
     if otherargs.refNull is None:
         # The null value used by USGS is 0, but is not recorded in the TIF files
         otherargs.refNull = 0
+    # The NIR null value, exactly as used by doPotentialShadows()
+    if otherargs.virtualTOA is not None:
+        otherargs.nirNull = otherargs.virtualTOA.outNull
+    else:
+        otherargs.nirNull = refImgInfo.nodataval[fmaskConfig.bands[config.BAND_NIR]]
+    if otherargs.nirNull is None:
+        otherargs.nirNull = 0
     if not missingThermal:
         thermalImgInfo = fileinfo.ImageInfo(fmaskFilenames.thermal)
         otherargs.thermalNull = thermalImgInfo.nodataval[0]
@@ -265,6 +596,9 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
         # and the cirrus band. 
         nullBandNdx = [config.BAND_BLUE, config.BAND_GREEN, config.BAND_RED]
     otherargs.bandsForRefNull = numpy.array([fmaskConfig.bands[i] for i in nullBandNdx])
+    
+    refInfo = fileinfo.ImageInfo(fmaskFilenames.getReferenceFile())
+    otherargs.blockMap = BlockMap(refInfo.nrows, refInfo.ncols)
 
     applier.apply(potentialCloudFirstPass, infiles, outfiles, otherargs, controls=controls)
     
@@ -278,7 +612,7 @@ def doPotentialCloudFirstPass(fmaskFilenames, fmaskConfig, missingThermal):
         # Not enough land to work this out, so guess a low value. 
         b4_17 = 0.01
     
-    return (outfiles.pass1, Twater, Tlow, Thigh, b4_17)
+    return (outfiles.pass1, Twater, Tlow, Thigh, b4_17, otherargs.blockMap)
 
 
 def potentialCloudFirstPass(info, inputs, outputs, otherargs):
@@ -290,7 +624,8 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     """
     fmaskConfig = otherargs.fmaskConfig
 
-    ref = inputs.toaref.astype(numpy.float) / fmaskConfig.TOARefScaling
+    toaref = readTOARef(info, inputs, otherargs)
+    ref = toaref.astype(numpy.float) / fmaskConfig.TOARefScaling
     # Clamp off any reflectance <= 0
     ref[ref<=0] = 0.00001
 
@@ -305,7 +640,7 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
         THERM = otherargs.thermalInfo.thermalBand1040um
     
     # Special mask needed only for resets in final pass
-    refNullmask = (inputs.toaref[otherargs.bandsForRefNull] == otherargs.refNull).any(axis=0)
+    refNullmask = (toaref[otherargs.bandsForRefNull] == otherargs.refNull).any(axis=0)
     if hasattr(inputs, 'thermal'):
         thermNullmask = (inputs.thermal[THERM] == otherargs.thermalNull)
         nullmask = (refNullmask | thermNullmask)
@@ -407,6 +742,12 @@ def potentialCloudFirstPass(info, inputs, outputs, otherargs):
     outputs.pass1 = numpy.array([pcp, waterTest, clearLand, variabilityProbPcnt, 
         nullmask, snowmask, refNullmask, thermNullmask])
     
+    # The NIR nulls on their own, as the potential shadow layer sees them
+    nirNullmask = (toaref[nir].astype(numpy.int16) == otherargs.nirNull)
+    (col0, row0) = info.getPixColRow(0, 0)
+    otherargs.blockMap.addBlock(row0, col0, nullmask, nirNullmask, snowmask, 
+        waterTest)
+    
     # Accumulate histograms of temperature for land and water separately
     if hasattr(inputs, 'thermal'):
         scaledBT = (bt + BT_OFFSET).clip(0, BT_HISTSIZE)
@@ -467,9 +808,10 @@ def calcBTthresholds(otherargs):
 PROB_SCALE = 100.0
 
 def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file, 
-                Twater, Tlow, Thigh, missingThermal):
+                Twater, Tlow, Thigh, missingThermal, blockMap=None, virtualTOA=None):
     """
-    Second pass for potential cloud layer
+    Second pass for potential cloud layer. The virtualTOA is as for 
+    :func:`setTOAInput`. 
     """
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
@@ -477,7 +819,7 @@ def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file,
     controls = applier.ApplierControls()
     
     infiles.pass1 = pass1file
-    infiles.toaref = fmaskFilenames.toaRef
+    setTOAInput(fmaskFilenames, infiles, otherargs, virtualTOA)
     if not missingThermal:
         infiles.thermal = fmaskFilenames.thermal
     (fd, outfiles.pass2) = tempfile.mkstemp(prefix='pass2', dir=fmaskConfig.tempDir, 
@@ -491,10 +833,11 @@ def doPotentialCloudSecondPass(fmaskFilenames, fmaskConfig, pass1file,
     otherargs.Thigh = Thigh
     otherargs.lCloudProb_hist = numpy.zeros(BT_HISTSIZE, dtype=numpy.uint32)
     otherargs.fmaskConfig = fmaskConfig
+    otherargs.blockMap = blockMap
     
     controls.setWindowXsize(RIOS_WINDOW_SIZE)
     controls.setWindowYsize(RIOS_WINDOW_SIZE)
-    controls.setReferenceImage(fmaskFilenames.toaRef)
+    controls.setReferenceImage(fmaskFilenames.getReferenceFile())
     controls.setCalcStats(False)
     
     applier.apply(potentialCloudSecondPass, infiles, outfiles, otherargs, controls=controls)
@@ -513,10 +856,20 @@ def potentialCloudSecondPass(info, inputs, outputs, otherargs):
     Called from RIOS
     
     Second pass of potential cloud layer
+    
+    The probabilities are only used where the pixels are not null, so for a
+    block which is all null, zeros are written without any calculation. 
     """
+    if otherargs.blockMap is not None:
+        shape = inputs.pass1.shape[-2:]
+        if otherargs.blockMap.isAllNull(*blockProperWindow(info, shape, 0)):
+            outputs.pass2 = numpy.zeros((2, ) + shape, dtype=numpy.uint8)
+            return
+    
     fmaskConfig = otherargs.fmaskConfig
     
-    ref = inputs.toaref.astype(numpy.float) / fmaskConfig.TOARefScaling
+    toaref = readTOARef(info, inputs, otherargs)
+    ref = toaref.astype(numpy.float) / fmaskConfig.TOARefScaling
     # Clamp off any reflectance <= 0
     ref[ref<=0] = 0.00001
     
@@ -576,9 +929,14 @@ def potentialCloudSecondPass(info, inputs, outputs, otherargs):
 
 
 def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file, 
-                    landThreshold, Tlow, missingThermal):
+                    landThreshold, Tlow, missingThermal, blockMap=None):
     """
     Final pass
+    
+    Returns a tuple of 
+        (interimCloudmask, numCloudPix, numValidPix)
+    where numCloudPix is the number of cloud pixels in the interim cloud
+    mask, and numValidPix is the number of non-null pixels. 
     """
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
@@ -593,6 +951,7 @@ def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file,
     otherargs.Tlow = Tlow
     otherargs.thermalInfo = fmaskConfig.thermalInfo
     otherargs.minCloudSize = fmaskConfig.minCloudSize_pixels
+    otherargs.blockMap = blockMap
 
     (fd, outfiles.cloudmask) = tempfile.mkstemp(prefix='interimcloud', 
         dir=fmaskConfig.tempDir, suffix=fmaskConfig.defaultExtension)
@@ -601,6 +960,9 @@ def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file,
     overlap = 1
     # Also need overlap for cloud size filter
     overlap = max(overlap, fmaskConfig.minCloudSize_pixels)
+    otherargs.overlap = overlap
+    otherargs.numCloudPix = 0
+    otherargs.numValidPix = 0
         
     controls.setOverlap(overlap)
     controls.setWindowXsize(RIOS_WINDOW_SIZE)
@@ -610,7 +972,7 @@ def doCloudLayerFinalPass(fmaskFilenames, fmaskConfig, pass1file, pass2file,
     
     applier.apply(cloudFinalPass, infiles, outfiles, otherargs, controls=controls)
     
-    return outfiles.cloudmask
+    return (outfiles.cloudmask, otherargs.numCloudPix, otherargs.numValidPix)
 
 
 def cloudFinalPass(info, inputs, outputs, otherargs):
@@ -618,7 +980,16 @@ def cloudFinalPass(info, inputs, outputs, otherargs):
     Called from RIOS
     
     Final pass of cloud mask layer
+    
+    The output is always zero where the pixels are null, so for a block which
+    is all null (not counting the overlap), zeros are written without any
+    calculation. 
     """
+    if otherargs.blockMap is not None and otherargs.blockMap.isAllNull(
+            *blockProperWindow(info, inputs.pass1.shape[-2:], otherargs.overlap)):
+        outputs.cloudmask = numpy.zeros((1, ) + inputs.pass1.shape[-2:], dtype=numpy.uint8)
+        return
+    
     nullmask = inputs.pass1[4].astype(numpy.bool)
     pcp = inputs.pass1[0]
     waterTest = inputs.pass1[1]
@@ -656,17 +1027,34 @@ def cloudFinalPass(info, inputs, outputs, otherargs):
 
     # Apply the prescribed 3x3 buffer. According to Zhu&Woodcock (page 87, end of section 3.1.2) 
     # they set a pixel to cloud if 5 or more of its 3x3 neighbours is cloud. 
-    # This little incantation will do exactly the same. 
-    bufferedCloudmask = (uniform_filter(cloudmask*2.0, size=3) >= 1.0)
+    # This is done on the bit-packed mask, without any float arrays. 
+    bufferedCloudmask = bitmask.BitMask.fromBool(cloudmask).majority3x3().toBool()
 
     bufferedCloudmask[nullmask] = 0
     
     outputs.cloudmask = numpy.array([bufferedCloudmask])
+    
+    # Count the cloud and non-null pixels, excluding the overlap
+    overlap = otherargs.overlap
+    (nrows, ncols) = blockProperWindow(info, nullmask.shape, overlap)[2:]
+    blockProper = (slice(overlap, overlap + nrows), slice(overlap, overlap + ncols))
+    otherargs.numCloudPix += int(numpy.count_nonzero(bufferedCloudmask[blockProper]))
+    otherargs.numValidPix += int(nullmask[blockProper].size - 
+        numpy.count_nonzero(nullmask[blockProper]))
 
 
-def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
+def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17, window=None, 
+        virtualTOA=None):
     """
     Make potential shadow layer, as per section 3.1.3 of Zhu&Woodcock. 
+    
+    If window is given, as (row0, col0, nrows, ncols), only that part of the
+    image is used, and the rest of the output file is zero. This should be
+    the footprint of the non-null pixels of the NIR band itself (see 
+    :meth:`BlockMap.footprint`), with a margin of NIR null pixels. The filling
+    of minima starts from the valid pixels next to the nulls, so it is then 
+    the same as for the whole image. The virtualTOA is as for :func:`setTOAInput`. 
+    
     """
     (fd, potentialShadowsFile) = tempfile.mkstemp(prefix='shadows', dir=fmaskConfig.tempDir, 
                                         suffix=fmaskConfig.defaultExtension)
@@ -675,14 +1063,21 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     # convert from numpy (0 based) to GDAL (1 based) indexing
     NIR_lyr = fmaskConfig.bands[config.BAND_NIR] + 1
     
-    # Read in whole of band 4
-    ds = gdal.Open(fmaskFilenames.toaRef)
-    band = ds.GetRasterBand(NIR_lyr)
-    nullval = band.GetNoDataValue()
-    if nullval is None:
-        nullval = 0
-    # Sentinel2 is uint16 which causes problems...
-    scaledNIR = band.ReadAsArray().astype(numpy.int16)
+    # Read in whole of band 4, within the window
+    ds = gdal.Open(fmaskFilenames.getReferenceFile())
+    if window is None:
+        window = (0, 0, ds.RasterYSize, ds.RasterXSize)
+    (row0, col0, nrows, ncols) = window
+    if fmaskFilenames.toaRef is not None:
+        band = ds.GetRasterBand(NIR_lyr)
+        nullval = band.GetNoDataValue()
+        if nullval is None:
+            nullval = 0
+        # Sentinel2 is uint16 which causes problems...
+        scaledNIR = band.ReadAsArray(col0, row0, ncols, nrows).astype(numpy.int16)
+    else:
+        (scaledNIR, nullval) = readVirtualTOABand(fmaskFilenames, NIR_lyr - 1, 
+            window, virtualTOA)
     NIR_17_dn = NIR_17 * fmaskConfig.TOARefScaling
     
     scaledNIR_filled = fillminima.fillMinima(scaledNIR, nullval, NIR_17_dn)
@@ -703,21 +1098,28 @@ def doPotentialShadows(fmaskFilenames, fmaskConfig, NIR_17):
     transform = ds.GetGeoTransform()
     outds.SetGeoTransform(transform)
     outband = outds.GetRasterBand(1)
-    outband.WriteArray(potentialShadows)
+    outband.WriteArray(potentialShadows.astype(numpy.uint8), col0, row0)
     outband.SetNoDataValue(0)
     del outds
 
     return potentialShadowsFile
 
 
-def clumpClouds(cloudmaskfile):
+def clumpClouds(cloudmaskfile, window=None):
     """
     Clump cloud pixels to make a layer of cloud objects. Currently assumes
     that the cloud mask contains only zeros and ones. 
+    
+    If window is given, as (row0, col0, nrows, ncols), only that part of the
+    cloud mask is clumped. It must include all the cloud pixels. 
     """
     ds = gdal.Open(cloudmaskfile)
     band = ds.GetRasterBand(1)
-    cloudmask = band.ReadAsArray()
+    if window is None:
+        cloudmask = band.ReadAsArray()
+    else:
+        (row0, col0, nrows, ncols) = window
+        cloudmask = band.ReadAsArray(col0, row0, ncols, nrows)
     
     (clumps, numClumps) = label(cloudmask, structure=numpy.ones((3,3)))
     
@@ -725,7 +1127,8 @@ def clumpClouds(cloudmaskfile):
 
 
 CLOUD_HEIGHT_SCALE = 10
-def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal):
+def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal,
+        window=None):
     """
     Create 3-dimensional cloud objects from the cloud mask, and the thermal 
     information. Assumes a constant lapse rate to convert temperature into height.
@@ -736,11 +1139,26 @@ def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal)
     cloud object, and valueindexes.ValueIndexes object for use in extracting the location of 
     every pixel for a given cloud object. 
     
+    If window is given, as (row0, col0, nrows, ncols), the clumps are for only
+    that part of the image (see :func:`clumpClouds`), and so is the cloud shape. 
+    
     """
+    referenceFile = fmaskFilenames.getReferenceFile()
+    thermalFile = fmaskFilenames.thermal
+    croppedFiles = []
+    if window is not None:
+        referenceFile = '/vsimem/fmask_{}_ref_window.vrt'.format(os.getpid())
+        cropToWindow(fmaskFilenames.getReferenceFile(), window, referenceFile)
+        croppedFiles.append(referenceFile)
+        if not missingThermal:
+            thermalFile = '/vsimem/fmask_{}_thermal_window.vrt'.format(os.getpid())
+            warpToGrid(fmaskFilenames.thermal, referenceFile, thermalFile)
+            croppedFiles.append(thermalFile)
+    
     # Find out the pixel grid of the toareffile, so we can use that for RIOS.
     # this is necessary because the thermal might be on a different grid,
     # and we can use RIOS to resample that. 
-    referencePixgrid = pixelgrid.pixelGridFromFile(fmaskFilenames.toaRef)
+    referencePixgrid = pixelgrid.pixelGridFromFile(referenceFile)
     
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
@@ -750,9 +1168,11 @@ def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal)
     # if we have thermal, run against that 
     # otherwise we are just 
     if not missingThermal:
-        infiles.thermal = fmaskFilenames.thermal
+        infiles.thermal = thermalFile
     else:
-        infiles.toaRef = fmaskFilenames.toaRef
+        infiles.toaRef = referenceFile
+        # Only used for its shape
+        controls.selectInputImageLayers([1], imagename='toaRef')
         
     otherargs.clumps = clumps
     otherargs.cloudClumpNdx = valueindexes.ValueIndexes(clumps, nullVals=[0])
@@ -768,6 +1188,9 @@ def make3Dclouds(fmaskFilenames, fmaskConfig, clumps, numClumps, missingThermal)
     
     applier.apply(cloudShapeFunc, infiles, outfiles, otherargs, controls=controls)
     
+    for filename in croppedFiles:
+        gdal.Unlink(filename)
+    
     return (otherargs.cloudShape, otherargs.cloudBaseTemp, otherargs.cloudClumpNdx)
 
 
@@ -833,19 +1256,27 @@ BYTES_PER_VOXEL = 4
 SOLIDCLOUD_MAXMEM = float(1024*1024*1024)
 
 def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
-        cloudShape, cloudClumpNdx):
+        cloudShape, cloudClumpNdx, window=None):
     """
     Project the 3d cloud shapes onto horizontal surface, along the sun vector, to
     make the 2d shape of the shadow. 
+    
+    If window is given, as (row0, col0, nrows, ncols), the cloudShape and 
+    cloudClumpNdx are for only that part of the image (see :func:`make3Dclouds`).
+    The shadow shapes are always in the pixel coordinates of the whole image. 
     """
     # Read in the two solar angles. Assumes that the angles file is on the same 
     # pixel grid as the cloud, which should always be the case. 
-    ds = gdal.Open(fmaskFilenames.toaRef)
+    ds = gdal.Open(fmaskFilenames.getReferenceFile())
     geotrans = ds.GetGeoTransform()
     (xRes, yRes) = (float(geotrans[1]), float(geotrans[5]))
     (nrows, ncols) = (ds.RasterYSize, ds.RasterXSize)
     del ds
 
+    (winRow0, winCol0) = (0, 0)
+    if window is not None:
+        (winRow0, winCol0) = window[:2]
+
     # tell anglesInfo it may need to read data into memory
     fmaskConfig.anglesInfo.prepareForQuerying()
     
@@ -853,7 +1284,8 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
     
     cloudIDlist = cloudClumpNdx.values
     for cloudID in cloudIDlist:
-        cloudNdx = cloudClumpNdx.getIndexes(cloudID)
+        windowNdx = cloudClumpNdx.getIndexes(cloudID)
+        cloudNdx = (windowNdx[0] + winRow0, windowNdx[1] + winCol0)
         numPix = len(cloudNdx[0])
         
         sunAz = fmaskConfig.anglesInfo.getSolarAzimuthAngle(cloudNdx)
@@ -862,7 +1294,7 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
         satZen = fmaskConfig.anglesInfo.getViewZenithAngle(cloudNdx)
         
         # Cloudtop height of each pixel in cloud, in metres
-        cloudHgt = METRES_PER_KM * cloudShape[cloudNdx] / CLOUD_HEIGHT_SCALE
+        cloudHgt = METRES_PER_KM * cloudShape[windowNdx] / CLOUD_HEIGHT_SCALE
         
         # Relative (x, y) positions of each pixel in the cloud, in metres. Note 
         # that the negative yRes flips the Y axis (which is what we want)
@@ -937,6 +1369,36 @@ def makeCloudShadowShapes(fmaskFilenames, fmaskConfig,
     return shadowShapesDict
 
 
+def cropToWindow(filename, window, vrtFile):
+    """
+    Make a VRT file of the given window, (row0, col0, nrows, ncols), of an 
+    image file, with all its bands. 
+    
+    """
+    (row0, col0, nrows, ncols) = window
+    ds = gdal.Translate(vrtFile, filename, format='VRT', 
+        srcWin=[col0, row0, ncols, nrows])
+    del ds
+
+
+def warpToGrid(filename, gridFile, vrtFile):
+    """
+    Make a VRT file of an image file, resampled (nearest neighbour) onto exactly
+    the pixel grid of gridFile, as RIOS would do when reading it with gridFile
+    as the reference image. 
+    
+    """
+    gridDS = gdal.Open(gridFile)
+    geotrans = gridDS.GetGeoTransform()
+    (xsize, ysize) = (gridDS.RasterXSize, gridDS.RasterYSize)
+    outputBounds = (geotrans[0], geotrans[3] + ysize * geotrans[5], 
+        geotrans[0] + xsize * geotrans[1], geotrans[3])
+    ds = gdal.Warp(vrtFile, filename, format='VRT', outputBounds=outputBounds,
+        width=xsize, height=ysize, dstSRS=gridDS.GetProjection(), 
+        resampleAlg='near')
+    del ds, gridDS
+
+
 def getIntersectionCoords(filelist):
     """
     Use the RIOS utilities to get the correct area of intersection
@@ -972,12 +1434,65 @@ def makeBufferKernel(buffsize):
         bufferkernel = (radius <= buffsize).astype(numpy.uint8)
     return bufferkernel
 
+#: Buffer sizes (in pixels) from this upwards are done with a distance transform
+BUFFER_EDT_MINSIZE = 150
+
+def bufferMask(mask, buffsize):
+    """
+    Buffer the given 2-d boolean mask by buffsize pixels, i.e. set every pixel
+    within the circle of :func:`makeBufferKernel` around any True pixel. 
+    Returns a new boolean array. 
+    
+    Most buffers use the bit-parallel dilation of :class:`fmask.bitmask.BitMask`, 
+    whose cost grows only linearly with buffsize, with a very small constant. 
+    Very large buffers use the exact Euclidean distance transform to the nearest 
+    mask pixel, whose cost does not depend on buffsize, and which is only 
+    calculated over the bounding box of the mask plus the buffer. A pixel is 
+    within the kernel exactly when its distance is <= buffsize, and neither method 
+    takes anything from outside the array, so the results are identical to 
+    maximum_filter with that kernel. 
+    
+    """
+    if buffsize < BUFFER_EDT_MINSIZE:
+        return bitmask.BitMask.fromBool(mask).dilate(buffsize).toBool()
+    
+    buffered = numpy.zeros(mask.shape, dtype=numpy.bool)
+    maskRows = numpy.where(mask.any(axis=1))[0]
+    maskCols = numpy.where(mask.any(axis=0))[0]
+    if len(maskRows) > 0:
+        (nrows, ncols) = mask.shape
+        row0 = max(maskRows[0] - buffsize, 0)
+        row1 = min(maskRows[-1] + buffsize + 1, nrows)
+        col0 = max(maskCols[0] - buffsize, 0)
+        col1 = min(maskCols[-1] + buffsize + 1, ncols)
+        distance = distance_transform_edt(~mask[row0:row1, col0:col1])
+        buffered[row0:row1, col0:col1] = (distance <= buffsize)
+    return buffered
+
 def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile, 
-        shadowShapesDict, cloudBaseTemp, Tlow, Thigh, pass1file):
+        shadowShapesDict, cloudBaseTemp, Tlow, Thigh, pass1file, statsFile=None):
     """
     Match the cloud shadow shapes to the potential cloud shadows. 
-    Write an output file of the resulting shadow layer. 
-    Includes a 3-pixel buffer on the final shadows. 
+    Write an output file of the resulting shadow layer. The shadows are not
+    buffered here. The buffer of fmaskConfig.shadowBufferSize pixels is applied
+    later, in :func:`maskAndBuffer`. 
+    
+    Rather than reading the three input rasters into memory as whole images,
+    each cloud only reads the corridor of the image which its shadow search
+    can reach (see :class:`CloudSearchInfo`). These windows are read through
+    a cache of tiles (see :class:`fmask.tilecache.TileCache`), and the clouds
+    are processed in order of position, so that nearby clouds share the
+    same tiles. The matched shadow pixels are held as index lists, and the 
+    output is written in strips, so memory use depends on the size of the 
+    clouds rather than the size of the image. 
+    
+    Before searching, a coarse grid of the potential shadow is built (see 
+    :class:`ShadowSearchIndex`), and any steps of the search which could not
+    possibly give a match are skipped. This does not change the result. 
+    
+    If statsFile is given, a table of statistics on the search for each cloud
+    is written to it (see :class:`ShadowMatchStats`). 
+    
     """
     # Do a bunch of fancy footwork to read the same region from the whole
     # raster, of each of three separate rasters. Really RIOS should be able to do this
@@ -989,140 +1504,188 @@ def matchShadows(fmaskConfig, interimCloudmask, potentialShadowsFile,
         interimCloudmask, pass1file])
     (nrows, ncols) = intersectionPixgrid.getDimensions()
     
-    # Read in whole rasters from the three relevant files. 
-    ds = gdal.Open(potentialShadowsFile)
-    band = ds.GetRasterBand(1)
-    (xoff, yoff) = topLeftDict[potentialShadowsFile]
-    potentialShadow = band.ReadAsArray(xoff, yoff, ncols, nrows).astype(numpy.bool)
-    del ds
-    ds = gdal.Open(interimCloudmask)
-    band = ds.GetRasterBand(1)
-    (xoff, yoff) = topLeftDict[interimCloudmask]
-    cloudmask = band.ReadAsArray(xoff, yoff, ncols, nrows).astype(numpy.bool)
-    geotrans = ds.GetGeoTransform()
+    # Open the three relevant files, for reading windows as required
+    potShadowDS = gdal.Open(potentialShadowsFile)
+    potShadowTiles = tilecache.TileCache(potShadowDS, 1)
+    cloudDS = gdal.Open(interimCloudmask)
+    cloudTiles = tilecache.TileCache(cloudDS, 1)
+    geotrans = cloudDS.GetGeoTransform()
     (xRes, yRes) = (geotrans[1], geotrans[5])
-    (xsize, ysize) = (ds.RasterXSize, ds.RasterYSize)
-    proj = ds.GetProjection()
-    del ds
-    ds = gdal.Open(pass1file)
-    band = ds.GetRasterBand(5)
-    (xoff, yoff) = topLeftDict[pass1file]
-    nullmask = band.ReadAsArray(xoff, yoff, ncols, nrows).astype(numpy.bool)
-    del ds
+    (xsize, ysize) = (cloudDS.RasterXSize, cloudDS.RasterYSize)
+    proj = cloudDS.GetProjection()
+    pass1DS = gdal.Open(pass1file)
+    # Outside the file counts as null
+    nullTiles = tilecache.TileCache(pass1DS, 5, fillValue=1)
 
     (fd, interimShadowmask) = tempfile.mkstemp(prefix='matchedshadows', dir=fmaskConfig.tempDir, 
                                         suffix=fmaskConfig.defaultExtension)
     os.close(fd)
     
-    shadowmask = numpy.zeros(potentialShadow.shape, dtype=numpy.bool)
-    
+    def readWindows(window):
+        """
+        Read the given window (in intersection coordinates) from the three files, 
+        and return (potShadow, valid). The potential shadow layer is masked, so we 
+        don't include anything we think is cloud, or anything which is null in 
+        the imagery. 
+        """
+        potShadow = readIntersectionWindow(potShadowTiles, topLeftDict[potentialShadowsFile], 
+            window).astype(numpy.bool)
+        cloud = readIntersectionWindow(cloudTiles, topLeftDict[interimCloudmask], 
+            window).astype(numpy.bool)
+        null = readIntersectionWindow(nullTiles, topLeftDict[pass1file], 
+            window).astype(numpy.bool)
+        valid = ~(cloud | null)
+        potShadow &= valid
+        return (potShadow, valid)
+    
+    # A coarse index of the masked potential shadow, so that we can skip 
+    # any part of the search which could not find a match
+    searchIndex = ShadowSearchIndex(readWindows, nrows, ncols)
+    cloudIndex = makeCloudObjectIndex(shadowShapesDict, cloudBaseTemp, Tlow, Thigh, 
+        xRes, yRes, nrows, ncols, searchIndex)
+    del searchIndex
+    
+    matchedRowsList = []
+    matchedColsList = []
     unmatchedCount = 0
-    cloudIDlist = shadowShapesDict.keys()
-    for cloudID in cloudIDlist:
-        shadowEntry = shadowShapesDict[cloudID]
-        if cloudID in cloudBaseTemp:
-            Tcloudbase = cloudBaseTemp[cloudID]
-        else:
-            Tcloudbase = 0
-
-        matchedShadowNdx = matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, 
-            Tlow, Thigh, xRes, yRes, cloudID, nullmask)
-        
+    stats = None
+    if statsFile is not None:
+        stats = ShadowMatchStats()
+    
+    def saveMatch(cloudInfo, matchedShadowNdx, elapsed):
+        if stats is not None:
+            stats.addCloud(cloudInfo, matchedShadowNdx is not None, elapsed)
         if matchedShadowNdx is not None:
-            shadowmask[matchedShadowNdx] = True
+            matchedRowsList.append(matchedShadowNdx[0])
+            matchedColsList.append(matchedShadowNdx[1])
+            return 0
+        else:
+            return 1
+    
+    def matchBatch(smallBatch):
+        startTime = time.time()
+        (potShadow, valid) = readWindows(smallBatch.window)
+        matchedList = matchSmallShadows(smallBatch, shadowShapesDict, potShadow, valid)
+        # Share the time between the clouds, according to the work done for each
+        elapsed = time.time() - startTime
+        unmatched = 0
+        for (cloudInfo, matchedShadowNdx) in zip(smallBatch.cloudInfoList, matchedList):
+            cloudElapsed = elapsed * smallBatch.lookupsForCloud(cloudInfo) / smallBatch.numLookups
+            unmatched += saveMatch(cloudInfo, matchedShadowNdx, cloudElapsed)
+        return unmatched
+    
+    # Small clouds are gathered into batches of nearby clouds, and matched together
+    smallBatch = SmallCloudBatch()
+    for cloudInfo in cloudIndex:
+        if cloudInfo.corridor is None:
+            # Template never fits inside the image, or nowhere could be a match
+            unmatchedCount += saveMatch(cloudInfo, None, 0.0)
+        elif cloudInfo.numPix < fmaskConfig.smallCloudMatchSize:
+            if not smallBatch.canAdd(cloudInfo):
+                unmatchedCount += matchBatch(smallBatch)
+                smallBatch = SmallCloudBatch()
+            smallBatch.add(cloudInfo)
         else:
-            unmatchedCount += 1
+            # Read the corridor windows. 
+            startTime = time.time()
+            (potShadow, valid) = readWindows(cloudInfo.corridor)
+            shapeNdx = shadowShapesDict[cloudInfo.cloudID][0]
+            matchedShadowNdx = matchOneShadow(cloudInfo, shapeNdx, potShadow, valid)
+            unmatchedCount += saveMatch(cloudInfo, matchedShadowNdx, time.time() - startTime)
+    if len(smallBatch.cloudInfoList) > 0:
+        unmatchedCount += matchBatch(smallBatch)
 
     if fmaskConfig.verbose:
-        print("No shadow found for %s of %s clouds " % (unmatchedCount, len(cloudIDlist)))
+        print("No shadow found for %s of %s clouds " % (unmatchedCount, len(cloudIndex)))
+    if stats is not None:
+        stats.writeTable(statsFile)
 
-    del potentialShadow, cloudmask, nullmask
+    del potShadowTiles, cloudTiles, nullTiles, potShadowDS, cloudDS, pass1DS
     
-    # Now apply a 3-pixel buffer, as per section 3.2 (2nd-last paragraph)
-    # I have the buffer size settable from the commandline, with our default
-    # being larger than the original. 
-    if fmaskConfig.shadowBufferSize > 0:
-        kernel = makeBufferKernel(fmaskConfig.shadowBufferSize)
-        shadowmaskBuffered = maximum_filter(shadowmask, footprint=kernel)
-    else:
-        shadowmaskBuffered = shadowmask
-
-    driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
-    creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
-    ds = driver.Create(interimShadowmask, xsize, ysize, 1, gdal.GDT_Byte,
-                creationOptions)
-    ds.SetProjection(proj)
-    ds.SetGeoTransform(geotrans)
-    band = ds.GetRasterBand(1)
-    band.WriteArray(shadowmaskBuffered)
-    del ds
+    # The buffer (section 3.2, 2nd-last paragraph) is applied later, in finalizeAll()
+    writeMatchedShadows(interimShadowmask, matchedRowsList, matchedColsList, 
+        (nrows, ncols), (xsize, ysize), proj, geotrans)
     
     return interimShadowmask
 
 
-def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Thigh, 
-        xRes, yRes, cloudID, nullmask):
+def readIntersectionWindow(tiles, topLeft, window):
     """
-    Given the temperatures and sun angles for a single cloud object, and a shadow
-    shape, search along the sun vector for a matching shadow object. 
+    Read the given window, in the pixel coordinates of the intersection region
+    (see :func:`getIntersectionCoords`), from the given TileCache. The topLeft is 
+    the (x, y) pixel position of the intersection within that file. 
     
     """
-    (imgNrows, imgNcols) = cloudmask.shape
+    (xoff, yoff) = topLeft
+    (row0, col0, nrows, ncols) = window
+    return tiles.readWindow(row0 + yoff, col0 + xoff, nrows, ncols)
 
-    # Not enough clear land to work out temperature thresholds, so guess. 
-    if Tlow is None:
-        Tlow = 0.0
-    if Thigh is None:
-        Thigh = 10.0
-    
-    # Equation 21. Convert these to metres instead of kilometres
-    Hcloudbase_min = max(0.2, (Tlow - 4 - Tcloudbase)/9.8) * METRES_PER_KM
-    Hcloudbase_max = min(12, (Thigh + 4 - Tcloudbase)) * METRES_PER_KM
-    
-    # Entry for this cloud shadow object
-    (shapeNdx, satAz, satZen, sunAz, sunZen) = shadowEntry
-    
-    tanSunZen = numpy.tan(sunZen)
-    sinSunAz = numpy.sin(sunAz)
-    cosSunAz = numpy.cos(sunAz)
-    tanSatZen = numpy.tan(satZen)
-    sinSatAz = numpy.sin(satAz)
-    cosSatAz = numpy.cos(satAz)
-    
-    # We want to shift the cloud up, from Hcloudbase_min to Hcloudbase_max.
-    # Given the sun angles, this corresponds to shifting the shadow along
-    # the ground from Dmin to Dmax. 
-    Dmin = Hcloudbase_min * tanSunZen
-    Dmax = Hcloudbase_max * tanSunZen
-    
-    # This corresponds to the following offsets in X and Y
-    Xoff_min = Dmin * sinSunAz
-    Xoff_max = Dmax * sinSunAz
-    Yoff_min = Dmin * cosSunAz
-    Yoff_max = Dmax * cosSunAz
-    
-    # We want the step to be xRes in at least one direction. 
-    longestShift = max(abs(Xoff_max - Xoff_min), abs(Yoff_max - Yoff_min))
-    numSteps = max(1, int(numpy.ceil(longestShift / xRes)))      # Assumes square pixels
-    Xstep = (Xoff_max - Xoff_min) / numSteps
-    Ystep = (Yoff_max - Yoff_min) / numSteps
-    
-    # shadowTemplate is a rectangle containing just the shadow shape to be shifted
-    row0 = shapeNdx[0].min()
-    rowN = shapeNdx[0].max()
-    col0 = shapeNdx[1].min()
-    colN = shapeNdx[1].max()
-    (nrows, ncols) = ((rowN-row0+1), (colN-col0+1))
-    shadowTemplate = numpy.zeros((nrows, ncols), dtype=numpy.bool)
-    shadowTemplate[shapeNdx[0]-row0, shapeNdx[1]-col0] = True
+
+class CloudSearchInfo(object):
+    """
+    Index entry for a single cloud object, describing the search for its shadow. 
+    
+    Records the bounding box of the shadow template (the shadow shape made
+    by :func:`makeCloudShadowShapes`), the position of the template at each step 
+    along the sun vector, and the search corridor. The corridor is the bounding 
+    box of every template position which lies wholly within the image, and so is
+    the only part of the image which the search can look at. It is a tuple of
+    (row0, col0, nrows, ncols), or None if the template never fits in the image. 
+    
+    The numStepsEvaluated and bestSimilarity attributes record the outcome
+    of the search, for reporting. The bestSimilarity is the highest similarity 
+    of the steps which could give a match (see :meth:`pruneSteps`), whether or 
+    not each one was actually evaluated. So it is exact whenever a match was 
+    found, but for a cloud with no match it is only a lower limit on the 
+    highest similarity anywhere along the sun vector. :meth:`maxSimilarityBound`
+    gives the corresponding upper limit. 
     
-    # Step this template across the potential shadows until we match. 
-    i = 0
-    bestSimilarity = 0
-    bestRC = (0, 0)
-    bestOverlapRegion = None
-    for i in range(numSteps):
-        # Cloudbase height for this step
+    """
+    def __init__(self, cloudID, shadowEntry, Tcloudbase, Tlow, Thigh, xRes, yRes, 
+            imgNrows, imgNcols):
+        self.cloudID = cloudID
+        
+        # Not enough clear land to work out temperature thresholds, so guess. 
+        if Tlow is None:
+            Tlow = 0.0
+        if Thigh is None:
+            Thigh = 10.0
+        
+        # Equation 21. Convert these to metres instead of kilometres
+        Hcloudbase_min = max(0.2, (Tlow - 4 - Tcloudbase)/9.8) * METRES_PER_KM
+        Hcloudbase_max = min(12, (Thigh + 4 - Tcloudbase)) * METRES_PER_KM
+        
+        # Entry for this cloud shadow object
+        (shapeNdx, satAz, satZen, sunAz, sunZen) = shadowEntry
+        
+        tanSunZen = numpy.tan(sunZen)
+        sinSunAz = numpy.sin(sunAz)
+        cosSunAz = numpy.cos(sunAz)
+        tanSatZen = numpy.tan(satZen)
+        sinSatAz = numpy.sin(satAz)
+        cosSatAz = numpy.cos(satAz)
+        
+        # We want to shift the cloud up, from Hcloudbase_min to Hcloudbase_max.
+        # Given the sun angles, this corresponds to shifting the shadow along
+        # the ground from Dmin to Dmax. 
+        Dmin = Hcloudbase_min * tanSunZen
+        Dmax = Hcloudbase_max * tanSunZen
+        
+        # This corresponds to the following offsets in X and Y
+        Xoff_min = Dmin * sinSunAz
+        Xoff_max = Dmax * sinSunAz
+        Yoff_min = Dmin * cosSunAz
+        Yoff_max = Dmax * cosSunAz
+        
+        # We want the step to be xRes in at least one direction. 
+        longestShift = max(abs(Xoff_max - Xoff_min), abs(Yoff_max - Yoff_min))
+        numSteps = max(1, int(numpy.ceil(longestShift / xRes)))      # Assumes square pixels
+        Xstep = (Xoff_max - Xoff_min) / numSteps
+        Ystep = (Yoff_max - Yoff_min) / numSteps
+        
+        # Every step at once. 
+        i = numpy.arange(numSteps)
+        # Cloudbase height for each step
         H = (Xoff_min + i * Xstep) / (tanSunZen * sinSunAz)
         # Calculate the shift in the cloud position due to the view angle and the cloud elevation
         D_viewoffset = H * tanSatZen
@@ -1133,47 +1696,275 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
         Xoff = Xoff_min + i * Xstep - X_viewoffset
         Yoff = Yoff_min + i * Ystep - Y_viewoffset
         
-        # Shift in pixels. Note that negative yRes inverts the row axis
-        rowOff = int(Yoff / yRes)
-        colOff = int(Xoff / xRes)
+        # Shift in pixels (truncated towards zero). Note that negative yRes inverts the row axis
+        rowOff = (Yoff / yRes).astype(numpy.int64)
+        colOff = (Xoff / xRes).astype(numpy.int64)
+        
+        # shadowTemplate is a rectangle containing just the shadow shape to be shifted
+        self.numPix = len(shapeNdx[0])
+        self.row0 = int(shapeNdx[0].min())
+        self.col0 = int(shapeNdx[1].min())
+        self.nrows = int(shapeNdx[0].max()) - self.row0 + 1
+        self.ncols = int(shapeNdx[1].max()) - self.col0 + 1
+        
+        # Top-left of the template, for each step
+        self.stepRows = self.row0 - rowOff
+        self.stepCols = self.col0 - colOff
+        self.inBounds = ((self.stepRows >= 0) & (self.stepRows + self.nrows <= imgNrows) &
+            (self.stepCols >= 0) & (self.stepCols + self.ncols <= imgNcols))
+        
+        # The steps which need to be evaluated, and an upper bound on the similarity
+        # at each step (see pruneSteps())
+        self.searchSteps = numpy.where(self.inBounds)[0]
+        self.simBound = None
+        self.setCorridor()
         
-        # Extract the potential shadow, and also the cloud, from the shifted region of
-        # the full images
-        r = row0 - rowOff
-        c = col0 - colOff
-        if r >= 0 and r+nrows <= imgNrows and c >= 0 and c+ncols <= imgNcols:
-            cloud = cloudmask[r:r+nrows, c:c+ncols]
-            potShadow = potentialShadow[r:r+nrows, c:c+ncols]
-            null = nullmask[r:r+nrows, c:c+ncols]
-            # mask the potential shadow layer, so we don't include anything we think is cloud
-            potShadow[cloud] = 0
-            # Similarly with the areas which are null in the imagery
-            potShadow[null] = 0
-
-            # Mask the shadow template with the cloud from this area
-            shadowTemplateMasked = shadowTemplate.copy()
-            shadowTemplateMasked[cloud] = False
-            shadowTemplateMasked[null] = False
-
-            similarity = 0
-            overlap = numpy.logical_and(potShadow, shadowTemplateMasked)
-            # Calculate overlap area (by counting pixels)
-            overlapArea = overlap.sum()
-            # Remaining area of shadow shape
-            shadowArea = shadowTemplateMasked.sum()
-            if shadowArea > 0:
-                similarity = float(overlapArea) / shadowArea
-
-
-            # We don't use the Zhu & Woodcock termination condition, as this
-            # very often results in stopping search too soon. We just check the whole
-            # transect, and save the best position. 
-            # TODO: strict version should use new threshold
-            if similarity > bestSimilarity:
-                bestRC = (r, c)
-                bestSimilarity = similarity
-                bestOverlapRegion = overlap
+        # Outcome of the search, set when the shadow is matched
+        self.numStepsEvaluated = 0
+        self.bestSimilarity = 0
+    
+    def setCorridor(self):
+        """
+        Set the corridor attribute from the current list of search steps
+        """
+        self.corridor = None
+        if len(self.searchSteps) > 0:
+            rows = self.stepRows[self.searchSteps]
+            cols = self.stepCols[self.searchSteps]
+            (corRow0, corCol0) = (int(rows.min()), int(cols.min()))
+            self.corridor = (corRow0, corCol0, int(rows.max()) - corRow0 + self.nrows,
+                int(cols.max()) - corCol0 + self.ncols)
+    
+    def pruneSteps(self, searchIndex, shapeNdx):
+        """
+        Use the given :class:`ShadowSearchIndex` to remove any search steps at 
+        which the similarity cannot exceed the 0.3 threshold, and shrink the 
+        corridor to match. The remaining upper bounds are kept in simBound, so that
+        the search can also skip steps which cannot beat the best so far. 
+        """
+        numTemplatePix = len(self.makeTemplatePoints(shapeNdx)[0])
+        self.simBound = numpy.zeros(len(self.inBounds))
+        self.simBound[self.searchSteps] = searchIndex.similarityBound(
+            self.stepRows[self.searchSteps], self.stepCols[self.searchSteps],
+            self.nrows, self.ncols, numTemplatePix)
+        self.searchSteps = self.searchSteps[self.simBound[self.searchSteps] > 0.3]
+        self.setCorridor()
+    
+    def maxSimilarityBound(self):
+        """
+        Return an upper limit on the similarity at any step along the sun vector, 
+        from the bounds found by :meth:`pruneSteps`. This is 1 if it has not been 
+        called, and 0 if the template never fits in the image. 
+        """
+        if self.simBound is None:
+            bound = 1.0
+        elif self.inBounds.any():
+            bound = float(self.simBound[self.inBounds].max())
+        else:
+            bound = 0.0
+        return bound
+    
+    def makeTemplate(self, shapeNdx):
+        """
+        Return the shadow template, a bool array of the bounding box of the shadow
+        shape, with True for the pixels in the shape. 
+        """
+        shadowTemplate = numpy.zeros((self.nrows, self.ncols), dtype=numpy.bool)
+        shadowTemplate[shapeNdx[0]-self.row0, shapeNdx[1]-self.col0] = True
+        return shadowTemplate
+    
+    def makeTemplatePoints(self, shapeNdx):
+        """
+        Return the shadow template as a list of points, i.e. a tuple of arrays 
+        (rows, cols) relative to the top-left of the template. Duplicate points
+        in the shadow shape are only included once. 
+        """
+        shapeRows = shapeNdx[0].astype(numpy.int64) - self.row0
+        shapeCols = shapeNdx[1].astype(numpy.int64) - self.col0
+        pointNdx = numpy.unique(shapeRows * self.ncols + shapeCols)
+        return (pointNdx // self.ncols, pointNdx % self.ncols)
+
+
+#: Size (in pixels) of the cells of a ShadowSearchIndex
+SHADOW_SEARCHINDEX_CELLSIZE = 8
+
+class ShadowSearchIndex(object):
+    """
+    A coarse occupancy grid of the potential shadow layer (masked against
+    cloud and null), used to prune the shadow search. For each cell of the 
+    grid it counts the potential shadow pixels, and the invalid (cloud or null)
+    pixels, held as integral images so that the counts over any rectangle of
+    cells are quick to find. 
     
+    The readWindows function is as used in :func:`matchShadows`, and the grid
+    is built by reading the whole image in strips. 
+    
+    """
+    def __init__(self, readWindows, nrows, ncols, cellSize=SHADOW_SEARCHINDEX_CELLSIZE):
+        self.cellSize = cellSize
+        gridNrows = (nrows + cellSize - 1) // cellSize
+        gridNcols = (ncols + cellSize - 1) // cellSize
+        potCount = numpy.zeros((gridNrows, gridNcols), dtype=numpy.int64)
+        invalidCount = numpy.zeros((gridNrows, gridNcols), dtype=numpy.int64)
+        
+        # Strips are a whole number of cells high
+        stripSize = max(1, RIOS_WINDOW_SIZE // cellSize) * cellSize
+        for row0 in range(0, nrows, stripSize):
+            stripNrows = min(stripSize, nrows - row0)
+            (potShadow, valid) = readWindows((row0, 0, stripNrows, ncols))
+            gridRow0 = row0 // cellSize
+            gridRow1 = gridRow0 + (stripNrows + cellSize - 1) // cellSize
+            potCount[gridRow0:gridRow1] = self.cellCounts(potShadow)
+            invalidCount[gridRow0:gridRow1] = self.cellCounts(~valid)
+        
+        self.potIntegral = self.makeIntegral(potCount)
+        self.invalidIntegral = self.makeIntegral(invalidCount)
+    
+    def cellCounts(self, mask):
+        """
+        Count the True pixels of the given mask in each cell
+        """
+        cellSize = self.cellSize
+        (nrows, ncols) = mask.shape
+        gridNrows = (nrows + cellSize - 1) // cellSize
+        gridNcols = (ncols + cellSize - 1) // cellSize
+        padded = numpy.zeros((gridNrows * cellSize, gridNcols * cellSize), dtype=numpy.uint8)
+        padded[:nrows, :ncols] = mask
+        padded = padded.reshape(gridNrows, cellSize, gridNcols, cellSize)
+        return padded.sum(axis=3, dtype=numpy.int64).sum(axis=1)
+    
+    @staticmethod
+    def makeIntegral(counts):
+        """
+        Integral image of the given counts, with a leading row and column of zeros
+        """
+        integral = numpy.zeros((counts.shape[0] + 1, counts.shape[1] + 1), dtype=numpy.int64)
+        integral[1:, 1:] = counts.cumsum(axis=0).cumsum(axis=1)
+        return integral
+    
+    def rectCounts(self, integral, rows, cols, nrows, ncols):
+        """
+        Total counts over all cells touched by each of the rectangles with top-left 
+        (rows[i], cols[i]) and the given size in pixels
+        """
+        cellSize = self.cellSize
+        cellRow0 = rows // cellSize
+        cellCol0 = cols // cellSize
+        cellRow1 = (rows + nrows - 1) // cellSize + 1
+        cellCol1 = (cols + ncols - 1) // cellSize + 1
+        return (integral[cellRow1, cellCol1] - integral[cellRow0, cellCol1] - 
+            integral[cellRow1, cellCol0] + integral[cellRow0, cellCol0])
+    
+    def similarityBound(self, rows, cols, nrows, ncols, numTemplatePix):
+        """
+        Return an upper bound on the similarity (as calculated in :func:`matchOneShadow`)
+        of a shadow template with numTemplatePix pixels, and a bounding box of 
+        (nrows, ncols), placed with its top-left at each of the given (rows, cols). 
+        
+        The overlap can be no more than the potential shadow in the cells covering
+        the template, and the remaining shadow area no less than the template size
+        less the invalid pixels in those cells. 
+        """
+        potCount = self.rectCounts(self.potIntegral, rows, cols, nrows, ncols)
+        invalidCount = self.rectCounts(self.invalidIntegral, rows, cols, nrows, ncols)
+        minShadowArea = numTemplatePix - invalidCount
+        
+        bound = numpy.ones(len(rows))
+        # With no potential shadow at all, the similarity is zero
+        bound[potCount == 0] = 0
+        useRatio = (potCount > 0) & (minShadowArea > 0)
+        bound[useRatio] = numpy.minimum(1, potCount[useRatio] / minShadowArea[useRatio])
+        return bound
+
+
+def makeCloudObjectIndex(shadowShapesDict, cloudBaseTemp, Tlow, Thigh, xRes, yRes, 
+        imgNrows, imgNcols, searchIndex=None):
+    """
+    Make a list of :class:`CloudSearchInfo` objects, one for each cloud
+    object. The list is sorted by the position of each cloud's search
+    corridor, so that clouds which are close together are processed together. 
+    
+    If searchIndex (a :class:`ShadowSearchIndex`) is given, it is used to prune
+    the search steps of each cloud. 
+    
+    """
+    cloudIndex = []
+    for cloudID in shadowShapesDict:
+        if cloudID in cloudBaseTemp:
+            Tcloudbase = cloudBaseTemp[cloudID]
+        else:
+            Tcloudbase = 0
+        cloudInfo = CloudSearchInfo(cloudID, shadowShapesDict[cloudID], Tcloudbase, 
+            Tlow, Thigh, xRes, yRes, imgNrows, imgNcols)
+        if searchIndex is not None:
+            cloudInfo.pruneSteps(searchIndex, shadowShapesDict[cloudID][0])
+        cloudIndex.append(cloudInfo)
+    
+    def sortKey(cloudInfo):
+        if cloudInfo.corridor is None:
+            return (-1, -1)
+        return cloudInfo.corridor[:2]
+    cloudIndex.sort(key=sortKey)
+    return cloudIndex
+
+
+def matchOneShadow(cloudInfo, shapeNdx, potShadow, valid):
+    """
+    Given the search information for a single cloud object (a 
+    :class:`CloudSearchInfo`), and its shadow shape, search along the sun vector 
+    for a matching shadow object. 
+    
+    The potShadow and valid arrays cover the search corridor for this cloud. The
+    potShadow array is the potential shadow layer, already masked against cloud and
+    nulls, and valid is True where the image is neither cloud nor null. 
+    
+    Returns the indexes of the matched shadow pixels, in the coordinates of the 
+    whole image, or None if no match was found. 
+    
+    """
+    shadowTemplate = cloudInfo.makeTemplate(shapeNdx)
+    (nrows, ncols) = shadowTemplate.shape
+    (corRow0, corCol0) = cloudInfo.corridor[:2]
+    
+    # Step this template across the potential shadows until we match. 
+    bestSimilarity = 0
+    bestRC = (0, 0)
+    bestOverlapRegion = None
+    for i in cloudInfo.searchSteps:
+        if (cloudInfo.simBound is not None and 
+                cloudInfo.simBound[i] <= max(bestSimilarity, 0.3)):
+            # Cannot be a better match than we already have
+            continue
+        cloudInfo.numStepsEvaluated += 1
+        
+        # Extract the potential shadow, and also the valid area, from the shifted region 
+        # of the corridor
+        r = cloudInfo.stepRows[i] - corRow0
+        c = cloudInfo.stepCols[i] - corCol0
+        potShadowHere = potShadow[r:r+nrows, c:c+ncols]
+
+        # Mask the shadow template with the cloud and null from this area
+        shadowTemplateMasked = shadowTemplate & valid[r:r+nrows, c:c+ncols]
+
+        similarity = 0
+        overlap = numpy.logical_and(potShadowHere, shadowTemplateMasked)
+        # Calculate overlap area (by counting pixels)
+        overlapArea = overlap.sum()
+        # Remaining area of shadow shape
+        shadowArea = shadowTemplateMasked.sum()
+        if shadowArea > 0:
+            similarity = float(overlapArea) / shadowArea
+
+        # We don't use the Zhu & Woodcock termination condition, as this
+        # very often results in stopping search too soon. We just check the whole
+        # transect, and save the best position. 
+        # TODO: strict version should use new threshold
+        if similarity > bestSimilarity:
+            bestRC = (cloudInfo.stepRows[i], cloudInfo.stepCols[i])
+            bestSimilarity = similarity
+            bestOverlapRegion = overlap
+    
+    cloudInfo.bestSimilarity = bestSimilarity
     if bestSimilarity > 0.3:
         # We accept the match, now save the index for the pixels in the overlap region
         overlapNdx = numpy.where(bestOverlapRegion)
@@ -1184,11 +1975,292 @@ def matchOneShadow(cloudmask, shadowEntry, potentialShadow, Tcloudbase, Tlow, Th
     return matchedShadowNdx
 
 
+#: Limit on the area (in pixels) of the window read for a batch of small clouds
+SMALLCLOUD_BATCH_MAXPIX = 4 * 1024 * 1024
+#: Limit on the number of (step, pixel) lookups done at once for a batch of small clouds
+SMALLCLOUD_BATCH_MAXLOOKUPS = 4 * 1024 * 1024
+
+class SmallCloudBatch(object):
+    """
+    A batch of small, nearby clouds, whose shadows are matched together by
+    :func:`matchSmallShadows`. The window attribute is the union of their
+    search corridors, as (row0, col0, nrows, ncols). 
+    """
+    def __init__(self):
+        self.cloudInfoList = []
+        self.window = None
+        self.numLookups = 0
+    
+    @staticmethod
+    def lookupsForCloud(cloudInfo):
+        return len(cloudInfo.searchSteps) * cloudInfo.numPix
+    
+    def unionWindow(self, cloudInfo):
+        """
+        Return the window which would cover this batch, if the given cloud were added
+        """
+        (row0, col0, nrows, ncols) = cloudInfo.corridor
+        if self.window is not None:
+            (bRow0, bCol0, bNrows, bNcols) = self.window
+            row1 = max(row0 + nrows, bRow0 + bNrows)
+            col1 = max(col0 + ncols, bCol0 + bNcols)
+            row0 = min(row0, bRow0)
+            col0 = min(col0, bCol0)
+            (nrows, ncols) = (row1 - row0, col1 - col0)
+        return (row0, col0, nrows, ncols)
+    
+    def canAdd(self, cloudInfo):
+        """
+        Return True if the given cloud can be added without exceeding the limits
+        on the size of the batch. An empty batch can always be added to. 
+        """
+        if len(self.cloudInfoList) == 0:
+            return True
+        (row0, col0, nrows, ncols) = self.unionWindow(cloudInfo)
+        numLookups = self.numLookups + self.lookupsForCloud(cloudInfo)
+        return (nrows * ncols <= SMALLCLOUD_BATCH_MAXPIX and 
+            numLookups <= SMALLCLOUD_BATCH_MAXLOOKUPS)
+    
+    def add(self, cloudInfo):
+        self.window = self.unionWindow(cloudInfo)
+        self.numLookups += self.lookupsForCloud(cloudInfo)
+        self.cloudInfoList.append(cloudInfo)
+
+
+def matchSmallShadows(smallBatch, shadowShapesDict, potShadow, valid):
+    """
+    Match the shadows for a batch of small clouds (a :class:`SmallCloudBatch`). Gives 
+    exactly the same results as calling :func:`matchOneShadow` for each cloud, but 
+    does it without looping over the search steps, or over the clouds. 
+    
+    Each shadow template is treated as a list of points, and all the points at
+    all the in-bounds steps, for all the clouds, are looked up in the potShadow and 
+    valid arrays at once. These arrays cover the window of the batch, and are as for
+    :func:`matchOneShadow`. 
+    
+    Returns a list of the matched shadow indexes (or None), one for each cloud
+    in the batch. 
+    
+    """
+    (winRow0, winCol0) = smallBatch.window[:2]
+    
+    # Row/col of every template point, at every step, for every cloud
+    rowsList = []
+    colsList = []
+    numPoints = []
+    numSteps = []
+    for cloudInfo in smallBatch.cloudInfoList:
+        shapeNdx = shadowShapesDict[cloudInfo.cloudID][0]
+        (pointRows, pointCols) = cloudInfo.makeTemplatePoints(shapeNdx)
+        steps = cloudInfo.searchSteps
+        rows = (cloudInfo.stepRows[steps] - winRow0)[:, numpy.newaxis] + pointRows
+        cols = (cloudInfo.stepCols[steps] - winCol0)[:, numpy.newaxis] + pointCols
+        rowsList.append(rows.flatten())
+        colsList.append(cols.flatten())
+        numPoints.append(len(pointRows))
+        numSteps.append(len(steps))
+    rows = numpy.concatenate(rowsList)
+    cols = numpy.concatenate(colsList)
+    numSteps = numpy.array(numSteps)
+    # Number of points in each (cloud, step) segment
+    segLengths = numpy.repeat(numpy.array(numPoints), numSteps)
+    segStarts = numpy.cumsum(segLengths) - segLengths
+    
+    potShadowHit = potShadow[rows, cols]
+    # Overlap area, and remaining area of shadow shape, for each (cloud, step)
+    overlapArea = numpy.add.reduceat(potShadowHit.astype(numpy.uint32), segStarts)
+    shadowArea = numpy.add.reduceat(valid[rows, cols].astype(numpy.uint32), segStarts)
+    similarity = numpy.zeros(len(segStarts))
+    nonEmpty = (shadowArea > 0)
+    similarity[nonEmpty] = overlapArea[nonEmpty] / shadowArea[nonEmpty]
+    
+    # The best step for each cloud is the first with the highest similarity,
+    # the same as the sequential search
+    cloudStarts = numpy.cumsum(numSteps) - numSteps
+    bestSimilarity = numpy.maximum.reduceat(similarity, cloudStarts)
+    isBest = (similarity == numpy.repeat(bestSimilarity, numSteps))
+    segNdx = numpy.arange(len(similarity))
+    bestSeg = numpy.minimum.reduceat(numpy.where(isBest, segNdx, len(similarity)), cloudStarts)
+    
+    matchedList = []
+    for i in range(len(smallBatch.cloudInfoList)):
+        cloudInfo = smallBatch.cloudInfoList[i]
+        cloudInfo.numStepsEvaluated = numSteps[i]
+        cloudInfo.bestSimilarity = bestSimilarity[i]
+        matchedShadowNdx = None
+        if bestSimilarity[i] > 0.3:
+            # We accept the match, now save the index for the pixels in the overlap region
+            start = segStarts[bestSeg[i]]
+            end = start + segLengths[bestSeg[i]]
+            overlap = potShadowHit[start:end]
+            matchedShadowNdx = (rows[start:end][overlap] + winRow0, 
+                cols[start:end][overlap] + winCol0)
+        matchedList.append(matchedShadowNdx)
+    
+    return matchedList
+
+
+class ShadowMatchStats(object):
+    """
+    Statistics on the shadow search for each cloud, collected by 
+    :func:`matchShadows`. For each cloud this records the number of pixels, the
+    number of steps along the sun vector which could be searched, and which were
+    actually evaluated, the best similarity found, an upper limit on the 
+    similarity, whether this was accepted as a match, and the time taken 
+    (in seconds). Where small clouds are matched together, the time for the 
+    batch is shared between them according to the work done for each. 
+    
+    The best similarity is only over the steps which could possibly give a 
+    match, i.e. whose upper limit on the similarity is more than 0.3, so for a 
+    cloud with no match it may be less than the true best (often 0, when there 
+    are no such steps). The similarityBound column is the highest upper limit 
+    over all the steps, so the true best similarity for any cloud is between 
+    bestSimilarity and max(bestSimilarity, similarityBound). These are the same
+    for the clouds matched individually and those matched in batches. 
+    
+    """
+    # Upper edges of the bins of the histograms. Sizes and counts use powers of 2
+    countBins = [2**i for i in range(25)]
+    similarityBins = [0.1 * i for i in range(1, 11)]
+    timeBins = [10.0**i for i in range(-5, 4)]
+    
+    def __init__(self):
+        self.cloudID = []
+        self.numPix = []
+        self.numSteps = []
+        self.numStepsEvaluated = []
+        self.bestSimilarity = []
+        self.similarityBound = []
+        self.matched = []
+        self.elapsed = []
+    
+    def addCloud(self, cloudInfo, matched, elapsed):
+        """
+        Add the outcome of the search for one cloud (a :class:`CloudSearchInfo`)
+        """
+        self.cloudID.append(cloudInfo.cloudID)
+        self.numPix.append(cloudInfo.numPix)
+        self.numSteps.append(int(cloudInfo.inBounds.sum()))
+        self.numStepsEvaluated.append(int(cloudInfo.numStepsEvaluated))
+        self.bestSimilarity.append(float(cloudInfo.bestSimilarity))
+        self.similarityBound.append(cloudInfo.maxSimilarityBound())
+        self.matched.append(int(matched))
+        self.elapsed.append(elapsed)
+    
+    def makeHistogram(self, values, bins):
+        """
+        Return a list of (upperEdge, count, numMatched, totalSeconds) for each 
+        bin which has anything in it. Values above the last bin go in an extra
+        bin with an upper edge of inf. 
+        """
+        edges = list(bins) + [float('inf')]
+        binNdx = numpy.searchsorted(numpy.array(bins), numpy.array(values, dtype=numpy.float64))
+        matched = numpy.array(self.matched, dtype=numpy.int64)
+        elapsed = numpy.array(self.elapsed, dtype=numpy.float64)
+        histogram = []
+        for i in range(len(edges)):
+            inBin = (binNdx == i)
+            count = inBin.sum()
+            if count > 0:
+                histogram.append((edges[i], count, matched[inBin].sum(), elapsed[inBin].sum()))
+        return histogram
+    
+    def writeTable(self, filename):
+        """
+        Write the statistics to a text file. There is one line per cloud, 
+        followed by histograms of the number of pixels, the number of steps 
+        evaluated, the best similarity, the similarity bound and the time taken. 
+        Each histogram has
+        one line per non-empty bin, giving the upper edge of the bin, then 
+        the number of clouds, the number matched, and their total time. 
+        
+        """
+        with open(filename, 'w') as f:
+            f.write("# Shadow matching, %d clouds, %d matched, %.3f seconds\n" % (
+                len(self.cloudID), sum(self.matched), sum(self.elapsed)))
+            f.write("cloudID numPix numSteps numStepsEvaluated bestSimilarity " +
+                "similarityBound matched seconds\n")
+            for i in range(len(self.cloudID)):
+                f.write("%d %d %d %d %.4f %.4f %d %.6f\n" % (self.cloudID[i], self.numPix[i], 
+                    self.numSteps[i], self.numStepsEvaluated[i], self.bestSimilarity[i], 
+                    self.similarityBound[i], self.matched[i], self.elapsed[i]))
+        
+            histograms = [('numPix', self.numPix, self.countBins),
+                ('numStepsEvaluated', self.numStepsEvaluated, self.countBins),
+                ('bestSimilarity', self.bestSimilarity, self.similarityBins),
+                ('similarityBound', self.similarityBound, self.similarityBins),
+                ('seconds', self.elapsed, self.timeBins)]
+            for (name, values, bins) in histograms:
+                f.write("\n# Histogram of %s\n" % name)
+                f.write("%s_upper count matched seconds\n" % name)
+                for (upper, count, matched, elapsed) in self.makeHistogram(values, bins):
+                    f.write("%g %d %d %.6f\n" % (upper, count, matched, elapsed))
+
+
+def writeMatchedShadows(filename, matchedRowsList, matchedColsList, shape, fileSize, 
+        proj, geotrans):
+    """
+    Write the interim shadow mask file, from the lists of matched shadow pixel
+    indexes. The mask covers an image of the given shape (nrows, ncols), written 
+    to a file of the given fileSize (xsize, ysize). The shadows are not buffered
+    here, that is done in :func:`maskAndBuffer`. 
+    
+    The mask is made and written in strips, so the whole image is never held 
+    in memory. 
+    
+    """
+    (nrows, ncols) = shape
+    (xsize, ysize) = fileSize
+    if len(matchedRowsList) > 0:
+        matchedRows = numpy.concatenate(matchedRowsList)
+        matchedCols = numpy.concatenate(matchedColsList)
+    else:
+        matchedRows = numpy.zeros(0, dtype=numpy.int64)
+        matchedCols = numpy.zeros(0, dtype=numpy.int64)
+    sortNdx = numpy.argsort(matchedRows)
+    matchedRows = matchedRows[sortNdx]
+    matchedCols = matchedCols[sortNdx]
+    del sortNdx
+    
+    driver = gdal.GetDriverByName(applier.DEFAULTDRIVERNAME)
+    creationOptions = applier.dfltDriverOptions[applier.DEFAULTDRIVERNAME]
+    ds = driver.Create(filename, xsize, ysize, 1, gdal.GDT_Byte,
+                creationOptions)
+    ds.SetProjection(proj)
+    ds.SetGeoTransform(geotrans)
+    band = ds.GetRasterBand(1)
+    
+    for row0 in range(0, nrows, RIOS_WINDOW_SIZE):
+        row1 = min(row0 + RIOS_WINDOW_SIZE, nrows)
+        strip = numpy.zeros((row1 - row0, ncols), dtype=numpy.uint8)
+        (i0, i1) = numpy.searchsorted(matchedRows, [row0, row1])
+        strip[matchedRows[i0:i1] - row0, matchedCols[i0:i1]] = 1
+        band.WriteArray(strip, 0, row0)
+    del ds
+
+
+#: Name to use with :meth:`fmask.config.FmaskConfig.setGdalDriverName`, to write
+#: the final output as a Cloud Optimised GeoTIFF
+COG_DRIVER_NAME = 'COG'
+# Options for the temporary tiled GTiff, and for copying it to a COG, with 
+# either the COG driver or the GTiff driver
+COG_TEMP_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 
+    'COMPRESS=DEFLATE']
+COG_CREATION_OPTIONS = ['BLOCKSIZE=512', 'COMPRESS=DEFLATE', 
+    'OVERVIEWS=FORCE_USE_EXISTING']
+COG_GTIFF_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 
+    'COMPRESS=DEFLATE', 'COPY_SRC_OVERVIEWS=YES']
+
+
 def finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask, 
-        pass1file):
+        pass1file, blockMap=None):
     """
     Use the cloud and shadow masks to mask the snow layer (as per Zhu & Woodcock). 
-    Apply the optional extra buffer to the cloud mask, and write to final file. 
+    Apply the optional extra buffer to the cloud mask, and the buffer to the
+    shadow mask, and write to final file. 
+    
+    The interimShadowmask may be None, if the shadow stages were skipped, in 
+    which case there is no shadow. 
     """
     infiles = applier.FilenameAssociations()
     outfiles = applier.FilenameAssociations()
@@ -1196,39 +2268,175 @@ def finalizeAll(fmaskFilenames, fmaskConfig, interimCloudmask, interimShadowmask
     controls = applier.ApplierControls()
     
     infiles.cloud = interimCloudmask
-    infiles.shadow = interimShadowmask
+    if interimShadowmask is not None:
+        infiles.shadow = interimShadowmask
     infiles.pass1 = pass1file
     outfiles.out = fmaskFilenames.outputMask
-    controls.setOverlap(fmaskConfig.cloudBufferSize)
+    cogOutput = (fmaskConfig.gdalDriverName == COG_DRIVER_NAME)
+    if cogOutput:
+        # RIOS cannot write COG directly, so write a tiled GTiff in memory, with
+        # its overviews, and copy that to the final file at the end. 
+        outfiles.out = '/vsimem/fmask_{}_final.tif'.format(os.getpid())
+    # Enough overlap for both buffers
+    overlap = max(fmaskConfig.cloudBufferSize, fmaskConfig.shadowBufferSize, 0)
+    controls.setOverlap(overlap)
     controls.setThematic(True)
     controls.setStatsIgnore(OUTCODE_NULL)
     controls.setWindowXsize(RIOS_WINDOW_SIZE)
     controls.setWindowYsize(RIOS_WINDOW_SIZE)
-    controls.setOutputDriverName(fmaskConfig.gdalDriverName)
+    if cogOutput:
+        controls.setOutputDriverName('GTiff')
+        controls.setCreationOptions(COG_TEMP_CREATION_OPTIONS)
+    else:
+        controls.setOutputDriverName(fmaskConfig.gdalDriverName)
     
-    if fmaskConfig.cloudBufferSize > 0:
-        otherargs.bufferkernel = makeBufferKernel(fmaskConfig.cloudBufferSize)
+    otherargs.cloudBufferSize = fmaskConfig.cloudBufferSize
+    otherargs.shadowBufferSize = fmaskConfig.shadowBufferSize
+    otherargs.overlap = overlap
+    otherargs.blockMap = blockMap
+    otherargs.haveShadow = (interimShadowmask is not None)
+    pass1Info = fileinfo.ImageInfo(pass1file)
+    otherargs.classStats = FmaskClassStats(pass1Info.nrows, pass1Info.ncols, 
+        fmaskConfig.classStatsCellSize)
 
-    applier.apply(maskAndBuffer, infiles, outfiles, otherargs, controls=controls)
+    try:
+        applier.apply(maskAndBuffer, infiles, outfiles, otherargs, controls=controls)
     
-    rat.setColorTable(outfiles.out, numpy.array([[2, 255, 0, 255, 255],
-                                                 [3, 255, 255, 0, 255],
-                                                 [4, 85, 255, 255, 255],
-                                                 [5, 0, 0, 255, 255]]))
+        rat.setColorTable(outfiles.out, numpy.array([[2, 255, 0, 255, 255],
+                                                     [3, 255, 255, 0, 255],
+                                                     [4, 85, 255, 255, 255],
+                                                     [5, 0, 0, 255, 255]]))
     
-    try:
-        rat.writeColumn(outfiles.out, "Classification", [b"Null", b"Valid", b"Cloud", 
-                                                    b"Cloud Shadow", b"Snow", b"Water"])
-    except Exception:
-        # Failed to write the RAT, probably because the selected format does not support it. 
-        # Just ignore it silently
-        pass
+        try:
+            rat.writeColumn(outfiles.out, "Classification", [b"Null", b"Valid", b"Cloud", 
+                                                        b"Cloud Shadow", b"Snow", b"Water"])
+        except Exception:
+            # Failed to write the RAT, probably because the selected format does not support it. 
+            # Just ignore it silently
+            pass
+    
+        if cogOutput:
+            writeCOG(outfiles.out, fmaskFilenames.outputMask)
+    finally:
+        if cogOutput and gdal.VSIStatL(outfiles.out) is not None:
+            # Deleting through the driver also removes the .aux.xml sidecar
+            gdal.GetDriverByName('GTiff').Delete(outfiles.out)
+    
+    if fmaskFilenames.classStats is not None:
+        otherargs.classStats.writeJSON(fmaskFilenames.classStats)
+    
+    return otherargs.classStats
+
+
+class FmaskClassStats(object):
+    """
+    Counts of the pixels of each class in the final output mask, collected by
+    :func:`maskAndBuffer` as the mask is written, so the mask need not be read 
+    again. The counts array is indexed by the OUTCODE_* values. 
+    
+    If cellSize (in pixels) is given, the counts are also kept for each cell
+    of a grid of that size over the image, in cellCounts, with shape 
+    (numCellRows, numCellCols, NUM_OUTCODES). 
+    
+    """
+    classNames = ['null', 'clear', 'cloud', 'shadow', 'snow', 'water']
+    
+    def __init__(self, nrows, ncols, cellSize=None):
+        self.shape = (nrows, ncols)
+        self.counts = numpy.zeros(NUM_OUTCODES, dtype=numpy.int64)
+        self.cellSize = cellSize
+        self.cellCounts = None
+        if cellSize is not None:
+            numCellRows = int(numpy.ceil(nrows / cellSize))
+            numCellCols = int(numpy.ceil(ncols / cellSize))
+            self.cellCounts = numpy.zeros((numCellRows, numCellCols, NUM_OUTCODES), 
+                dtype=numpy.int64)
+    
+    def addBlock(self, out, row0, col0):
+        """
+        Add the counts for a block of the output mask, whose top-left pixel
+        is at (row0, col0) in the whole image. 
+        
+        """
+        # Anything beyond the image is just padding
+        (nrows, ncols) = (min(out.shape[0], self.shape[0] - row0), 
+            min(out.shape[1], self.shape[1] - col0))
+        out = out[:nrows, :ncols]
+        self.counts += numpy.bincount(out.ravel(), minlength=NUM_OUTCODES)[:NUM_OUTCODES]
+        
+        if self.cellCounts is not None:
+            # Cells touched by this block, relative to the first one
+            cellRows = (numpy.arange(row0, row0 + nrows) // self.cellSize)
+            cellCols = (numpy.arange(col0, col0 + ncols) // self.cellSize)
+            (cellRow0, cellCol0) = (cellRows[0], cellCols[0])
+            numCellRows = cellRows[-1] - cellRow0 + 1
+            numCellCols = cellCols[-1] - cellCol0 + 1
+            ndx = ((cellRows[:, numpy.newaxis] - cellRow0) * numCellCols + 
+                (cellCols[numpy.newaxis, :] - cellCol0)) * NUM_OUTCODES
+            ndx = ndx + out
+            numBins = numCellRows * numCellCols * NUM_OUTCODES
+            blockCellCounts = numpy.bincount(ndx.ravel(), minlength=numBins)
+            self.cellCounts[cellRow0:cellRow0+numCellRows, cellCol0:cellCol0+numCellCols] += (
+                blockCellCounts.reshape((numCellRows, numCellCols, NUM_OUTCODES)))
+    
+    def percentages(self):
+        """
+        Return a dictionary of the percentage of each class (except null), 
+        as a percentage of all non-null pixels. 
+        
+        """
+        numValid = self.counts[OUTCODE_NULL+1:].sum()
+        pcntDict = {}
+        for code in range(OUTCODE_NULL+1, NUM_OUTCODES):
+            pcnt = 0.0
+            if numValid > 0:
+                pcnt = 100.0 * self.counts[code] / numValid
+            pcntDict[self.classNames[code]] = pcnt
+        return pcntDict
+    
+    def toDict(self):
+        """
+        Return everything as a dictionary, suitable for JSON
+        """
+        d = {'counts': dict([(name, int(n)) for (name, n) in zip(self.classNames, self.counts)]),
+            'percentages': self.percentages()}
+        if self.cellCounts is not None:
+            d['cellSize'] = self.cellSize
+            d['classNames'] = self.classNames
+            d['cellCounts'] = self.cellCounts.tolist()
+        return d
+    
+    def writeJSON(self, filename):
+        """
+        Write to the given file, as JSON
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.toDict(), f, indent=1)
+
+
+def writeCOG(srcFile, outFile):
+    """
+    Copy the srcFile, which must already be tiled and have its overviews, with
+    its colour table and RAT, to a Cloud Optimised GeoTIFF. This uses the COG 
+    driver if it is available (GDAL >= 3.1), otherwise the GTiff driver with 
+    the same layout. 
+    
+    """
+    srcDS = gdal.Open(srcFile)
+    driver = gdal.GetDriverByName(COG_DRIVER_NAME)
+    if driver is not None:
+        options = COG_CREATION_OPTIONS
+    else:
+        driver = gdal.GetDriverByName('GTiff')
+        options = COG_GTIFF_CREATION_OPTIONS
+    outDS = driver.CreateCopy(outFile, srcDS, options=options)
+    del outDS, srcDS
 
 def maskAndBuffer(info, inputs, outputs, otherargs):
     """
     Called from RIOS
     
-    Apply cloud and shadow masks to snow layer, and buffer cloud layer
+    Apply cloud and shadow masks to snow layer, and buffer cloud and shadow layers
     
     The main aims of all this re-masking are:
         1) A pixel should be either cloud, shadow, snow or not, but never 
@@ -1236,20 +2444,61 @@ def maskAndBuffer(info, inputs, outputs, otherargs):
         2) Areas which are null in the input imagery should be null in the 
            mask, even after buffering, etc. 
     
+    Blocks which are all null, or which have no cloud, shadow, snow or water
+    anywhere they could reach, are written directly, without the buffering. 
+    
     """
-    snow = inputs.pass1[5].astype(numpy.bool)
+    overlap = otherargs.overlap
+    shape = inputs.pass1.shape[-2:]
+    window = blockProperWindow(info, shape, overlap)
+    blockMap = otherargs.blockMap
     nullmask = inputs.pass1[4].astype(numpy.bool)
+    
+    out = None
+    if blockMap is not None and blockMap.isAllNull(*window):
+        out = numpy.zeros(shape, dtype=numpy.uint8)
+        out.fill(OUTCODE_NULL)
+    elif (blockMap is not None and not blockMap.anySnow(*window) and 
+            not blockMap.anyWater(*window) and not inputs.cloud[0].any() and 
+            not (otherargs.haveShadow and inputs.shadow[0].any())):
+        out = numpy.where(nullmask, OUTCODE_NULL, OUTCODE_CLEAR).astype(numpy.uint8)
+    
+    if out is None:
+        out = maskAndBufferBlock(inputs, otherargs, nullmask)
+    outputs.out = numpy.array([out])
+    
+    # Count the classes, excluding the overlap, which belongs to other blocks
+    (row0, col0, nrows, ncols) = window
+    otherargs.classStats.addBlock(out[overlap:overlap+nrows, overlap:overlap+ncols], 
+        row0, col0)
+
+
+def maskAndBufferBlock(inputs, otherargs, nullmask):
+    """
+    The full calculation for :func:`maskAndBuffer`, for one block. Returns the 
+    2-d array of output codes. 
+    
+    """
+    snow = inputs.pass1[5].astype(numpy.bool)
     refNullmask = inputs.pass1[6].astype(numpy.bool)
     thermNullmask = inputs.pass1[7].astype(numpy.bool)
     resetNullmask = nullmask
 
     cloud = inputs.cloud[0].astype(numpy.bool)
-    shadow = inputs.shadow[0].astype(numpy.bool)
+    if otherargs.haveShadow:
+        shadow = inputs.shadow[0].astype(numpy.bool)
+    else:
+        shadow = numpy.zeros(cloud.shape, dtype=numpy.bool)
     water = inputs.pass1[1].astype(numpy.bool)
     
     # Buffer the cloud
-    if hasattr(otherargs, 'bufferkernel'):
-        cloud = maximum_filter(cloud, footprint=otherargs.bufferkernel)
+    if otherargs.cloudBufferSize > 0 and cloud.any():
+        cloud = bufferMask(cloud, otherargs.cloudBufferSize)
+    # Buffer the matched shadows, as per section 3.2 (2nd-last paragraph). 
+    # I have the buffer size settable from the commandline, with our default
+    # being larger than the original. 
+    if otherargs.shadowBufferSize > 0 and shadow.any():
+        shadow = bufferMask(shadow, otherargs.shadowBufferSize)
 
     # Mask the shadow, against the buffered cloud, and the nullmask
     shadow[cloud] = False
@@ -1276,5 +2525,5 @@ def maskAndBuffer(info, inputs, outputs, otherargs):
     out[snow] = OUTCODE_SNOW
     out[water] = OUTCODE_WATER
     out[resetNullmask] = outNullval
-    outputs.out = numpy.array([out])
+    return out
     
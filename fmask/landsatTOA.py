@@ -26,7 +26,6 @@ import numpy
 from osgeo import gdal
 gdal.UseExceptions()
 from rios import applier, cuiprogress, fileinfo
-from . import fmask
 from . import config
 
 # Derived by Pete Bunting from 6S
@@ -43,6 +42,9 @@ ESUN_LOOKUP = {'LANDSAT_4' : LANDSAT4_ESUN,
             'LANDSAT_7' : LANDSAT7_ESUN,
             'LANDSAT_8' : LANDSAT8_ESUN}
 
+#: Null value in the output TOA reflectance
+TOA_NULL = 32767
+
 RADIANCE_MULT = 'RADIANCE_MULT_BAND_%d'
 RADIANCE_ADD = 'RADIANCE_ADD_BAND_%d'
 
@@ -113,33 +115,109 @@ def riosTOA(info, inputs, outputs, otherinputs):
     """
     Called from RIOS
     """
-    nbands = inputs.infile.shape[0]
+    outputs.outfile = toaForBlock(inputs.infile, inputs.angles[3], otherinputs)
+
+
+def toaForBlock(radiance, sunZenDN, otherinputs, bandList=None):
+    """
+    Return the int16 TOA reflectance (* 10000) for a block of radiance, given the 
+    sun zenith angle layer of the angles image for the block. The otherinputs
+    are as set by :func:`setTOAOtherinputs`. If bandList is given, only those
+    bands (0-based) are returned, but the null mask still uses all bands. 
+    
+    For 8-bit and 16-bit unsigned input, the radiance part of the calculation 
+    for each band is done once for every possible DN, as a lookup table (see
+    :func:`makeRadianceLUT`), and the cosine of the sun zenith is likewise looked
+    up for each angle value. These give exactly the same results as the direct
+    calculation, which is still used for any other input datatype. 
+    """
+    if bandList is None:
+        bandList = range(radiance.shape[0])
 
-    infile = inputs.infile.astype(numpy.float)
     inIgnore = otherinputs.inNull
     if inIgnore is None:
         inIgnore = 0
 
-    cosSunZen = numpy.cos(inputs.angles[3] * otherinputs.anglesToRadians)
+    useLUT = radiance.dtype in (numpy.uint8, numpy.uint16)
+    if useLUT:
+        minDN = int(sunZenDN.min())
+        cosLUT = numpy.cos(numpy.arange(minDN, int(sunZenDN.max()) + 1) * 
+            otherinputs.anglesToRadians)
+        cosSunZen = cosLUT[sunZenDN.astype(numpy.int64) - minDN]
+    else:
+        infile = radiance.astype(numpy.float64)
+        cosSunZen = numpy.cos(sunZenDN * otherinputs.anglesToRadians)
     
-    nullMask = (inputs.infile == inIgnore).any(axis=0)
+    nullMask = (radiance == inIgnore).any(axis=0)
     
-    toaRefList = []
-    for band in range(nbands):
-        rtoa = infile[band] * otherinputs.gains[band] + otherinputs.offsets[band]
-
-        p = numpy.pi * rtoa * otherinputs.earthSunDistanceSq / (otherinputs.esun[band] * cosSunZen)
+    toa = numpy.empty((len(bandList), ) + radiance.shape[1:], dtype=numpy.int16)
+    for (i, band) in enumerate(bandList):
+        if useLUT:
+            if band not in otherinputs.radianceLUTs:
+                otherinputs.radianceLUTs[band] = makeRadianceLUT(radiance.dtype, 
+                    otherinputs.gains[band], otherinputs.offsets[band], 
+                    otherinputs.earthSunDistanceSq)
+            p = otherinputs.radianceLUTs[band][radiance[band]]
+        else:
+            rtoa = infile[band] * otherinputs.gains[band] + otherinputs.offsets[band]
+            p = numpy.pi * rtoa * otherinputs.earthSunDistanceSq
+        p /= (otherinputs.esun[band] * cosSunZen)
         # clip to a sensible range
         numpy.clip(p, 0.0, 2.0, out=p)
+        p *= 10000.0
+        # convert to int16
+        toa[i] = p
+        # Mask out where input is null
+        toa[i][nullMask] = otherinputs.outNull
+    return toa
 
-        toaRefList.append(p)
 
-    out = numpy.array(toaRefList) * 10000.0
-    # convert to int16 
-    outputs.outfile = out.astype(numpy.int16)
-    # Mask out where input is null
-    for i in range(len(outputs.outfile)):
-        outputs.outfile[i][nullMask] = otherinputs.outNull
+def makeRadianceLUT(dtype, gain, offset, earthSunDistanceSq):
+    """
+    Return a lookup table, for every possible value of the given integer
+    datatype, of pi * L * d^2, where L is the radiance (gain * DN + offset)
+    and d is the earth-sun distance. This is the part of the TOA reflectance 
+    calculation which depends only on the DN, and is calculated exactly 
+    as in :func:`riosTOA`. 
+    """
+    dn = numpy.arange(numpy.iinfo(dtype).max + 1, dtype=numpy.float64)
+    rtoa = dn * gain + offset
+    return numpy.pi * rtoa * earthSunDistanceSq
+
+
+def setTOAOtherinputs(otherinputs, mtlInfo, imginfo, bandNumbers=None):
+    """
+    Set up the given RIOS otherinputs object with everything required by
+    :func:`toaForBlock`, from the dictionary returned by 
+    :func:`fmask.config.readMTLFile`, and the ImageInfo of the radiance image. 
+    Assumes the angles image is scaled as radians*100. 
+    
+    By default, the radiance image is assumed to have all the bands listed in
+    :data:`BAND_NUM_DICT`, in that order. If it has only some of them, 
+    bandNumbers is the list of the MTL band numbers of its layers (see 
+    :func:`fmask.landsatscene.makeReflectiveVRT`). 
+    
+    """
+    spaceCraft = mtlInfo['SPACECRAFT_ID']
+    date = mtlInfo['DATE_ACQUIRED']
+    date = date.replace('-', '')
+    
+    otherinputs.earthSunDistance = earthSunDistance(date)
+    otherinputs.earthSunDistanceSq = otherinputs.earthSunDistance * otherinputs.earthSunDistance
+    otherinputs.esun = ESUN_LOOKUP[spaceCraft]
+    gains, offsets = readGainsOffsets(mtlInfo)
+    if bandNumbers is not None:
+        ndx = [BAND_NUM_DICT[spaceCraft].index(bandNum) for bandNum in bandNumbers]
+        otherinputs.esun = [otherinputs.esun[i] for i in ndx]
+        gains = gains[ndx]
+        offsets = offsets[ndx]
+    otherinputs.gains = gains
+    otherinputs.offsets = offsets
+    otherinputs.anglesToRadians = 0.01
+    otherinputs.outNull = TOA_NULL
+    # Lookup tables for each band, made by toaForBlock() as required
+    otherinputs.radianceLUTs = {}
+    otherinputs.inNull = imginfo.nodataval[0]
 
 
 def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
@@ -164,9 +242,6 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     
     """
     mtlInfo = config.readMTLFile(mtlFile)
-    spaceCraft = mtlInfo['SPACECRAFT_ID']
-    date = mtlInfo['DATE_ACQUIRED']
-    date = date.replace('-', '')
     
     inputs = applier.FilenameAssociations()
     inputs.infile = infile
@@ -176,16 +251,8 @@ def makeTOAReflectance(infile, mtlFile, anglesfile, outfile):
     outputs.outfile = outfile
 
     otherinputs = applier.OtherInputs()
-    otherinputs.earthSunDistance = earthSunDistance(date)
-    otherinputs.earthSunDistanceSq = otherinputs.earthSunDistance * otherinputs.earthSunDistance
-    otherinputs.esun = ESUN_LOOKUP[spaceCraft]
-    gains, offsets = readGainsOffsets(mtlInfo)
-    otherinputs.gains = gains
-    otherinputs.offsets = offsets
-    otherinputs.anglesToRadians = 0.01
-    otherinputs.outNull = 32767
     imginfo = fileinfo.ImageInfo(infile)
-    otherinputs.inNull = imginfo.nodataval[0]
+    setTOAOtherinputs(otherinputs, mtlInfo, imginfo)
 
     controls = applier.ApplierControls()
     controls.progress = cuiprogress.GDALProgressBar()
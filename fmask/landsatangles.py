@@ -63,11 +63,17 @@ from __future__ import print_function, division
 import datetime
 
 import numpy
+from osgeo import gdal
 from osgeo import osr
 
 from rios import applier
 from rios import fileinfo
 
+#: Number of rows or columns read at a time when scanning for the swath corners
+CORNER_STRIP_SIZE = 256
+#: Minimum spacing of the rows sampled for the coarse search for the swath corners
+CORNER_SAMPLE_STEP = 256
+
 def findImgCorners(img, imgInfo):
     """
     Find the corners of the data within the given template image
@@ -75,75 +81,202 @@ def findImgCorners(img, imgInfo):
     Each row is a corner, in the order
         top-left, top-right, bottom-left, bottom-right.
 
-    Uses RIOS to pass through the image searching for non-null data,
-    and find the extremes. Assumes we are working with a full-swathe Landsat
-    image.
+    The top corner is the leftmost non-null pixel of the top row with any data, 
+    and the bottom corner is the leftmost of the bottom row. The left corner is the 
+    topmost non-null pixel of the leftmost column with any data, and the right corner
+    is the topmost of the rightmost column. The coordinates are of the pixel centres. 
+    Only the first band is used to decide which pixels are null. Assumes we are 
+    working with a full-swathe Landsat image, and the logic is very specific to 
+    the orientation of the usual Landsat descending pass imagery. 
+    
+    The search is in two stages, so that normally only a small part of the image 
+    is read. First a coarse image of the non-null area is made (see 
+    :func:`makeCoarseNonnull`), and then, for each corner, only a window of the 
+    full resolution image around the candidate from the coarse image is read. 
+    If a corner falls on the edge of its window, the coarse image was misleading, 
+    and the image is instead scanned inward from each edge, in strips of rows or
+    columns, until some data is found. 
 
     Each list element is a numpy array of (x, y)
 
     """
-    infiles = applier.FilenameAssociations()
-    outfiles = applier.FilenameAssociations()
-    otherargs = applier.OtherInputs()
-
-    infiles.img = img
-    otherargs.tl = None
-    otherargs.tr = None
-    otherargs.bl = None
-    otherargs.br = None
-    otherargs.nullVal = imgInfo.nodataval[0]
-    if otherargs.nullVal is None:
-        otherargs.nullVal = 0
-
-    applier.apply(findCorners, infiles, outfiles, otherargs)
+    nullVal = imgInfo.nodataval[0]
+    if nullVal is None:
+        nullVal = 0
+    
+    ds = gdal.Open(img)
+    band = ds.GetRasterBand(1)
+    (nrows, ncols) = (ds.RasterYSize, ds.RasterXSize)
+    geotrans = ds.GetGeoTransform()
+    
+    def readNonnull(xoff, yoff, xsize, ysize):
+        data = band.ReadAsArray(int(xoff), int(yoff), int(xsize), int(ysize))
+        return (data != nullVal)
+    
+    def findRow(rowOrder):
+        """
+        Search the rows in the given order. Return the (row, col) of the leftmost
+        non-null pixel in the first row with any, or None. 
+        """
+        for i in range(0, nrows, CORNER_STRIP_SIZE):
+            rows = rowOrder[i:i+CORNER_STRIP_SIZE]
+            yoff = rows.min()
+            nonnull = readNonnull(0, yoff, ncols, len(rows))[rows - yoff]
+            rowHasData = nonnull.any(axis=1)
+            if rowHasData.any():
+                j = numpy.argmax(rowHasData)
+                return (rows[j], numpy.argmax(nonnull[j]))
+        return None
+    
+    def findCol(colOrder):
+        """
+        Search the columns in the given order. Return the (row, col) of the topmost
+        non-null pixel in the first column with any, or None. 
+        """
+        for i in range(0, ncols, CORNER_STRIP_SIZE):
+            cols = colOrder[i:i+CORNER_STRIP_SIZE]
+            xoff = cols.min()
+            nonnull = readNonnull(xoff, 0, len(cols), nrows)[:, cols - xoff]
+            colHasData = nonnull.any(axis=0)
+            if colHasData.any():
+                j = numpy.argmax(colHasData)
+                return (numpy.argmax(nonnull[:, j]), cols[j])
+        return None
+    
+    def refineRow(rowLo, rowHi, last):
+        """
+        Read full resolution rows rowLo to rowHi-1, and return the (row, col) of
+        the leftmost non-null pixel in the first (or last) row with any. 
+        Return None if that row is on an edge of the window which is 
+        not an edge of the image. 
+        """
+        nonnull = readNonnull(0, rowLo, ncols, rowHi - rowLo)
+        rowsWithData = numpy.where(nonnull.any(axis=1))[0]
+        if len(rowsWithData) == 0:
+            return None
+        j = rowsWithData[-1] if last else rowsWithData[0]
+        row = rowLo + j
+        if (last and row == rowHi - 1 and rowHi < nrows) or (not last and j == 0 and rowLo > 0):
+            return None
+        return (row, numpy.argmax(nonnull[j]))
+    
+    def refineCol(rowLo, rowHi, colLo, colHi, last):
+        """
+        Read the full resolution window of the given rows and columns, and return
+        the (row, col) of the topmost non-null pixel in the first (or last) column 
+        with any. Return None if that pixel is on an edge of the window which 
+        is not an edge of the image. 
+        """
+        nonnull = readNonnull(colLo, rowLo, colHi - colLo, rowHi - rowLo)
+        colsWithData = numpy.where(nonnull.any(axis=0))[0]
+        if len(colsWithData) == 0:
+            return None
+        j = colsWithData[-1] if last else colsWithData[0]
+        (row, col) = (rowLo + numpy.argmax(nonnull[:, j]), colLo + j)
+        if ((row == rowLo and rowLo > 0) or (nonnull[-1, j] and rowHi < nrows) or
+                (col == colLo and colLo > 0) or (col == colHi - 1 and colHi < ncols)):
+            return None
+        return (row, col)
+    
+    (coarse, rowLo, rowHi, colLo, colHi) = makeCoarseNonnull(band, nrows, ncols, nullVal)
+    numCoarseRows = len(rowLo)
+    numCoarseCols = len(colLo)
+    
+    def rowWindow(i0, i1):
+        """
+        Full resolution rows covered by coarse rows i0 to i1, padded with one 
+        coarse row either side
+        """
+        return (rowLo[max(i0 - 1, 0)], rowHi[min(i1 + 1, numCoarseRows - 1)])
+    
+    def colWindow(j0, j1):
+        """
+        Full resolution columns covered by coarse columns j0 to j1, padded with
+        one coarse column either side
+        """
+        return (colLo[max(j0 - 1, 0)], colHi[min(j1 + 1, numCoarseCols - 1)])
+    
+    top = bottom = left = right = None
+    coarseRows = numpy.where(coarse.any(axis=1))[0]
+    coarseCols = numpy.where(coarse.any(axis=0))[0]
+    if len(coarseRows) > 0:
+        top = refineRow(*rowWindow(coarseRows[0], coarseRows[0]), last=False)
+        bottom = refineRow(*rowWindow(coarseRows[-1], coarseRows[-1]), last=True)
+        
+        # The left corner may lie anywhere left of the coarse leftmost column, 
+        # between the coarse rows which have data near that column. 
+        j = coarseCols[0]
+        c1 = colWindow(j, j)[1]
+        nearRows = numpy.where(coarse[:, :j+2].any(axis=1))[0]
+        (r0, r1) = rowWindow(nearRows[0], nearRows[-1])
+        left = refineCol(r0, r1, 0, c1, last=False)
+        
+        j = coarseCols[-1]
+        (c0, c1) = colWindow(j, j)
+        nearRows = numpy.where(coarse[:, max(j-1, 0):].any(axis=1))[0]
+        (r0, r1) = rowWindow(nearRows[0], nearRows[-1])
+        right = refineCol(r0, r1, c0, ncols, last=True)
+    
+    if top is None:
+        top = findRow(numpy.arange(nrows))
+    if bottom is None:
+        bottom = findRow(numpy.arange(nrows)[::-1])
+    if left is None:
+        left = findCol(numpy.arange(ncols))
+    if right is None:
+        right = findCol(numpy.arange(ncols)[::-1])
+    del band, ds
+    
+    def pixelCentre(rowCol):
+        if rowCol is None:
+            return None
+        (row, col) = rowCol
+        x = geotrans[0] + (col + 0.5) * geotrans[1]
+        y = geotrans[3] + (row + 0.5) * geotrans[5]
+        return (x, y)
 
     corners = numpy.array([
-        otherargs.tl,
-        otherargs.tr,
-        otherargs.bl,
-        otherargs.br,
+        pixelCentre(top),
+        pixelCentre(right),
+        pixelCentre(left),
+        pixelCentre(bottom),
     ])
     return corners
 
 
-def findCorners(info, inputs, outputs, otherargs):
+def makeCoarseNonnull(band, nrows, ncols, nullVal):
     """
-    Called from RIOS
-
-    Checks non-null area of image block. Finds extremes, records coords
-    of extremes against those already in otherargs.
-
-    Note that the logic is very specific to the orientation of the usual Landsat
-    descending pass imagery. The same logic should not be applied to swathes
-    oriented in other, e.g. for other satellites.
-
+    Make a coarse boolean image of the non-null area of the given band, for 
+    a first search for the swath corners. Return a tuple
+        (coarse, rowLo, rowHi, colLo, colHi)
+    where coarse[i, j] stands for the full resolution rows rowLo[i] to rowHi[i]-1, 
+    and columns colLo[j] to colHi[j]-1. 
+    
+    If the band has overviews, this is the smallest of them. Otherwise it is 
+    a sample of whole rows at full resolution, spaced at least 
+    :data:`CORNER_SAMPLE_STEP` rows and four blocks apart, which is cheap to 
+    read from a strip-organised file. 
+    
     """
-    (xblock, yblock) = info.getBlockCoordArrays()
-
-    nonnull = (inputs.img != otherargs.nullVal).all(axis=0)
-
-    xNonnull = xblock[nonnull]
-    yNonnull = yblock[nonnull]
-
-    if len(xNonnull) > 0:
-        topNdx = numpy.argmax(yNonnull)
-        topXY = (xNonnull[topNdx], yNonnull[topNdx])
-        leftNdx = numpy.argmin(xNonnull)
-        leftXY = (xNonnull[leftNdx], yNonnull[leftNdx])
-        bottomNdx = numpy.argmin(yNonnull)
-        bottomXY = (xNonnull[bottomNdx], yNonnull[bottomNdx])
-        rightNdx = numpy.argmax(xNonnull)
-        rightXY = (xNonnull[rightNdx], yNonnull[rightNdx])
-
-        # If these are more extreme than those already in otherargs, replace them
-        if otherargs.tl is None or topXY[1] > otherargs.tl[1]:
-            otherargs.tl = topXY
-        if otherargs.tr is None or rightXY[0] > otherargs.tr[0]:
-            otherargs.tr = rightXY
-        if otherargs.bl is None or leftXY[0] < otherargs.bl[0]:
-            otherargs.bl = leftXY
-        if otherargs.br is None or bottomXY[1] < otherargs.br[1]:
-            otherargs.br = bottomXY
+    numOverviews = band.GetOverviewCount()
+    if numOverviews > 0:
+        overviews = [band.GetOverview(i) for i in range(numOverviews)]
+        ovBand = min(overviews, key=lambda ov: ov.XSize)
+        coarse = (ovBand.ReadAsArray() != nullVal)
+        (ovNrows, ovNcols) = coarse.shape
+        rowEdges = (numpy.arange(ovNrows + 1) * nrows) // ovNrows
+        colEdges = (numpy.arange(ovNcols + 1) * ncols) // ovNcols
+        return (coarse, rowEdges[:-1], rowEdges[1:], colEdges[:-1], colEdges[1:])
+    
+    blockYsize = band.GetBlockSize()[1]
+    step = max(CORNER_SAMPLE_STEP, 4 * blockYsize)
+    sampleRows = numpy.arange(0, nrows, step)
+    if sampleRows[-1] != nrows - 1:
+        sampleRows = numpy.append(sampleRows, nrows - 1)
+    coarse = numpy.vstack([band.ReadAsArray(0, int(row), ncols, 1) != nullVal 
+        for row in sampleRows])
+    cols = numpy.arange(ncols)
+    return (coarse, sampleRows, sampleRows + 1, cols, cols + 1)
 
 
 def findNadirLine(corners):
@@ -306,6 +439,13 @@ def sunAnglesForPoints(latDeg, longDeg, hourGMT, jdp):
     return (sunAz, sunZen)
 
 
+#: Landsat nominal altitude in metres
+LANDSAT_ALTITUDE = 705000
+#: Angles image pixel values are (radians * ANGLES_RADIAN_SCALE)
+ANGLES_RADIAN_SCALE = 100
+#: Value ignored in statistics of the angles image
+ANGLES_NULL = 500
+
 def makeAnglesImage(templateimg, outfile, nadirLine, extentSunAngles, satAzimuth, imgInfo):
     """
     Make a single output image file of the sun and satellite angles for every
@@ -322,6 +462,20 @@ def makeAnglesImage(templateimg, outfile, nadirLine, extentSunAngles, satAzimuth
     infiles.img = templateimg
     outfiles.angles = outfile
 
+    setAnglesOtherargs(otherargs, imgInfo, nadirLine, extentSunAngles, satAzimuth)
+    controls.setStatsIgnore(ANGLES_NULL)
+    # The template image only defines the pixel grid, so just read one layer of it
+    controls.selectInputImageLayers([1], imagename='img')
+
+    applier.apply(makeAngles, infiles, outfiles, otherargs, controls=controls)
+
+
+def setAnglesOtherargs(otherargs, imgInfo, nadirLine, extentSunAngles, satAzimuth):
+    """
+    Set up the given RIOS otherargs object with everything required by 
+    :func:`makeAnglesForBlock`, for an image with the given ImageInfo. 
+    
+    """
     (ctrLat, ctrLong) = getCtrLatLong(imgInfo)
     otherargs.R = localRadius(ctrLat)
     otherargs.nadirLine = nadirLine
@@ -330,12 +484,52 @@ def makeAnglesImage(templateimg, outfile, nadirLine, extentSunAngles, satAzimuth
     otherargs.yMin = imgInfo.yMin
     otherargs.yMax = imgInfo.yMax
     otherargs.extentSunAngles = extentSunAngles
-    otherargs.satAltitude = 705000      # Landsat nominal altitude in metres
+    otherargs.satAltitude = LANDSAT_ALTITUDE
     otherargs.satAzimuth = satAzimuth
-    otherargs.radianScale = 100        # Store pixel values as (radians * radianScale)
-    controls.setStatsIgnore(500)
+    otherargs.radianScale = ANGLES_RADIAN_SCALE
+
+    # The largest distance from the nadir line is at a corner of the extent
+    (b, m) = nadirLine
+    cornerX = numpy.array([imgInfo.xMin, imgInfo.xMax, imgInfo.xMin, imgInfo.xMax])
+    cornerY = numpy.array([imgInfo.yMax, imgInfo.yMax, imgInfo.yMin, imgInfo.yMin])
+    maxDist = numpy.absolute((m * cornerX - cornerY + b) / numpy.sqrt(m**2 + 1)).max()
+    otherargs.satZenithBreaks = satZenithDNBreaks(maxDist, otherargs.R, 
+        otherargs.satAltitude, otherargs.radianScale)
 
-    applier.apply(makeAngles, infiles, outfiles, otherargs, controls=controls)
+
+def satZenithDN(dist, R, satAltitude, radianScale):
+    """
+    The satellite zenith, as an output pixel value (i.e. rounded radians * radianScale), 
+    for the given distance(s) from the nadir line. See :func:`satAnglesForPoints`. 
+    """
+    satZenith = numpy.arctan(dist / satAltitude) + numpy.arctan(dist / R)
+    return numpy.round(satZenith * radianScale)
+
+
+def satZenithDNBreaks(maxDist, R, satAltitude, radianScale):
+    """
+    Return an array of the distances from the nadir line at which the satellite 
+    zenith pixel value steps up by one, up to maxDist. Element i is the smallest
+    distance with a value greater than i, so the value for any distance is the number
+    of breaks less than or equal to it. These are found by bisection, to the 
+    nearest representable distance, so the values are exactly as given by
+    :func:`satZenithDN`. 
+    
+    """
+    maxDN = int(satZenithDN(maxDist, R, satAltitude, radianScale))
+    breaks = []
+    for dn in range(1, maxDN + 1):
+        (lo, hi) = (0.0, float(maxDist))
+        while numpy.nextafter(lo, hi) < hi:
+            mid = lo + (hi - lo) / 2
+            if mid <= lo or mid >= hi:
+                mid = numpy.nextafter(lo, hi)
+            if satZenithDN(mid, R, satAltitude, radianScale) >= dn:
+                hi = mid
+            else:
+                lo = mid
+        breaks.append(hi)
+    return numpy.array(breaks)
 
 
 def makeAngles(info, inputs, outputs, otherargs):
@@ -345,35 +539,108 @@ def makeAngles(info, inputs, outputs, otherargs):
     Make 4-layer sun and satellite angles for the image block
 
     """
-    (xblock, yblock) = info.getBlockCoordArrays()
+    (nrows, ncols) = inputs.img.shape[-2:]
+    outputs.angles = makeAnglesForBlock(info, nrows, ncols, otherargs)
+
+
+def makeAnglesForBlock(info, nrows, ncols, otherargs):
+    """
+    Return the 4-layer int16 array of sun and satellite angles for the current
+    block, of the given shape. The otherargs are as set by :func:`setAnglesOtherargs`. 
+
+    Both the distance from the nadir line, and the bilinear interpolation of the 
+    sun angles, are linear in x and y, so they are built from 1-d vectors of 
+    the x coordinates of the columns and the y coordinates of the rows, rather
+    than full 2-d coordinate arrays. The satellite zenith is monotonic in the
+    distance from the nadir line, and so is looked up from the distances at 
+    which its value steps (see :func:`satZenithDNBreaks`). Each layer is 
+    written straight into the int16 output. 
+
+    """
+    (xres, yres) = info.getPixelSize()
+    tl = info.blocktl
+    # Coordinates of the pixel centres
+    x = tl.x + xres / 2.0 + xres * numpy.arange(ncols)
+    y = tl.y - yres / 2.0 - yres * numpy.arange(nrows)
+    radianScale = otherargs.radianScale
+
+    angles = numpy.empty((4, nrows, ncols), dtype=numpy.int16)
+
     # Nadir line coefficients of y=mx+b
     (b, m) = otherargs.nadirLine
+    # Signed distance from the nadir line, and which side of it we are on
+    mx = m * x
+    dist = numpy.absolute((mx[numpy.newaxis, :] - y[:, numpy.newaxis] + b) / 
+        numpy.sqrt(m**2 + 1))
+    mxb = mx + b
+    isLeft = (y[:, numpy.newaxis] - mxb[numpy.newaxis, :]) > 0
+    
+    (satAzimuthLeft, satAzimuthRight) = otherargs.satAzimuth
+    angles[0] = numpy.round(satAzimuthRight * radianScale)
+    angles[0][isLeft] = numpy.round(satAzimuthLeft * radianScale)
+    angles[1] = numpy.searchsorted(otherargs.satZenithBreaks, dist, side='right')
+    del dist, isLeft
+
+    # Interpolate the sun angles from those calculated at the corners of the whole raster extent
+    p = (y - otherargs.yMin) / (otherargs.yMax - otherargs.yMin)
+    q = (x - otherargs.xMin) / (otherargs.xMax - otherargs.xMin)
+    for (layer, cornerVals) in [(2, otherargs.extentSunAngles[:, 0]), 
+            (3, otherargs.extentSunAngles[:, 1])]:
+        (tlVal, trVal, blVal, brVal) = cornerVals * radianScale
+        topVals = trVal * q + tlVal * (1 - q)
+        bottomVals = brVal * q + blVal * (1 - q)
+        vals = (p[:, numpy.newaxis] * topVals[numpy.newaxis, :] + 
+            (1 - p)[:, numpy.newaxis] * bottomVals[numpy.newaxis, :])
+        angles[layer] = numpy.round(vals)
+
+    return angles
+
+
+def satAnglesForPoints(x, y, nadirLine, satAzimuthLeftRight, R, satAltitude):
+    """
+    Calculate the satellite azimuth and zenith for the given (x, y) coordinates 
+    (which may be arrays), from the nadir line and satellite azimuths (see 
+    :func:`findNadirLine` and :func:`satAzLeftRight`), the local earth radius R 
+    (see :func:`localRadius`) and the satellite altitude (in metres). 
+
+    Return a tuple of (satAzimuth, satZenith), in radians. 
+
+    """
+    # Nadir line coefficients of y=mx+b
+    (b, m) = nadirLine
 
     # Distance of each pixel from the nadir line
-    dist = numpy.absolute((m * xblock - yblock + b) / numpy.sqrt(m**2 + 1))
+    dist = numpy.absolute((m * x - y + b) / numpy.sqrt(m**2 + 1))
 
     # Zenith angle assuming a flat earth
-    satZenith = numpy.arctan(dist / otherargs.satAltitude)
+    satZenith = numpy.arctan(dist / satAltitude)
 
     # Adjust satZenith for earth curvature. This is a very simple approximation, but
     # the adjustment is less than one degree anyway, so this is accurate enough.
-    curveAngle = numpy.arctan(dist / otherargs.R)
+    curveAngle = numpy.arctan(dist / R)
     satZenith += curveAngle
 
     # Work out whether we are left or right of the nadir line
-    isLeft = (yblock - (m * xblock + b)) > 0
-    (satAzimuthLeft, satAzimuthRight) = otherargs.satAzimuth
+    isLeft = (y - (m * x + b)) > 0
+    (satAzimuthLeft, satAzimuthRight) = satAzimuthLeftRight
     satAzimuth = numpy.where(isLeft, satAzimuthLeft, satAzimuthRight)
 
-    # Interpolate the sun angles from those calculated at the corners of the whole raster extent
-    (xMin, xMax, yMin, yMax) = (otherargs.xMin, otherargs.xMax, otherargs.yMin, otherargs.yMax)
-    sunAzimuth = bilinearInterp(xMin, xMax, yMin, yMax, otherargs.extentSunAngles[:, 0], xblock, yblock)
-    sunZenith = bilinearInterp(xMin, xMax, yMin, yMax, otherargs.extentSunAngles[:, 1], xblock, yblock)
+    return (satAzimuth, satZenith)
+
 
-    angleStack = numpy.array([satAzimuth, satZenith, sunAzimuth, sunZenith])
-    angleStackDN = angleStack * otherargs.radianScale
+def sunAnglesInterp(extent, extentSunAngles, x, y):
+    """
+    Interpolate the sun azimuth and zenith at the given (x, y) coordinates, from
+    those calculated at the corners of the raster extent (see :func:`sunAnglesForExtent`).
+    The extent is a tuple of (xMin, xMax, yMin, yMax). 
+
+    Return a tuple of (sunAzimuth, sunZenith), in radians. 
 
-    outputs.angles = numpy.round(angleStackDN).astype(numpy.int16)
+    """
+    (xMin, xMax, yMin, yMax) = extent
+    sunAzimuth = bilinearInterp(xMin, xMax, yMin, yMax, extentSunAngles[:, 0], x, y)
+    sunZenith = bilinearInterp(xMin, xMax, yMin, yMax, extentSunAngles[:, 1], x, y)
+    return (sunAzimuth, sunZenith)
 
 
 def bilinearInterp(xMin, xMax, yMin, yMax, cornerVals, x, y):
@@ -0,0 +1,134 @@
+"""
+Single-pass preparation of the inputs to fmask for a USGS Landsat scene.
+
+From the stack of reflective radiance bands and the MTL file, this makes
+the TOA reflectance image, the saturation mask and the angles image,
+in a single read through the radiance stack, with the MTL file read once.
+The outputs are the same as those from :func:`fmask.landsatTOA.makeTOAReflectance`,
+:func:`fmask.saturationcheck.makeSaturationMask` and
+:func:`fmask.landsatangles.makeAnglesImage`.
+
+"""
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+from osgeo import gdal
+gdal.UseExceptions()
+from rios import applier, cuiprogress, fileinfo
+
+from . import config
+from . import fmaskerrors
+from . import landsatangles
+from . import landsatTOA
+from . import saturationcheck
+
+
+def sensorFromMTL(mtlInfo):
+    """
+    Return the fmask sensor (e.g. :data:`fmask.config.FMASK_LANDSAT8`) for the
+    dictionary returned by :func:`fmask.config.readMTLFile`.
+
+    """
+    landsat = mtlInfo['SPACECRAFT_ID'][-1]
+    if landsat in ('4', '5', '7'):
+        sensor = config.FMASK_LANDSAT47
+    elif landsat == '8':
+        sensor = config.FMASK_LANDSAT8
+    else:
+        msg = 'Unsupported Landsat sensor: {}'.format(mtlInfo['SPACECRAFT_ID'])
+        raise fmaskerrors.FmaskNotSupportedError(msg)
+    return sensor
+
+
+def makeLandsatInputs(radianceFile, mtlFile, toaFile, saturationFile, anglesFile):
+    """
+    Make the TOA reflectance, saturation mask and angles images from the
+    given radiance stack and MTL file, reading the radiance only once. Any of
+    the output filenames may be None, in which case that output is not made.
+
+    The swath corners for the angles are found first (see
+    :func:`fmask.landsatangles.findImgCorners`), which normally reads only
+    the edges of the radiance image.
+
+    """
+    mtlInfo = config.readMTLFile(mtlFile)
+    imgInfo = fileinfo.ImageInfo(radianceFile)
+
+    infiles = applier.FilenameAssociations()
+    outfiles = applier.FilenameAssociations()
+    otherargs = applier.OtherInputs()
+    controls = applier.ApplierControls()
+    controls.progress = cuiprogress.GDALProgressBar()
+
+    infiles.radiance = radianceFile
+    if toaFile is not None:
+        outfiles.toa = toaFile
+    if saturationFile is not None:
+        outfiles.saturation = saturationFile
+    if anglesFile is not None:
+        outfiles.angles = anglesFile
+    otherargs.makeTOA = (toaFile is not None)
+    otherargs.makeSaturation = (saturationFile is not None)
+    otherargs.makeAngles = (anglesFile is not None)
+
+    # Angles are needed for the TOA reflectance, even if not written out
+    corners = landsatangles.findImgCorners(radianceFile, imgInfo)
+    nadirLine = landsatangles.findNadirLine(corners)
+    extentSunAngles = landsatangles.sunAnglesForExtent(imgInfo, mtlInfo)
+    satAzimuth = landsatangles.satAzLeftRight(nadirLine)
+    landsatangles.setAnglesOtherargs(otherargs, imgInfo, nadirLine, extentSunAngles,
+        satAzimuth)
+
+    landsatTOA.setTOAOtherinputs(otherargs, mtlInfo, imgInfo)
+
+    fmaskConfig = config.FmaskConfig(sensorFromMTL(mtlInfo))
+    otherargs.radianceBands = fmaskConfig.bands
+
+    if toaFile is not None:
+        controls.setStatsIgnore(landsatTOA.TOA_NULL, imagename='toa')
+        controls.setCalcStats(False, imagename='toa')
+    if anglesFile is not None:
+        controls.setStatsIgnore(landsatangles.ANGLES_NULL, imagename='angles')
+
+    applier.apply(riosLandsatInputs, infiles, outfiles, otherargs, controls=controls)
+
+    if toaFile is not None:
+        # Explicitly set the null value in the output
+        ds = gdal.Open(toaFile, gdal.GA_Update)
+        for i in range(ds.RasterCount):
+            ds.GetRasterBand(i+1).SetNoDataValue(landsatTOA.TOA_NULL)
+        del ds
+
+
+def riosLandsatInputs(info, inputs, outputs, otherargs):
+    """
+    Called from RIOS. Makes whichever of the outputs are required, from
+    the same block of radiance.
+
+    """
+    radiance = inputs.radiance
+    (nrows, ncols) = radiance.shape[-2:]
+
+    angles = landsatangles.makeAnglesForBlock(info, nrows, ncols, otherargs)
+    if otherargs.makeAngles:
+        outputs.angles = angles
+    if otherargs.makeTOA:
+        outputs.toa = landsatTOA.toaForBlock(radiance, angles[3], otherargs)
+    if otherargs.makeSaturation:
+        outputs.saturation = saturationcheck.saturationForBlock(radiance,
+            otherargs.radianceBands)
@@ -0,0 +1,117 @@
+"""
+Direct use of the per-band GeoTIFF files of a USGS Landsat scene, as
+distributed, without first stacking them into new files.
+
+A VRT is made (in GDAL's in-memory filesystem) over only those reflective
+bands which fmask actually uses, and the thermal band is read directly
+from its own file. The reflective VRT is then used as the radiance input
+(see :meth:`fmask.config.FmaskFilenames.setRadianceFile`), and the TOA
+reflectance is calculated on the fly.
+
+"""
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+import os
+import glob
+
+from osgeo import gdal
+gdal.UseExceptions()
+
+from . import config
+from . import fmaskerrors
+from . import landsatTOA
+
+# MTL keys for the name of each band's file. The first is the newer format, the
+# second the oldest format (where e.g. band 6_VCID_1 is just 61)
+FILE_NAME_KEY = 'FILE_NAME_BAND_%s'
+OLD_FILE_NAME_KEY = 'BAND%s_FILE_NAME'
+
+
+def findMTLFile(sceneDir):
+    """
+    Return the name of the .MTL file for a scene. The sceneDir may be either
+    the directory containing the unpacked scene, or the .MTL file itself.
+
+    """
+    if os.path.isfile(sceneDir):
+        return sceneDir
+
+    mtlList = glob.glob(os.path.join(sceneDir, '*_MTL.txt'))
+    if len(mtlList) != 1:
+        msg = 'Expected exactly one *_MTL.txt file in {}, found {}'.format(sceneDir,
+            len(mtlList))
+        raise fmaskerrors.FmaskFileError(msg)
+    return mtlList[0]
+
+
+def bandFilename(mtlFile, mtlInfo, bandNum):
+    """
+    Return the full path of the GeoTIFF file for the given band number (a
+    string or int, as used in the MTL keys, e.g. '6_VCID_1'). The files are
+    assumed to be in the same directory as the .MTL file.
+
+    """
+    bandNum = str(bandNum)
+    key = FILE_NAME_KEY % bandNum
+    if key not in mtlInfo:
+        key = OLD_FILE_NAME_KEY % bandNum.replace('_VCID_', '')
+    if key not in mtlInfo:
+        msg = 'No file name for band {} in {}'.format(bandNum, mtlFile)
+        raise fmaskerrors.FmaskFileError(msg)
+
+    sceneDir = os.path.dirname(os.path.abspath(mtlFile))
+    return os.path.join(sceneDir, mtlInfo[key])
+
+
+def makeReflectiveVRT(mtlFile, fmaskConfig, reflectiveVRT):
+    """
+    Make a VRT file of the reflective bands of the scene which fmask uses
+    (as given in fmaskConfig.bands), with the usual stack order. This would
+    normally be on GDAL's in-memory filesystem, e.g. '/vsimem/ref.vrt'.
+
+    The band indexes in fmaskConfig are updated (see
+    :meth:`fmask.config.FmaskConfig.setReflectiveBand`) to match the VRT,
+    as it skips any unused bands (e.g. the Landsat-8 coastal band).
+
+    Returns a tuple of
+        (bandNumbers, thermalFile)
+    where bandNumbers is the list of MTL band numbers of the layers of the VRT
+    (as required by :meth:`fmask.config.FmaskFilenames.setRadianceFile`), and
+    thermalFile is the name of the GeoTIFF of the thermal band.
+
+    """
+    mtlInfo = config.readMTLFile(mtlFile)
+    spaceCraft = mtlInfo['SPACECRAFT_ID']
+    allBandNumbers = landsatTOA.BAND_NUM_DICT[spaceCraft]
+
+    # Indexes of the usual stack which are actually used, in stack order
+    stackNdxList = sorted(set(fmaskConfig.bands.values()))
+    bandNumbers = [allBandNumbers[i] for i in stackNdxList]
+    filenames = [bandFilename(mtlFile, mtlInfo, bandNum) for bandNum in bandNumbers]
+
+    ds = gdal.BuildVRT(reflectiveVRT, filenames, separate=True)
+    del ds
+
+    for (band, stackNdx) in list(fmaskConfig.bands.items()):
+        fmaskConfig.setReflectiveBand(band, stackNdxList.index(stackNdx))
+
+    thermalBandNum = config.LANDSAT_TH_BAND_NUM_DICT[spaceCraft]
+    thermalFile = bandFilename(mtlFile, mtlInfo, thermalBandNum)
+
+    return (bandNumbers, thermalFile)
@@ -64,23 +64,32 @@ def makeSaturationMask(fmaskConfig, radiancefile, outMask):
     
 def riosSaturationMask(info, inputs, outputs, otherargs):
     """
-    Called from RIOS. Does the actual saturation test. Currently assumes that
-    only 8-bit radiance inputs can be saturated, but if this turns out
+    Called from RIOS. Does the actual saturation test. 
+    
+    """
+    outputs.mask = saturationForBlock(inputs.radiance, otherargs.radianceBands)
+
+
+def saturationForBlock(radiance, radianceBands):
+    """
+    Return the 3-layer saturation mask (blue, green, red) for a block of radiance.
+    The radianceBands are as in :attr:`fmask.config.FmaskConfig.bands`. Currently 
+    assumes that only 8-bit radiance inputs can be saturated, but if this turns out
     not to be true, we can come back to this. 
     
     """
-    if inputs.radiance.dtype == numpy.uint8:
-        blue = otherargs.radianceBands[config.BAND_BLUE]
-        green = otherargs.radianceBands[config.BAND_GREEN]
-        red = otherargs.radianceBands[config.BAND_RED]
+    if radiance.dtype == numpy.uint8:
+        blue = radianceBands[config.BAND_BLUE]
+        green = radianceBands[config.BAND_GREEN]
+        red = radianceBands[config.BAND_RED]
 
         satMaskList = []
         for band in [blue, green, red]:
-            satMaskList.append(inputs.radiance[band] == 255)
+            satMaskList.append(radiance[band] == 255)
 
-        outputs.mask = numpy.array(satMaskList).astype(numpy.uint8)
+        mask = numpy.array(satMaskList).astype(numpy.uint8)
     else:
         # Assume that anything larger than 8-bit is immune to saturation
-        outShape = (3, ) + inputs.radiance[0].shape
-        outputs.mask = numpy.zeros(outShape, dtype=numpy.uint8)
-    
+        outShape = (3, ) + radiance[0].shape
+        mask = numpy.zeros(outShape, dtype=numpy.uint8)
+    return mask
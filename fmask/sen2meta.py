@@ -6,7 +6,9 @@ Currently only has a class for the tile-based metadata file.
 """
 from __future__ import print_function, division
 
+import os
 import datetime
+import json
 from xml.etree import ElementTree
 
 import numpy
@@ -14,18 +16,137 @@ from osgeo import osr
 
 from . import fmaskerrors
 
+#: Suffix added to the XML filename, for the cache of the parsed metadata
+CACHE_SUFFIX = '.fmaskcache'
+# Incremented whenever the attributes of Sen2TileMeta change, so that any 
+# older cache files are ignored
+CACHE_VERSION = 2
+# The attributes of Sen2TileMeta stored in the cache, grouped by how they are 
+# converted to and from JSON. A cache file must have exactly these keys. 
+CACHE_PLAIN_ATTRS = ['tileId', 'satId', 'procLevel', 'epsg', 'angleGridXres', 
+    'angleGridYres']
+CACHE_TUPLE_ATTRS = ['anglesGridShape', 'anglesULXY']
+CACHE_TUPLEDICT_ATTRS = ['dimsByRes', 'ulxyByRes']
+CACHE_ARRAY_ATTRS = ['sunZenithGrid', 'sunAzimuthGrid']
+CACHE_ARRAYDICT_ATTRS = ['viewZenithDict', 'viewAzimuthDict']
+CACHE_KEYS = set(['version', 'datetime'] + CACHE_PLAIN_ATTRS + CACHE_TUPLE_ATTRS + 
+    CACHE_TUPLEDICT_ATTRS + CACHE_ARRAY_ATTRS + CACHE_ARRAYDICT_ATTRS)
+CACHE_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
 class Sen2TileMeta(object):
     """
     Metadata for a single 100km tile
     """
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, useCache=False):
         """
         Constructor takes a filename for the XML file of tile-based metadata. 
         
+        If useCache is True, the parsed metadata is kept in a file next to
+        the XML file (with :data:`CACHE_SUFFIX` added to its name), and is
+        read from there next time, as long as it is newer than the XML file.
+        If the cache cannot be written (e.g. a read-only directory), it is 
+        silently not used. The cache is plain JSON, so reading it cannot run
+        any code, and a cache which does not have exactly the expected 
+        contents is ignored. 
+        
+        """
+        if useCache:
+            cacheFile = filename + CACHE_SUFFIX
+            if self.readCache(filename, cacheFile):
+                return
+        
+        self.readXML(filename)
+        
+        if useCache:
+            self.writeCache(cacheFile)
+    
+    def readCache(self, filename, cacheFile):
+        """
+        Set all attributes from the cache file, if it exists, is up to date and 
+        is valid. Return True if this was done. 
+        
+        """
+        cacheOK = (os.path.exists(cacheFile) and 
+            os.path.getmtime(cacheFile) >= os.path.getmtime(filename))
+        if cacheOK:
+            try:
+                with open(cacheFile, 'r') as f:
+                    cacheDict = json.load(f)
+                attrDict = self.fromCacheDict(cacheDict)
+            except Exception:
+                attrDict = None
+            cacheOK = (attrDict is not None)
+        if cacheOK:
+            self.__dict__.update(attrDict)
+        return cacheOK
+    
+    def writeCache(self, cacheFile):
+        """
+        Write all attributes to the cache file, ignoring any failure to do so. 
+        
+        """
+        try:
+            with open(cacheFile, 'w') as f:
+                json.dump(self.toCacheDict(), f)
+        except (IOError, OSError):
+            pass
+    
+    def toCacheDict(self):
+        """
+        Return a dictionary of all attributes, with only types which JSON
+        can represent. 
+        
         """
-        f = open(filename)
+        cacheDict = {'version': CACHE_VERSION, 
+            'datetime': self.datetime.strftime(CACHE_DATETIME_FORMAT)}
+        for attr in CACHE_PLAIN_ATTRS + CACHE_TUPLE_ATTRS + CACHE_TUPLEDICT_ATTRS:
+            cacheDict[attr] = getattr(self, attr)
+        for attr in CACHE_ARRAY_ATTRS:
+            cacheDict[attr] = getattr(self, attr).tolist()
+        for attr in CACHE_ARRAYDICT_ATTRS:
+            cacheDict[attr] = dict([(k, a.tolist()) for (k, a) in getattr(self, attr).items()])
+        return cacheDict
+    
+    @staticmethod
+    def fromCacheDict(cacheDict):
+        """
+        Return a dictionary of the attributes, from a dictionary as made by 
+        :meth:`toCacheDict` (and read back from JSON). Return None if it does 
+        not have exactly the expected keys, or is from a different version. 
+        Raises an exception if any of the values cannot be converted. 
         
-        root = ElementTree.fromstring(f.read())
+        """
+        if (not isinstance(cacheDict, dict) or set(cacheDict.keys()) != CACHE_KEYS or
+                cacheDict['version'] != CACHE_VERSION):
+            return None
+        
+        attrDict = {'datetime': datetime.datetime.strptime(cacheDict['datetime'], 
+            CACHE_DATETIME_FORMAT)}
+        for attr in CACHE_PLAIN_ATTRS:
+            attrDict[attr] = cacheDict[attr]
+        for attr in ['tileId', 'satId', 'procLevel', 'epsg']:
+            attrDict[attr] = str(attrDict[attr])
+        for attr in ['angleGridXres', 'angleGridYres']:
+            attrDict[attr] = float(attrDict[attr])
+        attrDict['anglesGridShape'] = tuple([int(n) for n in cacheDict['anglesGridShape']])
+        attrDict['anglesULXY'] = tuple([float(x) for x in cacheDict['anglesULXY']])
+        attrDict['dimsByRes'] = dict([(str(res), tuple([int(n) for n in dims])) 
+            for (res, dims) in cacheDict['dimsByRes'].items()])
+        attrDict['ulxyByRes'] = dict([(str(res), tuple([float(x) for x in ulxy])) 
+            for (res, ulxy) in cacheDict['ulxyByRes'].items()])
+        for attr in CACHE_ARRAY_ATTRS:
+            attrDict[attr] = numpy.array(cacheDict[attr], dtype=numpy.float32)
+        for attr in CACHE_ARRAYDICT_ATTRS:
+            attrDict[attr] = dict([(str(k), numpy.array(v, dtype=numpy.float32)) 
+                for (k, v) in cacheDict[attr].items()])
+        return attrDict
+    
+    def readXML(self, filename):
+        """
+        Set all attributes by parsing the XML file
+        
+        """
+        root = ElementTree.parse(filename).getroot()
         # Stoopid XML namespace prefix
         nsPrefix = root.tag[:root.tag.index('}')+1]
         nsDict = {'n1':nsPrefix[1:-1]}
@@ -102,13 +223,13 @@ class Sen2TileMeta(object):
         Take a <Values_List> node from the XML, and return an array of the values contained
         within it. This will be a 2-d numpy array of float32 values (should I pass the dtype in??)
         
+        All rows are converted together, by numpy's own text parsing. 
+        
         """
         valuesList = valuesListNode.findall('VALUES')
-        vals = []
-        for valNode in valuesList:
-            text = valNode.text
-            vals.append([numpy.float32(x) for x in text.strip().split()])
-        return numpy.array(vals)
+        text = ' '.join([valNode.text for valNode in valuesList])
+        vals = numpy.fromstring(text, dtype=numpy.float32, sep=' ')
+        return vals.reshape((len(valuesList), -1))
     
     def buildViewAngleArr(self, viewingAngleNodeList, angleName):
         """
@@ -0,0 +1,114 @@
+"""
+Direct use of the band files of a Sentinel-2 granule, as distributed by ESA
+in a .SAFE directory, without first stacking all the bands.
+
+A VRT is made (in GDAL's in-memory filesystem) over only those bands which
+fmask actually uses, resampled as they are read to a single processing
+resolution. The sun and satellite angles come from the tile metadata XML
+(see :class:`fmask.config.Sen2TileAnglesInfo`).
+
+"""
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+import os
+import glob
+
+from osgeo import gdal
+gdal.UseExceptions()
+
+from . import fmaskerrors
+
+#: Names of the Sentinel-2 bands, in the usual stack order (i.e. the order
+#: assumed by the default :attr:`fmask.config.FmaskConfig.bands`)
+SEN2_BAND_NAMES = ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A',
+    'B09', 'B10', 'B11', 'B12']
+
+#: Default processing resolution, in metres
+DEFAULT_RESOLUTION = 20
+
+# Patterns for the tile metadata XML within a granule directory, for the
+# newer and older ESA file naming conventions
+TILE_XML_PATTERNS = ['MTD_TL.xml', '*_MTD_L1C_TL_*.xml']
+
+
+def findTileXML(path):
+    """
+    Return the name of the tile metadata XML file for a granule. The path may
+    be the XML file itself, the granule directory, or the .SAFE directory
+    (provided it contains only one granule).
+
+    """
+    if os.path.isfile(path):
+        return path
+
+    granuleDirList = [path]
+    granuleTopDir = os.path.join(path, 'GRANULE')
+    if os.path.isdir(granuleTopDir):
+        granuleDirList = glob.glob(os.path.join(granuleTopDir, '*'))
+        if len(granuleDirList) != 1:
+            msg = ('{} contains {} granules. Please give the granule directory ' +
+                'instead').format(path, len(granuleDirList))
+            raise fmaskerrors.FmaskFileError(msg)
+
+    xmlList = []
+    for pattern in TILE_XML_PATTERNS:
+        xmlList.extend(glob.glob(os.path.join(granuleDirList[0], pattern)))
+    if len(xmlList) != 1:
+        msg = 'Unable to find tile metadata XML file in {}'.format(path)
+        raise fmaskerrors.FmaskFileError(msg)
+    return xmlList[0]
+
+
+def bandFilename(tileXML, bandName):
+    """
+    Return the full path of the JPEG2000 file for the given band name (e.g.
+    'B08'), from the IMG_DATA directory of the granule with the given tile
+    metadata XML file.
+
+    """
+    imgDataDir = os.path.join(os.path.dirname(os.path.abspath(tileXML)), 'IMG_DATA')
+    fileList = glob.glob(os.path.join(imgDataDir, '*_{}.jp2'.format(bandName)))
+    if len(fileList) != 1:
+        msg = 'Unable to find band {} in {}'.format(bandName, imgDataDir)
+        raise fmaskerrors.FmaskFileError(msg)
+    return fileList[0]
+
+
+def makeReflectiveVRT(tileXML, fmaskConfig, reflectiveVRT, resolution=DEFAULT_RESOLUTION):
+    """
+    Make a VRT file of the bands of the granule which fmask uses (as given
+    in fmaskConfig.bands), in the usual stack order, all resampled (nearest
+    neighbour) to the given resolution as they are read. This would normally
+    be on GDAL's in-memory filesystem, e.g. '/vsimem/allbands.vrt'.
+
+    The band indexes in fmaskConfig are updated (see
+    :meth:`fmask.config.FmaskConfig.setReflectiveBand`) to match the VRT,
+    as it skips all the unused bands.
+
+    """
+    # Indexes of the usual stack which are actually used, in stack order
+    stackNdxList = sorted(set(fmaskConfig.bands.values()))
+    filenames = [bandFilename(tileXML, SEN2_BAND_NAMES[i]) for i in stackNdxList]
+
+    ds = gdal.BuildVRT(reflectiveVRT, filenames, separate=True, resolution='user',
+        xRes=resolution, yRes=resolution)
+    del ds
+
+    for (band, stackNdx) in list(fmaskConfig.bands.items()):
+        fmaskConfig.setReflectiveBand(band, stackNdxList.index(stackNdx))
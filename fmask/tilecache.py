@@ -0,0 +1,132 @@
+"""
+A small cache of fixed-size tiles from a raster band, so that arbitrary
+windows can be read repeatedly without either reading the whole band into
+memory, or going back to the file for every request.
+
+This is used where fmask needs random access to a few parts of a large
+image, such as when searching for the shadow of each cloud object. Nearby
+requests share the same tiles, so each part of the file is normally only
+read once.
+
+"""
+# This file is part of 'python-fmask' - a cloud masking module
+# Copyright (C) 2015  Neil Flood
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+from __future__ import print_function, division
+
+from collections import OrderedDict
+
+import numpy
+
+#: Default size (in pixels, both directions) of a cached tile
+DEFAULT_TILE_SIZE = 256
+#: Default maximum number of tiles held in memory at once
+DEFAULT_MAX_TILES = 64
+
+class TileCache(object):
+    """
+    Reads windows from a single band of an open GDAL dataset, through a
+    least-recently-used cache of square tiles.
+
+    Windows are given in pixel coordinates of the whole file. Any part of a
+    requested window which lies outside the raster is filled with fillValue,
+    so callers do not need to clip their windows to the raster extent.
+
+    The band number is 1-based, as for GDAL. If overview is given, the tiles
+    are read from that overview of the band (0-based, as for GDAL's 
+    GetOverview), and windows are in the pixel coordinates of the overview. 
+
+    """
+    def __init__(self, ds, bandNum, tileSize=DEFAULT_TILE_SIZE, maxTiles=DEFAULT_MAX_TILES,
+            fillValue=0, overview=None):
+        # Keep a reference to the dataset, so the band remains valid
+        self.ds = ds
+        self.band = ds.GetRasterBand(bandNum)
+        if overview is not None:
+            self.band = self.band.GetOverview(overview)
+        (self.nrows, self.ncols) = (self.band.YSize, self.band.XSize)
+        self.tileSize = tileSize
+        self.maxTiles = maxTiles
+        self.fillValue = fillValue
+        self.tiles = OrderedDict()
+        self.dtype = None
+
+    def getTile(self, tileRow, tileCol):
+        """
+        Return the array for the given tile, reading it from the file
+        if it is not already in the cache.
+
+        """
+        key = (tileRow, tileCol)
+        if key in self.tiles:
+            # Move it to the most-recently-used end
+            tile = self.tiles.pop(key)
+        else:
+            row0 = tileRow * self.tileSize
+            col0 = tileCol * self.tileSize
+            nrows = min(self.tileSize, self.nrows - row0)
+            ncols = min(self.tileSize, self.ncols - col0)
+            tile = self.band.ReadAsArray(col0, row0, ncols, nrows)
+            if self.dtype is None:
+                self.dtype = tile.dtype
+            if len(self.tiles) >= self.maxTiles:
+                # Drop the least recently used tile
+                self.tiles.popitem(last=False)
+        self.tiles[key] = tile
+        return tile
+
+    def readWindow(self, row0, col0, nrows, ncols):
+        """
+        Return a 2-d array of the given window, with its top-left pixel at
+        (row0, col0) in the file.
+
+        """
+        # Clip the window to the raster
+        r0 = max(row0, 0)
+        c0 = max(col0, 0)
+        r1 = min(row0 + nrows, self.nrows)
+        c1 = min(col0 + ncols, self.ncols)
+
+        if self.dtype is None and r1 > r0 and c1 > c0:
+            # Make sure we know the datatype before allocating the window
+            self.getTile(r0 // self.tileSize, c0 // self.tileSize)
+        dtype = self.dtype
+        if dtype is None:
+            dtype = numpy.array(self.fillValue).dtype
+        window = numpy.empty((nrows, ncols), dtype=dtype)
+        window.fill(self.fillValue)
+
+        if r1 > r0 and c1 > c0:
+            tileSize = self.tileSize
+            for tileRow in range(r0 // tileSize, (r1 - 1) // tileSize + 1):
+                tr0 = tileRow * tileSize
+                for tileCol in range(c0 // tileSize, (c1 - 1) // tileSize + 1):
+                    tc0 = tileCol * tileSize
+                    tile = self.getTile(tileRow, tileCol)
+                    # The part of this tile which falls within the window, in file coords
+                    fr0 = max(r0, tr0)
+                    fr1 = min(r1, tr0 + tile.shape[0])
+                    fc0 = max(c0, tc0)
+                    fc1 = min(c1, tc0 + tile.shape[1])
+                    window[fr0-row0:fr1-row0, fc0-col0:fc1-col0] = tile[fr0-tr0:fr1-tr0,
+                        fc0-tc0:fc1-tc0]
+        return window
+
+    def clear(self):
+        """
+        Release all cached tiles
+        """
+        self.tiles.clear()
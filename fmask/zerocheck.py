@@ -23,9 +23,16 @@ be all zeroes and hence unusable form cloud masking.
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 from __future__ import print_function, division
 
-from rios import applier
+import numpy
+from osgeo import gdal
+gdal.UseExceptions()
 from rios import fileinfo
 
+#: Number of rows, spread evenly down the image, read as a quick sample
+SAMPLE_NROWS = 16
+#: Approximate number of pixels to read at a time, when reading the whole band
+READ_NPIXELS = 1024 * 1024
+
 def isBandAllZeroes(filename, band=0):
     """
     Checks the specified band within a file to see if it is all zeroes.
@@ -36,7 +43,13 @@ def isBandAllZeroes(filename, band=0):
     This function firstly checks the stats if present and uses this
     and assumes that they are correct.
     
-    If they are not present, then the band is read and the values determined.
+    If they are not present, then the smallest overview (if any), and a
+    sample of rows spread down the image, are checked for non-zero values. 
+    A non-zero overview pixel is only trusted once the full resolution pixels
+    it came from have been read and found to include a non-zero value. 
+    Only if these are all zero is the whole band read, a strip at a time, 
+    stopping as soon as a non-zero value is found. Only the one band is
+    ever read. 
     
     """
 
@@ -46,26 +59,40 @@ def isBandAllZeroes(filename, band=0):
         # we have valid stats
         return maxVal == 0
     
-    # otherwise read the thing with rios
-    infiles = applier.FilenameAssociations()
-    infiles.input = filename
-    
-    outfiles = applier.FilenameAssociations()
-    
-    otherArgs = applier.OtherInputs()
-    otherArgs.nonZeroFound = False
-    otherArgs.band = band
-    
-    applier.apply(riosAllZeroes, infiles, outfiles, otherArgs)
-    
-    return not otherArgs.nonZeroFound
+    ds = gdal.Open(filename)
+    gdalBand = ds.GetRasterBand(band + 1)
+    (nrows, ncols) = (ds.RasterYSize, ds.RasterXSize)
+
+    # An overview only suggests where there is something non-zero, as small
+    # non-zero areas may be lost from it, and resampling such as cubic may 
+    # overshoot. So the full resolution pixels under the first non-zero overview
+    # pixel (and those around it) are read to confirm it. 
+    numOverviews = gdalBand.GetOverviewCount()
+    if numOverviews > 0:
+        overview = gdalBand.GetOverview(numOverviews - 1).ReadAsArray()
+        if overview.max() > 0:
+            (ovNrows, ovNcols) = overview.shape
+            (ovRow, ovCol) = numpy.unravel_index(numpy.argmax(overview > 0), 
+                overview.shape)
+            row0 = max(ovRow - 1, 0) * nrows // ovNrows
+            row1 = min(ovRow + 2, ovNrows) * nrows // ovNrows
+            col0 = max(ovCol - 1, 0) * ncols // ovNcols
+            col1 = min(ovCol + 2, ovNcols) * ncols // ovNcols
+            if gdalBand.ReadAsArray(int(col0), int(row0), int(col1 - col0), 
+                    int(row1 - row0)).max() > 0:
+                return False
     
+    sampleStep = max(nrows // SAMPLE_NROWS, 1)
+    for row in range(sampleStep // 2, nrows, sampleStep):
+        if gdalBand.ReadAsArray(0, row, ncols, 1).max() > 0:
+            return False
     
-def riosAllZeroes(info, inputs, outputs, otherArgs):
-    """
-    Called from RIOS. Does the actual work.
+    # Read whole strips of the file's own blocks, stopping at the first non-zero
+    blockNrows = gdalBand.GetBlockSize()[1]
+    stripNrows = max(READ_NPIXELS // (ncols * blockNrows), 1) * blockNrows
+    for row in range(0, nrows, stripNrows):
+        numRows = min(stripNrows, nrows - row)
+        if gdalBand.ReadAsArray(0, row, ncols, numRows).max() > 0:
+            return False
     
-    """
-    if inputs.input[otherArgs.band].max() > 0:
-        otherArgs.nonZeroFound = True
-    
\ No newline at end of file
+    return True